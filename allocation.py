@@ -0,0 +1,202 @@
+"""Batch allocation of pending add requests.
+
+    python allocation.py [--db path] [--policy fifo|lottery] [--seed N] [--dry-run]
+
+Every pending AddRequest, class capacity and student period mask is loaded
+into flat arrays and decided in one pass. The enrollments are then written
+in one transaction. Don't point the CLI at the database of a running server:
+the server's seat index and response cache won't see the change. Use
+/allocateAddRequests there instead.
+"""
+import argparse
+import array
+import json
+import os
+import random
+import sqlite3
+import time
+
+import journal
+import migrations
+import seats
+from periods import periodBit
+from writer import Rollback, transaction
+
+FIFO = "fifo"
+LOTTERY = "lottery"
+POLICIES = (FIFO, LOTTERY)
+
+
+class Allocation:
+    """What plan() decided: the enrollments to write, a count per outcome
+    (seats statuses; missing covers a deleted class or student) and timings."""
+
+    def __init__(self, policy, seed):
+        self.policy = policy
+        self.seed = seed
+        self.enrolled = []  # (requestId, classId, studentId, student)
+        self.seatsTaken = {}  # classId -> seats
+        self.masks = {}  # studentId -> period bits gained
+        self.classesFilled = 0  # classes this allocation left with no seats
+        self.counts = dict.fromkeys((seats.ENROLLED, seats.CLASS_FULL, seats.PERIOD_CONFLICT, seats.NO_SUCH_CLASS), 0)
+        self.timing = {}
+
+    def asDict(self, dryRun=False):
+        return {
+            "policy": self.policy,
+            "seed": self.seed,
+            "dryRun": dryRun,
+            "requests": sum(self.counts.values()),
+            "enrolled": self.counts[seats.ENROLLED],
+            "full": self.counts[seats.CLASS_FULL],
+            "conflict": self.counts[seats.PERIOD_CONFLICT],
+            "missing": self.counts[seats.NO_SUCH_CLASS],
+            "classesTouched": len(self.seatsTaken),
+            "classesFilled": self.classesFilled,
+            "timing": {name: round(seconds, 4) for name, seconds in self.timing.items()},
+        }
+
+
+# Lottery order: students drawn at random, then served round-robin in that
+# order, so everyone's oldest request is tried before anyone's second one
+def _lotteryOrder(requestStudents, rng):
+    byStudent = {}
+    for i, student in enumerate(requestStudents):
+        byStudent.setdefault(student, []).append(i)
+    students = list(byStudent)
+    rng.shuffle(students)
+    rounds = []
+    for student in students:
+        for depth, i in enumerate(byStudent[student]):
+            if depth == len(rounds):
+                rounds.append([])
+            rounds[depth].append(i)
+    return [i for requests in rounds for i in requests]
+
+
+def plan(cursor, policy=FIFO, seed=None):
+    """Decide every pending add request against the current capacities and
+    period masks, returns an Allocation. Reads only; run it in the same
+    transaction as apply() for the decisions to still hold when written."""
+    if policy not in POLICIES:
+        raise ValueError(f"unknown policy {policy!r}, expected {' or '.join(POLICIES)}")
+    if policy == LOTTERY and seed is None:
+        seed = random.SystemRandom().randrange(2 ** 31)
+    allocation = Allocation(policy, seed if policy == LOTTERY else None)
+    started = time.perf_counter()
+
+    # Classes and students become dense indexes into typed arrays
+    cursor.execute("SELECT id, period, capacity FROM Classes")
+    classIndex = {}
+    classIds = array.array("q")
+    periodBits = array.array("q")
+    capacity = array.array("q")
+    for classId, period, seatsLeft in cursor:
+        classIndex[classId] = len(classIds)
+        classIds.append(classId)
+        periodBits.append(periodBit(period))
+        capacity.append(seatsLeft)
+
+    cursor.execute("SELECT id, student, classId, studentId FROM AddRequests ORDER BY id")
+    requests = cursor.fetchall()
+    requestClass = array.array("q", (classIndex.get(row[2], -1) for row in requests))
+
+    studentIndex = {}
+    studentIds = array.array("q")
+    masks = array.array("q")
+    cursor.execute("""
+        SELECT id, periodMask FROM Users
+        WHERE id IN (SELECT DISTINCT studentId FROM AddRequests) AND role = 'student'
+    """)
+    for studentId, mask in cursor:
+        studentIndex[studentId] = len(studentIds)
+        studentIds.append(studentId)
+        masks.append(mask)
+    requestStudent = array.array("q", (studentIndex.get(row[3], -1) for row in requests))
+    startMasks = array.array("q", masks)
+    loaded = time.perf_counter()
+
+    order = range(len(requests))
+    if policy == LOTTERY:
+        order = _lotteryOrder(requestStudent, random.Random(seed))
+    counts = allocation.counts
+    enrolled = []
+    for i in order:
+        c = requestClass[i]
+        s = requestStudent[i]
+        if c < 0 or s < 0:
+            counts[seats.NO_SUCH_CLASS] += 1
+        elif capacity[c] <= 0:
+            counts[seats.CLASS_FULL] += 1
+        elif masks[s] & periodBits[c]:
+            counts[seats.PERIOD_CONFLICT] += 1
+        else:
+            capacity[c] -= 1
+            masks[s] |= periodBits[c]
+            counts[seats.ENROLLED] += 1
+            enrolled.append(i)
+    assigned = time.perf_counter()
+
+    for i in enrolled:
+        requestId, student, classId, studentId = requests[i]
+        allocation.enrolled.append((requestId, classId, studentId, student))
+        allocation.seatsTaken[classId] = allocation.seatsTaken.get(classId, 0) + 1
+    allocation.classesFilled = sum(1 for classId in allocation.seatsTaken if capacity[classIndex[classId]] == 0)
+    for s, studentId in enumerate(studentIds):
+        if masks[s] != startMasks[s]:
+            allocation.masks[studentId] = masks[s] & ~startMasks[s]
+    allocation.timing["loadSeconds"] = loaded - started
+    allocation.timing["assignSeconds"] = assigned - loaded
+    return allocation
+
+
+def apply(cursor, allocation):
+    """Write an Allocation: roster rows, seats, period masks, the granted
+    requests removed, and their journal rows. Call it inside the transaction
+    plan() read from."""
+    started = time.perf_counter()
+    cursor.executemany("""
+        INSERT INTO ClassStudents (classId, student, studentId) VALUES (?, ?, ?)
+    """, [(classId, student, studentId) for requestId, classId, studentId, student in allocation.enrolled])
+    cursor.executemany("UPDATE Classes SET capacity = capacity - ? WHERE id = ?",
+                       [(taken, classId) for classId, taken in allocation.seatsTaken.items()])
+    cursor.executemany("UPDATE Users SET periodMask = periodMask | ? WHERE id = ?",
+                       [(bits, studentId) for studentId, bits in allocation.masks.items()])
+    cursor.executemany("DELETE FROM AddRequests WHERE id = ?",
+                       [(requestId,) for requestId, classId, studentId, student in allocation.enrolled])
+    journal.recordEnrollments(cursor, journal.INSERT,
+                              [(classId, studentId) for requestId, classId, studentId, student in allocation.enrolled])
+    journal.recordMany(cursor, "AddRequests", journal.DELETE,
+                       [(classId, studentId, {"requestId": requestId, "reason": "allocated"})
+                        for requestId, classId, studentId, student in allocation.enrolled])
+    allocation.timing["writeSeconds"] = time.perf_counter() - started
+    return allocation
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.environ.get("DATABASE_PATH", "./database/database.db"))
+    parser.add_argument("--policy", choices=POLICIES, default=FIFO)
+    parser.add_argument("--seed", type=int, help="lottery seed, to repeat a draw")
+    parser.add_argument("--dry-run", action="store_true", help="decide and report, write nothing")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    try:
+        migrations.migrate(conn)
+        started = time.perf_counter()
+
+        def run(cursor):
+            allocation = plan(cursor, args.policy, args.seed)
+            if args.dry_run:
+                raise Rollback(allocation)
+            return apply(cursor, allocation)
+
+        allocation = transaction(conn, run)
+        result = allocation.asDict(args.dry_run)
+        result["timing"]["totalSeconds"] = round(time.perf_counter() - started, 4)
+    finally:
+        conn.close()
+    print(json.dumps(result, indent=2))
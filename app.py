@@ -1,13 +1,62 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, has_request_context
+import functools
+import json
 import sqlite3
 import os
-import hashlib
 import logging
 import secrets
+import time
+from pool import ConnectionPool
+from identity import IdentityCache
+from hashing import HashExecutor, HashPoolBusy
+from tokens import TokenSigner, InvalidToken
+import migrations
+from periods import freePeriods, getPeriodMask, periodBit, releaseClassPeriod, studentsFreeIn
+import seats
+from seatindex import SeatIndex
+from waitlist import Waitlists
+from events import RESYNC, EventBus
+import userimport
+import allocation
+import export
+import journal
+import backup
+from writer import WriteQueue, WriteQueueFull
+from metrics import RequestMetrics, addDbTime, addHashTime
+from sqltrace import SqlTracer, TracedConnection
+from versions import CATALOG, DataVersions, ResponseCache
 
 serverError = "An Internal Server Error Has Occurred"
 logInError = "Username or Password was incorrect"
+busyError = "Server is busy, please try again shortly"
 MAX_PERIODS = 7
+MAX_BATCH = 5000  # most requests one batch approval call will handle
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK = 500  # rows fetched per write when streaming a listing
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "./database/database.db")
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "16"))
+IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_CACHE_TTL = float(os.environ.get("IDENTITY_CACHE_TTL", "60"))
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", "0")) or None  # default: one per core
+HASH_MAX_PENDING = int(os.environ.get("HASH_MAX_PENDING", "0")) or None  # default: 8 per worker, at least 32
+# Without a configured secret every restart logs everyone out, and multiple
+# server processes won't accept each other's tokens
+SESSION_SECRET = os.environ.get("SESSION_SECRET") or secrets.token_hex(32)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "3600"))
+SQL_TRACE = os.environ.get("SQL_TRACE", "0") == "1"  # per-request X-SQL-Trace header and /sqlStats
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG")  # file for the slow query log, default is the app log
+WRITE_BATCH = int(os.environ.get("WRITE_BATCH", "64"))  # most writes committed together
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "1024"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "4096"))
+EVENT_BACKLOG = int(os.environ.get("EVENT_BACKLOG", "10000"))  # events kept for /adminEvents replay
+EVENT_SUBSCRIBERS = int(os.environ.get("EVENT_SUBSCRIBERS", "32"))  # each open stream holds a server thread
+EVENT_KEEPALIVE = 15  # seconds between keepalive comments on an idle event stream
+BACKUP_DIR = os.environ.get("BACKUP_DIR") or os.path.join(os.path.dirname(DATABASE_PATH), "backups")
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", str(backup.BACKUP_PAGES)))  # pages copied per step
+BACKUP_SLEEP_MS = float(os.environ.get("BACKUP_SLEEP_MS", str(backup.BACKUP_SLEEP * 1000)))  # pause between steps
 
 
 app = Flask(__name__)
@@ -15,10 +64,100 @@ app = Flask(__name__)
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
 
-# Create a database connection
-def __createConnection():
+# Shared pool of configured connections, borrowed per request instead of reconnecting.
+# foreign_keys stays off for now: schema.sql references Users(full_name), which isn't
+# unique, so sqlite would reject every write with "foreign key mismatch"
+# Every statement is timed; slow ones and repeated ones are logged to the "slowquery" logger
+sqlTracer = SqlTracer(enabled=SQL_TRACE, slowSeconds=SLOW_QUERY_MS / 1000)
+slowQueryLog = logging.getLogger("slowquery")
+slowQueryLog.setLevel(logging.WARNING)
+if SLOW_QUERY_LOG:
+    slowQueryLog.addHandler(logging.FileHandler(SLOW_QUERY_LOG))
+    slowQueryLog.propagate = False
+dbPool = ConnectionPool(DATABASE_PATH, maxSize=POOL_SIZE, foreignKeys=False,
+                        factory=TracedConnection, onConnect=sqlTracer.attach)
+
+# Bring the schema up to date before serving anything
+with dbPool.connection() as conn:
+    migrations.migrate(conn)
+    for name, detail in migrations.checkQueryPlans(conn):
+        logging.error(f"Hot query '{name}' falls back to a full scan: {detail}")
+
+# All writes go through one thread and connection, committed in groups, so request
+# threads never fight over the write lock. Reads still use the pools
+writeQueue = WriteQueue(dbPool.dedicated, maxBatch=WRITE_BATCH, maxPending=WRITE_QUEUE_SIZE)
+
+def __attachReadConnection(conn):
+    sqlTracer.attach(conn)
+    conn.readOnly = True  # so __closeConnection returns it to readPool
+
+# GET handlers read through mode=ro, query_only connections with a bigger cache,
+# so catalog traffic never waits on a connection behind enrollment writes
+readPool = ConnectionPool(DATABASE_PATH, maxSize=READ_POOL_SIZE, foreignKeys=False, readOnly=True,
+                          factory=TracedConnection, onConnect=__attachReadConnection)
+
+# Open classes by period for studentGetAvailableClasses. Anything that changes a
+# class's capacity, or creates or deletes a class, must call seatIndex.refresh
+seatIndex = SeatIndex()
+# Students queued for full classes, promoted when a drop frees a seat
+waitlists = Waitlists()
+with readPool.connection() as conn:
+    seatIndex.load(conn.cursor())
+    waitlists.load(conn.cursor())
+
+# username -> (role, full_name, user id), so role checks usually skip the database entirely.
+# Anything that changes a Users row must call identityCache.invalidate(username)
+identityCache = IdentityCache(maxSize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+# Writes that change what a polled GET returns must call dataVersions.touch with
+# the keys that GET depends on (see conditionalGet)
+dataVersions = DataVersions()
+responseCache = ResponseCache(maxSize=RESPONSE_CACHE_SIZE)
+# Add/drop request changes pushed to /adminEvents. Writes that add or remove a
+# request publish through eventBus.publishOnCommit
+eventBus = EventBus(maxBacklog=EVENT_BACKLOG, maxSubscribers=EVENT_SUBSCRIBERS)
+# Online backups started from /backupDatabase, one at a time on their own thread
+backupRunner = backup.BackupRunner(DATABASE_PATH, BACKUP_DIR, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP_MS / 1000)
+
+# PBKDF2 runs in worker processes; raises HashPoolBusy when the queue is full
+hashExecutor = HashExecutor(workers=HASH_WORKERS, maxPending=HASH_MAX_PENDING)
+
+# Signed session tokens issued by /login; revoke(username) kills the user's live tokens
+tokenSigner = TokenSigner(SESSION_SECRET, ttl=SESSION_TTL)
+
+# Latency, status and db/hash/python time per route, served on /metrics
+requestMetrics = RequestMetrics()
+
+@app.before_request
+def __startRequestMetrics():
+    requestMetrics.start()
+    sqlTracer.start()
+
+@app.after_request
+def __recordRequestMetrics(response):
+    route = __routeLabel()
+    requestMetrics.finish(route, request.method, response.status_code)
+    trace = sqlTracer.finish(route)
+    if trace and sqlTracer.enabled:
+        response.headers["X-SQL-Trace"] = sqlTracer.header(trace)
+    return response
+
+# Only runs the recording if after_request didn't, i.e. the handler raised
+@app.teardown_request
+def __recordFailedRequest(exc):
+    route = __routeLabel()
+    requestMetrics.finish(route, request.method, 500)
+    sqlTracer.finish(route)
+
+# The rule, not the path, so ids in urls don't turn into separate series
+def __routeLabel():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+# Borrow a database connection, from readPool for GET requests (or readOnly=True)
+def __createConnection(readOnly=None):
+    if readOnly is None:
+        readOnly = has_request_context() and request.method == "GET"
     try:
-        conn = sqlite3.connect("./database/database.db")  # Ensure the database file exists
+        conn = (readPool if readOnly else dbPool).acquire()
         cursor = conn.cursor()
         return conn, cursor
     except sqlite3.Error as e:
@@ -28,52 +167,250 @@ def __createConnection():
 def __generateSalt():
     return os.urandom(16).hex()
 
-# Hash a password with a given salt
+# Hash a password with a given salt (on the hashing process pool)
 def __hashPassword(password, salt):
-    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 100000).hex()
+    start = time.perf_counter()
+    try:
+        return hashExecutor.hash(password, salt)
+    finally:
+        addHashTime(time.perf_counter() - start)
+
+# Run fn(cursor) on the writer thread and wait for its commit, returns what fn returns.
+# fn raising Rollback(value) undoes its own changes and returns value
+def __write(fn):
+    start = time.perf_counter()
+    trace = sqlTracer.current()
+    if trace is not None:
+        # fn's statements count towards this request's trace, not the writer thread's
+        inner = fn
+        def fn(cursor):
+            with sqlTracer.using(trace):
+                return inner(cursor)
+    try:
+        return writeQueue.run(fn)
+    finally:
+        addDbTime(time.perf_counter() - start)
 
+# Hand the connection back to the pool
 def __closeConnection(conn, cursor):
     if cursor:
         cursor.close()
     if conn:
-        conn.close()
-
-def __checkRole(username, roleCheck):
-    conn, cursor = None, None
+        (readPool if getattr(conn, "readOnly", False) else dbPool).release(conn)
+
+# Look up (role, full_name, user id) for a username, cache first
+# Pass the handler's cursor in when it already holds a connection
+def __getIdentity(username, cursor=None):
+    identity = identityCache.get(username)
+    if identity:
+        return identity
+    conn, ownCursor = None, None
     try:
-        roleCheck = roleCheck.lower()
-        conn, cursor = __createConnection()
-        query = "SELECT 1 FROM Users WHERE username = ? and role = ?"
-        cursor.execute(query, [username, roleCheck])
+        if cursor is None:
+            conn, ownCursor = __createConnection(readOnly=True)
+            cursor = ownCursor
+        cursor.execute("SELECT role, full_name, id FROM Users WHERE username = ?", [username])
         user = cursor.fetchone()
         if not user:
             return None
-        return user
-    except Exception as e:
-        return None
+        identityCache.put(username, user[0], user[1], user[2])
+        return user[0], user[1], user[2]
     finally:
-        __closeConnection(conn, cursor)
+        __closeConnection(conn, ownCursor)
 
-#FIXME: FIX ME
-def __getMissingPeriods(username):
-    conn, cursor = None, None
+def __checkRole(username, roleCheck, cursor=None):
     try:
-        conn, cursor = __createConnection()
-        cursor.execute("""
-            SELECT c.period 
-            FROM ClassStudents cs
-            JOIN Classes c ON cs.classId = c.id
-            WHERE cs.student = (
-                SELECT full_name FROM Users WHERE username = ?
-            )
-        """, [username])
-        taken = {row[0] for row in cursor.fetchall()}
-        return [p for p in range(1, MAX_PERIODS+1) if p not in taken]
+        identity = __getIdentity(username, cursor)
+        if not identity or identity[0] != roleCheck.lower():
+            return None
+        return identity
     except Exception as e:
-        logging.error(f"Period check error: {e}")
         return None
-    finally:
-        __closeConnection(conn, cursor)
+
+# Work out which user a request refers to, by integer id or by full name.
+# Returns (userId, fullName, error); names shared by several users need the id
+def __resolveUser(cursor, userId=None, fullName=None, role=None):
+    if isinstance(userId, int) and userId:
+        cached = identityCache.getById(userId)
+        if cached:
+            userRole, fullName = cached[1], cached[2]
+        else:
+            cursor.execute("SELECT role, full_name FROM Users WHERE id = ?", [userId])
+            user = cursor.fetchone()
+            if not user:
+                return None, None, "user doesn't exist"
+            userRole, fullName = user
+        if role and userRole != role:
+            return None, None, f"user is not a {role}"
+        return userId, fullName, None
+    if not isinstance(fullName, str) or not fullName:
+        return None, None, "missing user"
+    cursor.execute("SELECT id, role FROM Users WHERE full_name = ?", [fullName])
+    matches = [row[0] for row in cursor.fetchall() if not role or row[1] == role]
+    if not matches:
+        return None, None, f"{role or 'user'} doesn't exist"
+    if len(matches) > 1:
+        return None, None, "more than one user has that name, pass their id instead"
+    return matches[0], fullName, None
+
+# Read the bearer token from the Authorization header
+def __getSessionToken():
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[len("Bearer "):].strip()
+    return None
+
+# Verifies the session token in memory and passes the caller's Identity
+# (username, userId, fullName, role) to the handler as its first argument
+def requireRole(*roles):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            token = __getSessionToken()
+            if not token:
+                return jsonify({"error": "User is not logged in"}), 401
+            try:
+                identity = tokenSigner.verify(token)
+            except InvalidToken as e:
+                return jsonify({"error": f"Invalid session: {e}"}), 401
+            if identity.role not in roles:
+                return jsonify({"error": "Permission denied"}), 403
+            return handler(identity, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Query string argument as an int, None if it is missing or isn't one
+def __intArg(name):
+    try:
+        return int(request.args.get(name))
+    except (TypeError, ValueError):
+        return None
+
+# Goes under requireRole on a GET. keysFor(identity) lists the dataVersions keys the
+# response depends on; while none of them move the client gets a 304 for its ETag,
+# or the body from responseCache, and the handler doesn't run. Only 200s are cached
+def conditionalGet(keysFor):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(identity, *args, **kwargs):
+            resource = (request.full_path, identity.userId)
+            etag = dataVersions.etag(resource, keysFor(identity))
+            # If-None-Match compares weakly (RFC 9110), so W/"..." from a proxy still matches
+            if request.if_none_match.contains_weak(etag):
+                responseCache.notModified()
+                response = app.response_class(status=304)
+            else:
+                body = responseCache.get(resource, etag)
+                if body is None:
+                    response = app.make_response(handler(identity, *args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    responseCache.put(resource, etag, response.get_data())
+                else:
+                    response = app.response_class(body, mimetype="application/json")
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+# Error message for each way seats.enroll can fail
+enrollErrors = {
+    seats.CLASS_FULL: "Class is full",
+    seats.NO_SUCH_CLASS: "class id doesn't exist",
+    seats.PERIOD_CONFLICT: "class doesn't fit schedule",
+    seats.ALREADY_ENROLLED: "student is already in the class",
+}
+
+# Bookkeeping for enrolling or dropping (classId, studentId) pairs, from inside the write:
+# the seat counts and the data versions the polled GETs depend on. CATALOG only
+# moves when a class opened or filled up, so the open class listings stay cached
+# through the seat count changes in between
+def __enrollmentsChanged(cursor, pairs):
+    if pairs:
+        classIds = {classId for classId, studentId in pairs}
+        seatIndex.refresh(cursor, classIds, onListingChanged=lambda: dataVersions.bump(CATALOG))
+        keys = {("class", classId) for classId in classIds}
+        keys.update(("seats", classId) for classId in classIds)
+        keys.update(("student", studentId) for classId, studentId in pairs)
+        dataVersions.touch(*keys)
+
+# Listing row (see __requestRow) for the request just inserted, as an "add.created"
+# or "drop.created" event, and its journal row
+def __requestCreated(cursor, table, kind, requestId):
+    journal.recordRequest(cursor, table, requestId)
+    cursor.execute(REQUEST_ROW_QUERY.format(table=table) + " WHERE r.id = ?", [requestId])
+    row = cursor.fetchone()
+    if row:
+        eventBus.publishOnCommit(f"{kind}.created", __requestRow(row))
+
+requestTables = {"add": "AddRequests", "drop": "DropRequests"}
+
+# "add.removed" or "drop.removed" and a journal row for (classId, studentId) requests
+# that were just deleted
+def __requestsRemoved(cursor, kind, pairs, reason):
+    journal.recordMany(cursor, requestTables[kind], journal.DELETE,
+                       [(classId, studentId, {"reason": reason}) for classId, studentId in pairs])
+    for classId, studentId in pairs:
+        eventBus.publishOnCommit(f"{kind}.removed", {"classId": classId, "studentId": studentId, "reason": reason})
+
+# Give a seat that was just freed to the head of the class's waitlist, from inside
+# the write that freed it. Returns the promoted student's id, or None
+def __fillFromWaitlist(cursor, classId):
+    promoted = waitlists.promote(cursor, classId)
+    # everyone behind moved up, or was dropped off the list
+    dataVersions.touch(("waitlist", classId))
+    if promoted is not None:
+        # an add request they also had for the class is now moot
+        cursor.execute("DELETE FROM AddRequests WHERE classId = ? AND studentId = ?", [classId, promoted])
+        if cursor.rowcount:
+            __requestsRemoved(cursor, "add", [(classId, promoted)], "promoted")
+    return promoted
+
+# Pending (classId, studentId, student) rows a batch approval should process, from
+# either {"requests": [{"classId": int, "studentId": int}, ...]} or {"classId": int, "all": true}.
+# Returns (rows, missing, remaining, error); missing are requested pairs with nothing
+# pending, remaining is how many of the class's pending requests were past MAX_BATCH
+def __pendingBatch(cursor, table, data):
+    classId = data.get("classId")
+    if data.get("all") is True:
+        if not isinstance(classId, int):
+            return None, None, 0, "classId must be an int"
+        # The window counts every pending request before LIMIT cuts the page
+        cursor.execute(f"""
+            SELECT classId, studentId, student, COUNT(*) OVER () FROM {table}
+            WHERE classId = ?
+            ORDER BY id
+            LIMIT ?
+        """, [classId, MAX_BATCH])
+        found = cursor.fetchall()
+        remaining = found[0][3] - len(found) if found else 0
+        return [row[:3] for row in found], [], remaining, None
+
+    requests = data.get("requests")
+    if not isinstance(requests, list) or not requests:
+        return None, None, 0, "pass a list of requests, or classId with all: true"
+    if len(requests) > MAX_BATCH:
+        return None, None, 0, f"at most {MAX_BATCH} requests per batch"
+    pairs = []
+    for item in requests:
+        if not isinstance(item, dict) or not isinstance(item.get("classId"), int) or not isinstance(item.get("studentId"), int):
+            return None, None, 0, "each request needs an int classId and studentId"
+        pairs.append((item["classId"], item["studentId"]))
+    # A pair listed twice is processed and reported once
+    pairs = list(dict.fromkeys(pairs))
+    # One query for the whole list instead of a lookup per pair
+    cursor.execute(f"""
+        SELECT t.classId, t.studentId, t.student
+        FROM json_each(?) j
+        JOIN {table} t
+            ON t.classId = json_extract(j.value, '$[0]')
+            AND t.studentId = json_extract(j.value, '$[1]')
+        ORDER BY t.id
+    """, [json.dumps(pairs)])
+    rows = cursor.fetchall()
+    found = {(row[0], row[1]) for row in rows}
+    missing = [pair for pair in pairs if pair not in found]
+    return rows, missing, 0, None
 
 # Login route
 #notes: use json raw to pass in
@@ -93,10 +430,11 @@ def login():
         # Validate inputs
         if not all ([username, password, user_type]):
             return jsonify({"error": "Missing Parameter"}), 400
-        if not __checkRole(username, user_type):
+        identity = __checkRole(username, user_type)
+        if not identity:
             return jsonify({"error": "role doesnt match user"}), 400
         # Connect to the database
-        conn, cursor = __createConnection()
+        conn, cursor = __createConnection(readOnly=True)
         # Query the database for the user's salt and hashed password
         query = "SELECT salt, hash FROM Users WHERE username = ?"
         cursor.execute(query, [username])
@@ -115,9 +453,12 @@ def login():
         if not secrets.compare_digest(input_hash, stored_hash):
             return jsonify({"error": logInError}), 401
 
-        # If login is successful
-        return jsonify({"login": True, "message": "Login successful"}), 200
+        # If login is successful, hand out a session token for the other endpoints
+        token, expires = tokenSigner.issue(username, identity[2], identity[1], identity[0])
+        return jsonify({"login": True, "message": "Login successful", "token": token, "expires": expires}), 200
 
+    except HashPoolBusy:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Error during login: {e}")
         return jsonify({"error": serverError}), 500
@@ -128,290 +469,419 @@ def login():
 #TODO Admin Endpoints
 
 @app.route("/addNewClass", methods=["POST"])
-def addNewClass():
+@requireRole("admin")
+def addNewClass(identity):
     data = request.json
-    username = data.get("username")
-    if not isinstance(username, str):
-        return jsonify({"error": "parameter is wrong type"})
-    if not username or not __checkRole(username, "admin"):
-        return jsonify({"error": "Permission not granted"}), 400
-    
     # Extract required parameters
     className = data.get("classname")
     description = data.get("description")
-    teacher = data.get("teacher")  # Must be the teacher's name
+    teacher = data.get("teacher")  # The teacher's name, or pass teacherId
+    teacherId = data.get("teacherId")
     capacity = data.get("capacity")
     period = data.get("period")
 
-    if not isinstance(className, str) or not isinstance(description, str) or not isinstance(teacher, str) or not isinstance(capacity, int) or not isinstance(period, int):
+    if not isinstance(className, str) or not isinstance(description, str) or not isinstance(capacity, int) or not isinstance(period, int):
+        return jsonify({"error": "parameters are of wrong types"})
+    if not isinstance(teacher, str) and not isinstance(teacherId, int):
         return jsonify({"error": "parameters are of wrong types"})
     
     # Validate all required parameters
-    if not all([className, description, teacher, capacity, period]):
+    if not all([className, description, teacher or teacherId, capacity, period]):
         return jsonify({"error": "Missing parameters"}), 400
+    # periodBit and the period masks only cover 1..MAX_PERIODS
+    if not 1 <= period <= MAX_PERIODS:
+        return jsonify({"error": f"period must be between 1 and {MAX_PERIODS}"}), 400
 
-    conn, cursor = None, None  # Initialize connection and cursor
-    try:
-        conn, cursor = __createConnection()
+    # Checked and inserted on the writer, so two admins can't book the same teacher's period
+    def insertClass(cursor):
         #check if teacher exists
-        teacherExistsQuery = """
-            SELECT 1
-            FROM Users
-            WHERE full_name = ? and role = "teacher"
-        """
-        cursor.execute(teacherExistsQuery, [teacher])
-        if not cursor.fetchone():
-            return jsonify({"error": "Teacher does not exist"}), 400
+        resolvedId, teacherName, error = __resolveUser(cursor, teacherId, teacher, "teacher")
+        if error:
+            return error
         # Check if the teacher is free for the given period
         teacherQuery = """
             SELECT 1
             FROM Classes
-            WHERE teacher = ? AND period = ?
+            WHERE teacherId = ? AND period = ?
         """
-        cursor.execute(teacherQuery, [teacher, period])
+        cursor.execute(teacherQuery, [resolvedId, period])
         if cursor.fetchone():
-            return jsonify({"error": "Teacher is already assigned for that period"}), 400
+            return "Teacher is already assigned for that period"
 
         # Add the new class to the database
         newClassQuery = """
-            INSERT INTO Classes (className, classDescription, capacity, teacher, period) 
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO Classes (className, classDescription, capacity, teacher, teacherId, period) 
+            VALUES (?, ?, ?, ?, ?, ?)
         """
-        cursor.execute(newClassQuery, [className, description, capacity, teacher, period])
-        conn.commit()
+        cursor.execute(newClassQuery, [className, description, capacity, teacherName, resolvedId, period])
+        newClassId = cursor.lastrowid
+        # and to the teacher's schedule, which is what the teacher endpoints read
+        cursor.execute("""
+            INSERT INTO TeacherSchedule (teacher, teacherId, classId) VALUES (?, ?, ?)
+        """, [teacherName, resolvedId, newClassId])
+        journal.record(cursor, "Classes", journal.INSERT, classId=newClassId, userId=resolvedId,
+                       data={"capacity": capacity, "period": period})
+        seatIndex.refresh(cursor, [newClassId])
+        dataVersions.touch(("class", newClassId), ("teacher", resolvedId), CATALOG)
+        return None
+
+    try:
+        error = __write(insertClass)
+        if error:
+            return jsonify({"error": error}), 400
         return jsonify({"message": "Class added successfully"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
-        if conn:
-            conn.rollback()  # Rollback transaction on error
         logging.error(f"Error during class addition: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn and cursor:
-            __closeConnection(conn, cursor)
 
 #TODO: TEST
 @app.route("/addStudentToClass", methods=["POST"])
-def addStudentToClass():
+@requireRole("admin")
+def addStudentToClass(identity):
     data = request.json
-    username = data.get("username")
-    student = data.get("student")
+    student = data.get("student")  # full name, or pass studentId
+    studentId = data.get("studentId")
     classId = data.get("classId")
-    if not all([isinstance(username, str), isinstance(student, str), isinstance(classId, int)]):
+    if not all([isinstance(student, str) or isinstance(studentId, int), isinstance(classId, int)]):
         return jsonify({"error": "parameter is wrong type"}), 400
-    if not all([username, student, classId]):
-        return jsonify({"error", "missing parameter"}), 400
-    if not __checkRole(username, "admin"):
-        return jsonify({"error", "Permission Denied"}), 400
-    try:
-        conn, cursor = __createConnection()
-        #verify if the classId exists
-        classIdQuery = """
-            SELECT period, capacity
-            FROM Classes
-            WHERE id = ?
-        """
-        cursor.execute(classIdQuery, [classId])
-        period, capacity = cursor.fetchone()[0]
-        if not period:
-            return jsonify({"error", "class id doesn't exist"}), 400
-        if capacity <= 0:
-            return jsonify({"error": "no more space in class"}), 400
+    if not all([student or studentId, classId]):
+        return jsonify({"error": "missing parameter"}), 400
+    def enrollStudent(cursor):
         #check if the student exists
-        studentQuery = """
-            SELECT 1
-            FROM Users
-            WHERE full_name = ?
-        """
-        cursor.execute(studentQuery, [student])
-        if not cursor.fetchone():
-            return jsonify({"error", "Student doesn't exist"}), 400
-        #check if the students schedule fits it
-        missingPeriods = __getMissingPeriods()
-        if period not in missingPeriods:  #FIXME: get missing periods is probably broken
-            return jsonify({"error":"class doesn't fit schedule"}), 400
+        resolvedId, studentName, error = __resolveUser(cursor, studentId, student, "student")
+        if error:
+            return error
+        #take a seat and the period in one go
+        status, period = seats.enroll(cursor, classId, resolvedId, studentName)
+        if status != seats.ENROLLED:
+            return enrollErrors[status]
         #now lets insert the class into the students schedule
         insertClassQuery = """
-            INSERT INTO StudentSchedule (student, classId, period) VALUES (?, ?, ?)
+            INSERT INTO StudentSchedule (student, studentId, classId, period) VALUES (?, ?, ?, ?)
         """
-        cursor.execute(insertClassQuery, [student, classId, period])
-        #update the class capacity
-        capacityQuery = """
-            UPDATE Classes
-            SET capacity = capacity - 1
-            WHERE classId = ?
-        """
-        cursor.execute(capacityQuery, [classId])
-        conn.commit()
+        cursor.execute(insertClassQuery, [studentName, resolvedId, classId, period])
+        __enrollmentsChanged(cursor, [(classId, resolvedId)])
+        return None
+
+    try:
+        error = __write(enrollStudent)
+        if error:
+            return jsonify({"error": error}), 400
         return jsonify({"status": "class added successfully"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
-        if conn:
-            conn.rollback()  # Roll back the transaction if an error occurs
         logging.error(f"Server Error: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn and cursor:
-            __closeConnection(conn, cursor)
 
 #TODO: check
 @app.route("/deleteClass", methods=["DELETE"])
-def deleteClass():
+@requireRole("admin")
+def deleteClass(identity):
     data = request.json
-    username = data.get("username")
     classId = data.get("classId")
-    if not all([isinstance(username, str), isinstance(classId, int)]):
+    if not isinstance(classId, int):
         return jsonify({"error": "parameters are wrong types"})
-    if not all([username, classId]):
+    if not classId:
         return jsonify({"error": "missing parameter"}), 400
-    if not __checkRole(username, "admin"):
-        return jsonify({"error": "permission not granted"}), 400
-    
-    conn, cursor = None, None  # Initialize connection and cursor for safety
-    try:
+    def removeClass(cursor):
         # Check if the classId exists
-        conn, cursor = __createConnection()
         classIdQuery = """
-            SELECT 1
+            SELECT period
             FROM Classes
             WHERE id = ?
         """
         cursor.execute(classIdQuery, [classId])
         classIdResult = cursor.fetchone()
         if not classIdResult:
-            return jsonify({"error": "class does not exist"}), 400
-        
+            return "class does not exist"
+
+        # Free the period for everyone who was enrolled
+        releaseClassPeriod(cursor, classId, classIdResult[0])
+        # Their schedules, the teacher's and the catalog all change, and the
+        # class's requests drop out of the listings
+        dataVersions.touchAll()
+        eventBus.publishOnCommit(RESYNC, {"reason": "class deleted"})
         # Delete the class
         deleteQuery = """
             DELETE FROM Classes
             WHERE id = ?
         """
         cursor.execute(deleteQuery, [classId])
-        conn.commit()
+        journal.record(cursor, "Classes", journal.DELETE, classId=classId)
+        # and everything hanging off it: class ids get reused, and the next
+        # class with this id must not inherit a roster, requests or a teacher
+        for table in ("ClassStudents", "AddRequests", "DropRequests"):
+            cursor.execute(f"DELETE FROM {table} WHERE classId = ? RETURNING studentId", [classId])
+            journal.recordMany(cursor, table, journal.DELETE,
+                               [(classId, row[0], {"reason": "class deleted"}) for row in cursor.fetchall()])
+        cursor.execute("DELETE FROM StudentSchedule WHERE classId = ?", [classId])
+        cursor.execute("DELETE FROM TeacherSchedule WHERE classId = ?", [classId])
+        seatIndex.refresh(cursor, [classId])
+        waitlists.dropClass(cursor, classId)
+        return None
+
+    try:
+        error = __write(removeClass)
+        if error:
+            return jsonify({"error": error}), 400
         return jsonify({"message": "class deleted successfully"})
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
-        if conn:
-            conn.rollback()  # Roll back the transaction if an error occurs
         logging.error(f"Error during class deletion: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn and cursor:
-            __closeConnection(conn, cursor)
-        
+
 #TODO: check
 @app.route("/acceptClassDrop", methods=["POST"])
-def acceptClassDrop():
-    conn, cursor = None, None
+@requireRole("admin")
+def acceptClassDrop(identity):
     try:
         data = request.json
-        username = data.get("username")
         studentName = data.get("studentName")
+        studentId = data.get("studentId")  # needed when several students share the name
         classId = data.get("classId")
-        if not isinstance(username, str) or not isinstance(studentName, str) or not isinstance(classId, int):
+        if not (isinstance(studentName, str) or isinstance(studentId, int)) or not isinstance(classId, int):
             return jsonify({"error": "missing parameter"})
-        if not all([username, studentName, classId]):
+        if not all([studentName or studentId, classId]):
             return jsonify({"error": "Missing required fields"}), 400
 
-        if not __checkRole(username, "admin"):
-            return jsonify({"error": "Permission denied"}), 403
-
-        conn, cursor = __createConnection()
-        conn.execute("BEGIN TRANSACTION")
-
-        # Verify drop request exists
-        cursor.execute("""
-            SELECT 1 FROM DropRequests
-            WHERE classId = ? AND student = ?
-        """, [classId, studentName])
-        if not cursor.fetchone():
-            conn.rollback()
-            return jsonify({"error": "Drop request not found"}), 404
-
-        # Remove from ClassStudents
-        cursor.execute("""
-            DELETE FROM ClassStudents
-            WHERE classId = ? AND student = ?
-        """, [classId, studentName])
-
-        # Update capacity
-        cursor.execute("""
-            UPDATE Classes 
-            SET capacity = capacity + 1 
-            WHERE id = ?
-        """, [classId])
-
-        # Remove from DropRequests
-        cursor.execute("""
-            DELETE FROM DropRequests 
-            WHERE classId = ? AND student = ?
-        """, [classId, studentName])
-
-        conn.commit()
-        return jsonify({"message": "Drop request processed"}), 200
-
+        def drop(cursor):
+            resolvedId, resolvedName, error = __resolveUser(cursor, studentId, studentName, "student")
+            if error:
+                return error, 400, None
+
+            # Verify drop request exists
+            cursor.execute("""
+                SELECT 1 FROM DropRequests
+                WHERE classId = ? AND studentId = ?
+            """, [classId, resolvedId])
+            if not cursor.fetchone():
+                return "Drop request not found", 404, None
+
+            # Remove from ClassStudents, giving back the seat and the period,
+            # and hand the seat to whoever is first on the waitlist
+            changed = [(classId, resolvedId)]
+            promoted = None
+            if seats.unenroll(cursor, classId, resolvedId):
+                promoted = __fillFromWaitlist(cursor, classId)
+                if promoted is not None:
+                    changed.append((classId, promoted))
+
+            # Remove from DropRequests
+            cursor.execute("""
+                DELETE FROM DropRequests 
+                WHERE classId = ? AND studentId = ?
+            """, [classId, resolvedId])
+            __requestsRemoved(cursor, "drop", [(classId, resolvedId)], "accepted")
+            __enrollmentsChanged(cursor, changed)
+            return None, 200, promoted
+
+        error, status, promoted = __write(drop)
+        if error:
+            return jsonify({"error": error}), status
+        return jsonify({"message": "Drop request processed", "promoted": promoted}), 200
+
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Drop error: {e}")
-        conn.rollback() if conn else None
         return jsonify({"error": serverError}), 500
-    finally:
-        __closeConnection(conn, cursor)
 
 #TODO: check
 @app.route("/acceptAddClass", methods=["POST"])
-def acceptAddClass():
-    conn, cursor = None, None
+@requireRole("admin")
+def acceptAddClass(identity):
     try:
         data = request.json
-        username = data.get("username")
         studentName = data.get("student_name")
+        studentId = data.get("student_id")  # needed when several students share the name
         classId = data.get("class_id")
-
         if not all ([
-            isinstance(username, str),
-            isinstance(studentName, str),
+            isinstance(studentName, str) or isinstance(studentId, int),
             isinstance(classId, int)
         ]):
             return jsonify({"error": "parameter is not the proper type"}), 400
 
-        if not all([username, studentName, classId]):
+        if not all([studentName or studentId, classId]):
             return jsonify({"error": "Missing required fields"}), 400
 
-        if not __checkRole(username, "admin"):
-            return jsonify({"error": "Permission denied"}), 403
+        def accept(cursor):
+            resolvedId, resolvedName, error = __resolveUser(cursor, studentId, studentName, "student")
+            if error:
+                return error
+
+            # Take a seat and the period, and add to ClassStudents
+            status, period = seats.enroll(cursor, classId, resolvedId, resolvedName)
+            if status != seats.ENROLLED:
+                return enrollErrors[status]
+
+            # Remove from AddRequests
+            cursor.execute("""
+                DELETE FROM AddRequests 
+                WHERE classId = ? AND studentId = ?
+            """, [classId, resolvedId])
+            if cursor.rowcount:
+                __requestsRemoved(cursor, "add", [(classId, resolvedId)], "accepted")
+            __enrollmentsChanged(cursor, [(classId, resolvedId)])
+            return None
 
-        conn, cursor = __createConnection()
-        conn.execute("BEGIN TRANSACTION")
+        error = __write(accept)
+        if error:
+            return jsonify({"error": error}), 400
+        return jsonify({"message": "Add request processed"}), 200
 
-        # Check capacity
-        cursor.execute("SELECT capacity FROM Classes WHERE id = ?", [classId])
-        capacity = cursor.fetchone()
-        if not capacity or capacity[0] < 1:
-            conn.rollback()
-            return jsonify({"error": "Class is full"}), 400
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Add error: {e}")
+        return jsonify({"error": serverError}), 500
 
-        # Add to ClassStudents
-        cursor.execute("""
-            INSERT INTO ClassStudents (classId, student)
-            VALUES (?, ?)
-        """, [classId, studentName])
+# Approve many add requests in one transaction, with a result per request
+@app.route("/acceptAddClassBatch", methods=["POST"])
+@requireRole("admin")
+def acceptAddClassBatch(identity):
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify({"error": "parameter is not the proper type"}), 400
 
-        # Update capacity
-        cursor.execute("""
-            UPDATE Classes 
-            SET capacity = capacity - 1 
-            WHERE id = ?
-        """, [classId])
+        # The whole batch is one write, so it commits or fails as a unit
+        def acceptAll(cursor):
+            rows, missing, remaining, error = __pendingBatch(cursor, "AddRequests", data)
+            if error:
+                return None, error
+
+            results = [{"classId": c, "studentId": s, "status": "no pending request"} for c, s in missing]
+            accepted = []
+            # A request that can't be enrolled only skips that student
+            for (classId, studentId, student), (status, period) in zip(rows, seats.enrollMany(cursor, rows)):
+                results.append({"classId": classId, "studentId": studentId, "status": status})
+                if status == seats.ENROLLED:
+                    accepted.append((classId, studentId))
+
+            cursor.executemany("""
+                DELETE FROM AddRequests
+                WHERE classId = ? AND studentId = ?
+            """, accepted)
+            __requestsRemoved(cursor, "add", accepted, "accepted")
+            __enrollmentsChanged(cursor, accepted)
+            return {
+                "accepted": len(accepted),
+                "failed": len(results) - len(accepted),
+                "remaining": remaining,
+                "results": results
+            }, None
+
+        result, error = __write(acceptAll)
+        if error:
+            return jsonify({"error": error}), 400
+        return jsonify(result), 200
+
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Batch add error: {e}")
+        return jsonify({"error": serverError}), 500
 
-        # Remove from AddRequests
-        cursor.execute("""
-            DELETE FROM AddRequests 
-            WHERE classId = ? AND student = ?
-        """, [classId, studentName])
+# Approve many drop requests in one transaction, with a result per request
+@app.route("/acceptClassDropBatch", methods=["POST"])
+@requireRole("admin")
+def acceptClassDropBatch(identity):
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify({"error": "parameter is not the proper type"}), 400
 
-        conn.commit()
-        return jsonify({"message": "Add request processed"}), 200
+        def dropAll(cursor):
+            rows, missing, remaining, error = __pendingBatch(cursor, "DropRequests", data)
+            if error:
+                return None, error
+
+            results = [{"classId": c, "studentId": s, "status": "no pending request"} for c, s in missing]
+            processed = [(classId, studentId) for classId, studentId, student in rows]
+            droppedPairs = seats.unenrollMany(cursor, processed)
+            # Only classes with someone waiting need a promotion per freed seat
+            cursor.execute("""
+                SELECT DISTINCT classId FROM Waitlist
+                WHERE classId IN (SELECT value FROM json_each(?))
+            """, [json.dumps(list({classId for classId, studentId in droppedPairs}))])
+            waiting = {row[0] for row in cursor.fetchall()}
+            changed = []
+            for classId, studentId in processed:
+                dropped = (classId, studentId) in droppedPairs
+                result = {"classId": classId, "studentId": studentId, "status": "dropped" if dropped else "not enrolled"}
+                if dropped:
+                    result["promoted"] = __fillFromWaitlist(cursor, classId) if classId in waiting else None
+                    if result["promoted"] is not None:
+                        changed.append((classId, result["promoted"]))
+                results.append(result)
+
+            # Same as /acceptClassDrop, the request is cleared either way
+            cursor.executemany("""
+                DELETE FROM DropRequests
+                WHERE classId = ? AND studentId = ?
+            """, processed)
+            __requestsRemoved(cursor, "drop", processed, "accepted")
+            __enrollmentsChanged(cursor, processed + changed)
+            dropped = sum(1 for result in results if result["status"] == "dropped")
+            return {
+                "dropped": dropped,
+                "failed": len(results) - dropped,
+                "remaining": remaining,
+                "results": results
+            }, None
+
+        result, error = __write(dropAll)
+        if error:
+            return jsonify({"error": error}), 400
+        return jsonify(result), 200
+
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Batch drop error: {e}")
+        return jsonify({"error": serverError}), 500
 
+# Decide every pending add request in one pass and enroll the winners in one write.
+# dryRun decides on a read-only connection and writes nothing
+@app.route("/allocateAddRequests", methods=["POST"])
+@requireRole("admin")
+def allocateAddRequests(identity):
+    conn, cursor = None, None
+    try:
+        data = request.json or {}
+        policy = data.get("policy", allocation.FIFO)
+        seed = data.get("seed")
+        dryRun = data.get("dryRun", False)
+        if policy not in allocation.POLICIES or not (seed is None or isinstance(seed, int)) or not isinstance(dryRun, bool):
+            return jsonify({"error": "policy must be fifo or lottery, seed an int and dryRun a bool"}), 400
+
+        started = time.perf_counter()
+        if dryRun:
+            conn, cursor = __createConnection(readOnly=True)
+            cursor.execute("BEGIN")  # one snapshot for all the reads
+            result = allocation.plan(cursor, policy, seed)
+        else:
+            def allocateAll(cursor):
+                result = allocation.apply(cursor, allocation.plan(cursor, policy, seed))
+                __enrollmentsChanged(cursor, [(classId, studentId) for requestId, classId, studentId, student in result.enrolled])
+                if result.enrolled:
+                    # possibly far more removals than the replay buffer holds
+                    eventBus.publishOnCommit(RESYNC, {"reason": "allocation"})
+                return result
+
+            result = __write(allocateAll)
+        report = result.asDict(dryRun)
+        report["timing"]["totalSeconds"] = round(time.perf_counter() - started, 4)
+        return jsonify(report), 200
+
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
-        logging.error(f"Add error: {e}")
-        conn.rollback() if conn else None
+        logging.error(f"Allocation error: {e}")
         return jsonify({"error": serverError}), 500
     finally:
         __closeConnection(conn, cursor)
@@ -419,24 +889,22 @@ def acceptAddClass():
 #todo decline add
 #TODO: check
 @app.route("/declineAdd", methods=["DELETE"])
-def declineAdd():
+@requireRole("admin")
+def declineAdd(identity):
     data = request.json
-    username = data.get("username")
-    if not username or not __checkRole(username, "admin"):
-        return jsonify({"error": "permission not granted"})
     addId = data.get("addId")
     classId = data.get("classId")
     student = data.get("student") #full name
+    studentId = data.get("studentId")
     if not all([
         isinstance(addId, int),
         isinstance(classId, int),
-        isinstance(student, str)
+        isinstance(student, str) or isinstance(studentId, int)
     ]):
         return jsonify({"error": "parameter not proper type"}), 400
-    if not all([addId, classId, student]):
+    if not all([addId, classId, student or studentId]):
         return jsonify({"error": "missing parameter"}), 400
-    try:
-        conn, cursor = __createConnection()
+    def removeRequest(cursor):
         checkAddId = """
             SELECT 1
             FROM AddRequests
@@ -444,16 +912,11 @@ def declineAdd():
         """
         cursor.execute(checkAddId, [addId])
         if not cursor.fetchone():
-            return jsonify({"error": "drop id is not valid"}), 400
+            return "drop id is not valid"
         #lets verify the student exists now
-        studentQuery = """
-            SELECT 1
-            FROM Users
-            WHERE full_name = ?
-        """
-        cursor.execute(studentQuery, [student])
-        if not cursor.fetchone():
-            return jsonify({"error": "student doesn't exist"}), 400
+        resolvedId, resolvedName, error = __resolveUser(cursor, studentId, student)
+        if error:
+            return error
         #now lets verify that the classId exists
         classIdQuery = """
             SELECT 1
@@ -462,44 +925,49 @@ def declineAdd():
         """
         cursor.execute(classIdQuery, [classId])
         if not cursor.fetchone():
-            return jsonify({"error": "class does not exist"}), 400
+            return "class does not exist"
         #Delete the student from the AddRequests and thats all
         declineQuery = """
             DELETE FROM AddRequests
             WHERE id = ?
+            RETURNING classId, studentId
         """
         cursor.execute(declineQuery, [addId])
-        conn.commit()
+        declined = cursor.fetchone()
+        dataVersions.touch(("student", declined[1]))
+        __requestsRemoved(cursor, "add", [declined], "declined")
+        return None
+
+    try:
+        error = __write(removeRequest)
+        if error:
+            return jsonify({"error": error}), 400
         return jsonify({"message": "request removed"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Add error: {e}")
-        conn.rollback() if conn else None
         return jsonify({"error": serverError}), 500
-    finally:
-        __closeConnection(conn, cursor)
 
 #todo decline drop
 #TODO: check
 @app.route("/declineDrop", methods=["POST"])
-def declineDrop():
+@requireRole("admin")
+def declineDrop(identity):
     data = request.json
-    username = data.get("username")
     dropId = data.get("dropId")
     classId = data.get("classId")
     student = data.get("student") #full name
+    studentId = data.get("studentId")
     if not all([
-        isinstance(username, str),
         isinstance(dropId, int),
         isinstance(classId, int),
-        isinstance(student, str)
+        isinstance(student, str) or isinstance(studentId, int)
     ]):
         return jsonify({"error": "parameter is wrong type"}), 400
-    if not username or not __checkRole(username, "admin"):
-        return jsonify({"error": "permission not granted"})
-    if not all([dropId, classId, student]):
+    if not all([dropId, classId, student or studentId]):
         return jsonify({"error": "missing parameter"}), 400
-    try:
-        conn, cursor = __createConnection()
+    def removeRequest(cursor):
         checkDropId = """
             SELECT 1
             FROM DropRequests
@@ -507,16 +975,11 @@ def declineDrop():
         """
         cursor.execute(checkDropId, [dropId])
         if not cursor.fetchone():
-            return jsonify({"error": "drop id is not valid"}), 400
+            return "drop id is not valid"
         #lets verify the student exists now
-        studentQuery = """
-            SELECT 1
-            FROM Users
-            WHERE full_name = ?
-        """
-        cursor.execute(studentQuery, [student])
-        if not cursor.fetchone():
-            return jsonify({"error": "student doesn't exist"}), 400
+        resolvedId, resolvedName, error = __resolveUser(cursor, studentId, student)
+        if error:
+            return error
         #now lets verify that the classId exists
         classIdQuery = """
             SELECT 1
@@ -525,164 +988,378 @@ def declineDrop():
         """
         cursor.execute(classIdQuery, [classId])
         if not cursor.fetchone():
-            return jsonify({"error": "class does not exist"}), 400
+            return "class does not exist"
         #Delete the student from the AddRequests and thats all
         declineQuery = """
             DELETE FROM DropRequests
             WHERE id = ?
+            RETURNING classId, studentId
         """
         cursor.execute(declineQuery, [dropId])
-        conn.commit()
+        declined = cursor.fetchone()
+        dataVersions.touch(("student", declined[1]))
+        __requestsRemoved(cursor, "drop", [declined], "declined")
+        return None
+
+    try:
+        error = __write(removeRequest)
+        if error:
+            return jsonify({"error": error}), 400
         return jsonify({"message": "request removed"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Add error: {e}")
-        conn.rollback() if conn else None
         return jsonify({"error": serverError}), 500
-    finally:
-        __closeConnection(conn, cursor)
 
 # Create new user (for admin)
 #TODO: check
 @app.route("/createUser", methods=["POST"])
-def create_user():
-    conn, cursor = None, None
+@requireRole("admin")
+def create_user(identity):
     try:
         data = request.json
-        adminUsername = data.get("username")
         newUsername = data.get("newUsername")
         userFullName = data.get("full_name")
         newPassword = data.get("newPassword")
         role = data.get("role")
-        if not all([adminUsername, newUsername, userFullName, newPassword, role]):
+        if not all([newUsername, userFullName, newPassword, role]):
             return jsonify({"error": "parameter is wrong type"}), 400
-        if not __checkRole(adminUsername, "admin"):
-            return jsonify({"error": "Permission not granted"}), 400
 
         # Validate the role
         if role not in ["admin", "student", "teacher"]:
             return jsonify({"error": "Invalid role"}), 400
 
-        # Connect to the database
+        # Hash before queueing, the writer must never wait on PBKDF2
         salt = __generateSalt()
         hashedPassword = __hashPassword(newPassword, salt)
-        conn, cursor = __createConnection()
-        newUserQuery = "INSERT INTO Users (username, full_name, salt, hash, role) VALUES (?, ?, ?, ?, ?)"
-        cursor.execute(newUserQuery, [newUsername, userFullName , salt, hashedPassword, role])
-        conn.commit()
-        return jsonify({"message": "User created successfully"}), 200
 
+        def insertUser(cursor):
+            newUserQuery = "INSERT INTO Users (username, full_name, salt, hash, role) VALUES (?, ?, ?, ?, ?)"
+            cursor.execute(newUserQuery, [newUsername, userFullName , salt, hashedPassword, role])
+            # id is assigned by the trg_users_assign_id trigger
+            cursor.execute("SELECT id FROM Users WHERE username = ?", [newUsername])
+            userId = cursor.fetchone()[0]
+            journal.record(cursor, "Users", journal.INSERT, userId=userId, data={"role": role})
+            return userId
+
+        userId = __write(insertUser)
+        identityCache.invalidate(newUsername)
+        return jsonify({"message": "User created successfully", "userId": userId}), 200
+
+    except (HashPoolBusy, WriteQueueFull):
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Error during user creation: {e}")
         return jsonify({"error": serverError}), 500
 
-    finally:
-        __closeConnection(conn, cursor)
+# Create users in bulk from an uploaded CSV or JSONL file (multipart "file" or the raw body)
+@app.route("/importUsers", methods=["POST"])
+@requireRole("admin")
+def import_users(identity):
+    try:
+        upload = request.files.get("file")
+        if upload:
+            stream, format = upload.stream, userimport.formatFor(upload.filename, upload.mimetype)
+        else:
+            stream, format = request.stream, userimport.formatFor(None, request.mimetype)
+        format = request.args.get("format", format)
+        rows = userimport.parseRows(userimport.textLines(stream), format)
+
+        report = userimport.importUsers(__write, rows, hashExecutor, onCreated=identityCache.invalidate)
+        return jsonify(report.asDict()), 200
+
+    except userimport.ImportFormatError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnicodeDecodeError:
+        return jsonify({"error": "file is not valid utf-8"}), 400
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Error during user import: {e}")
+        return jsonify({"error": serverError}), 500
 
 #TODO: check
 @app.route("/deleteuser", methods=["DELETE"])
-def delete():
-    conn, cursor = None, None
+@requireRole("admin")
+def delete(identity):
     try:
-        conn, cursor = __createConnection()
         data = request.json
-        adminUsername = data.get("adminUsername")
         username = data.get("username")
-        if not all([adminUsername, username]):
+        if not username:
             return jsonify({"error": "parameter missing"}), 400
-        if not __checkRole(adminUsername, "admin"):
-            return jsonify({"error": "permission not granted"}), 400
-        query = "DELETE FROM Users WHERE username = ?"
-        cursor.execute(query, [username])
-        conn.commit()
+        def removeUser(cursor):
+            cursor.execute("DELETE FROM Users WHERE username = ? RETURNING id", [username])
+            row = cursor.fetchone()
+            if row:
+                journal.record(cursor, "Users", journal.DELETE, userId=row[0])
+                waitlists.removeStudent(cursor, row[0])
+                # Rosters show names, and we don't know which classes had this user
+                dataVersions.touchAll()
+                eventBus.publishOnCommit(RESYNC, {"reason": "user deleted"})
+
+        __write(removeUser)
+        identityCache.invalidate(username)
+        tokenSigner.revoke(username)
         return jsonify({"message": "User deleted successfully"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Error during user deletion: {e}")
         return jsonify({"error": serverError}), 500
-    finally:
-        __closeConnection(conn, cursor)
 
 #TODO: check
 @app.route("/getDropClassRequest", methods=["GET"])
-def get_drop_class_request():
+@requireRole("admin")
+def get_drop_class_request(identity):
+    return __listRequests("DropRequests", "dropRequests", "drop class requests")
+
+#TODO: check
+@app.route("/getAddClassRequest", methods=["GET"])
+@requireRole("admin")
+def get_add_class_request(identity):
+    return __listRequests("AddRequests", "addRequests", "add class requests")
+
+# Pending add/drop requests oldest first, a page at a time: ?after_id=<last id seen>&limit=
+# with optional ?classId= and ?period= filters. ?stream=1 writes the rows out as
+# they are read instead of building the response in memory, and has no default limit
+def __listRequests(table, key, what):
     conn, cursor = None, None
     try:
-        adminUsername = request.args.get("adminUsername")
-        if not adminUsername:
-            return jsonify({"error": "Admin must be signed in"}), 400
-        if not __checkRole(adminUsername, "admin"):
-            return jsonify({"error": "User is not an admin"}), 401
+        afterId = request.args.get("after_id", 0, type=int)
+        stream = request.args.get("stream") in ("1", "true")
+        limit = request.args.get("limit", None if stream else DEFAULT_PAGE_SIZE, type=int)
+        classId = request.args.get("classId", type=int)
+        period = request.args.get("period", type=int)
+        if limit is not None and (limit < 1 or (not stream and limit > MAX_PAGE_SIZE)):
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+        conditions, params = ["r.id > ?"], [afterId]
+        if classId is not None:
+            conditions.append("r.classId = ?")
+            params.append(classId)
+        if period is not None:
+            conditions.append("c.period = ?")
+            params.append(period)
+        query = REQUEST_ROW_QUERY.format(table=table) + f"""
+            WHERE {" AND ".join(conditions)}
+            ORDER BY r.id
+        """
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
 
         conn, cursor = __createConnection()
+        cursor.execute(query, params)
+        if stream:
+            # The generator owns the connection from here and gives it back when done
+            body = __streamRequests(conn, cursor, key, what, limit)
+            conn, cursor = None, None
+            return app.response_class(body, mimetype="application/json")
+
+        data = [__requestRow(row) for row in cursor.fetchall()]
+        # A short page means there is nothing after it
+        nextAfterId = data[-1]["id"] if len(data) == limit else None
+        return jsonify({key: data, "nextAfterId": nextAfterId}), 200
+    except Exception as e:
+        logging.error(f"Error fetching {what}: {e}")
+        return jsonify({"error": serverError}), 500
+    finally:
+        __closeConnection(conn, cursor)
 
-        # Get all drop-class requests
-        query = """
-        SELECT c.id, c.className, c.classDescription, c.capacity, c.teacher, c.period, d.student 
-        FROM DropClasses d
-        JOIN Classes c ON d.classId = c.id
-        """
-        cursor.execute(query)
-        classData = cursor.fetchall()
+# Rows for __requestRow, add WHERE (and ORDER BY) to taste
+REQUEST_ROW_QUERY = """
+            SELECT r.id, c.id, c.className, c.classDescription, c.capacity, c.teacher, c.period, u.full_name, r.studentId
+            FROM {table} r
+            JOIN Classes c ON r.classId = c.id
+            JOIN Users u ON u.id = r.studentId"""
+
+def __requestRow(row):
+    return {
+        "id": row[0],
+        "classId": row[1],
+        "className": row[2],
+        "classDescription": row[3],
+        "capacity": row[4],
+        "teacher": row[5],
+        "period": row[6],
+        "student": row[7],
+        "studentId": row[8]
+    }
+
+def __streamRequests(conn, cursor, key, what, limit):
+    try:
+        yield f'{{"{key}": ['
+        lastId, count = None, 0
+        while True:
+            rows = cursor.fetchmany(STREAM_CHUNK)
+            if not rows:
+                break
+            chunk = ",".join(json.dumps(__requestRow(row)) for row in rows)
+            yield chunk if lastId is None else "," + chunk
+            lastId, count = rows[-1][0], count + len(rows)
+        nextAfterId = lastId if limit is not None and count == limit else None
+        yield f'], "nextAfterId": {json.dumps(nextAfterId)}}}'
+    except Exception as e:
+        # Too late for an error status, the client sees truncated json
+        logging.error(f"Error streaming {what}: {e}")
+        raise
+    finally:
+        __closeConnection(conn, cursor)
 
-        # Format the data
-        data = [
-            {
-                "classId": row[0],
-                "className": row[1],
-                "classDescription": row[2],
-                "capacity": row[3],
-                "teacher": row[4],
-                "period": row[5],
-                "student": row[6]
-            }
-            for row in classData
-        ]
+# Server-sent events for changes to the add/drop request queues, so the admin
+# listings can be kept current without polling. Resume with Last-Event-ID or ?after=
+@app.route("/adminEvents", methods=["GET"])
+@requireRole("admin")
+def adminEvents(identity):
+    if not eventBus.subscribe():
+        return jsonify({"error": busyError}), 503
+    after = request.headers.get("Last-Event-ID") or request.args.get("after")
+    response = app.response_class(__streamEvents(identity, after), mimetype="text/event-stream",
+                                  headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(eventBus.unsubscribe)
+    return response
+
+def __streamEvents(identity, after):
+    yield f"retry: {EVENT_KEEPALIVE * 1000}\n\n"
+    cursor = after
+    if cursor is None:
+        cursor = eventBus.cursor()
+        yield f"id: {cursor}\nevent: hello\ndata: {{}}\n\n"
+    # The session is checked once, at connect; end the stream when it would have lapsed
+    while time.time() * 1000 < identity.expires and not tokenSigner.revocations.isRevoked(identity.username, identity.issued):
+        events = eventBus.since(cursor, timeout=EVENT_KEEPALIVE)
+        if events is None:
+            # Too old, or from before a restart: the client must reload the listings
+            cursor = eventBus.cursor()
+            yield f"id: {cursor}\nevent: {RESYNC}\ndata: {{}}\n\n"
+        elif not events:
+            yield ": keepalive\n\n"
+        for cursor, type, data in events or ():
+            yield f"id: {cursor}\nevent: {type}\ndata: {data}\n\n"
+
+# Committed changes to enrollments, seats, requests and users in journal order, for
+# downstream systems to sync from. Page with ?since=<seq of the last change applied>
+@app.route("/changes", methods=["GET"])
+@requireRole("admin")
+def changes(identity):
+    conn, cursor = None, None
+    try:
+        since = request.args.get("since", 0, type=int)
+        limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+        if since < 0 or limit < 1 or limit > MAX_PAGE_SIZE:
+            return jsonify({"error": f"since must be 0 or more and limit between 1 and {MAX_PAGE_SIZE}"}), 400
 
-        return jsonify({"dropRequests": data}), 200
+        conn, cursor = __createConnection()
+        entries, latestSeq = journal.page(cursor, since, limit)
+        nextSince = entries[-1]["seq"] if entries else since
+        return jsonify({"changes": entries, "nextSince": nextSince, "latestSeq": latestSeq}), 200
+    except journal.ChangesCompacted as e:
+        return jsonify({"error": str(e), "latestSeq": e.latestSeq}), 410
     except Exception as e:
-        logging.error(f"Error fetching drop class requests: {e}")
+        logging.error(f"Error fetching changes: {e}")
         return jsonify({"error": serverError}), 500
     finally:
         __closeConnection(conn, cursor)
 
-#TODO: check
-@app.route("/getAddClassRequest", methods=["GET"])
-def get_add_class_request():
-    conn, cursor = None, None
+# A consumer has applied every change up to seq. Changes all consumers have acked are compacted
+@app.route("/ackChanges", methods=["POST"])
+@requireRole("admin")
+def ackChanges(identity):
     try:
-        adminUsername = request.args.get("adminUsername")
-        if not adminUsername:
-            return jsonify({"error": "Admin must be signed in"}), 400
-        if not __checkRole(adminUsername, "admin"):
-            return jsonify({"error": "User is not an admin"}), 401
+        data = request.json
+        consumer = data.get("consumer")
+        seq = data.get("seq")
+        if not isinstance(consumer, str) or not consumer or not isinstance(seq, int) or seq < 0:
+            return jsonify({"error": "consumer must be a string and seq an int"}), 400
+
+        def ack(cursor):
+            if seq > journal.latestSeq(cursor):
+                return None, None
+            return journal.ack(cursor, consumer, seq)
+
+        ackedSeq, compacted = __write(ack)
+        if ackedSeq is None:
+            return jsonify({"error": "seq is past the latest change"}), 400
+        return jsonify({"consumer": consumer, "ackedSeq": ackedSeq, "compacted": compacted}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Error acking changes: {e}")
+        return jsonify({"error": serverError}), 500
 
-        conn, cursor = __createConnection()
+# Forget a consumer that won't sync again, so it stops holding back compaction
+@app.route("/deleteChangeConsumer", methods=["DELETE"])
+@requireRole("admin")
+def deleteChangeConsumer(identity):
+    try:
+        data = request.json
+        consumer = data.get("consumer")
+        if not isinstance(consumer, str) or not consumer:
+            return jsonify({"error": "consumer must be a string"}), 400
+
+        removed, compacted = __write(lambda cursor: journal.removeConsumer(cursor, consumer))
+        if not removed:
+            return jsonify({"error": "consumer not found"}), 404
+        return jsonify({"message": "consumer removed", "compacted": compacted}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Error removing change consumer: {e}")
+        return jsonify({"error": serverError}), 500
 
-        # Get all add-class requests
-        query = """
-        SELECT c.id, c.className, c.classDescription, c.capacity, c.teacher, c.period, a.student 
-        FROM addClasses a
-        JOIN Classes c ON a.classId = c.id
-        """
-        cursor.execute(query)
-        classData = cursor.fetchall()
+# Start an online backup. It runs in the background; poll /backups for its report
+@app.route("/backupDatabase", methods=["POST"])
+@requireRole("admin")
+def backupDatabase(identity):
+    try:
+        data = request.get_json(silent=True) or {}
+        verify = data.get("verify", False)
+        if not isinstance(verify, bool):
+            return jsonify({"error": "verify must be a bool"}), 400
+        if not backupRunner.start(verify):
+            return jsonify({"error": "a backup is already running"}), 409
+        return jsonify({"message": "backup started"}), 202
+    except Exception as e:
+        logging.error(f"Error starting backup: {e}")
+        return jsonify({"error": serverError}), 500
 
-        # Format the data
-        data = [
-            {
-                "classId": row[0],
-                "className": row[1],
-                "classDescription": row[2],
-                "capacity": row[3],
-                "teacher": row[4],
-                "period": row[5],
-                "student": row[6]
-            }
-            for row in classData
-        ]
+# Finished backups with their reports, and the one in progress if any
+@app.route("/backups", methods=["GET"])
+@requireRole("admin")
+def backups(identity):
+    try:
+        return jsonify({"backups": backup.listBackups(BACKUP_DIR), "status": backupRunner.status()}), 200
+    except Exception as e:
+        logging.error(f"Error listing backups: {e}")
+        return jsonify({"error": serverError}), 500
 
-        return jsonify({"addRequests": data}), 200
+# Students with no class in the given period(s), e.g. ?period=3&period=4
+@app.route("/studentsFreeInPeriod", methods=["GET"])
+@requireRole("admin")
+def students_free_in_period(identity):
+    conn, cursor = None, None
+    try:
+        periods = request.args.getlist("period", type=int)
+        afterId = request.args.get("after_id", 0, type=int)
+        limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+        if not periods:
+            return jsonify({"error": "Missing period"}), 400
+        if any(p < 1 or p > MAX_PERIODS for p in periods):
+            return jsonify({"error": f"period must be between 1 and {MAX_PERIODS}"}), 400
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+        conn, cursor = __createConnection()
+        rows = studentsFreeIn(cursor, periods, afterId, limit)
+        # A short page means there is nothing after it
+        nextAfterId = rows[-1][0] if len(rows) == limit else None
+        return jsonify({
+            "students": [{"studentId": row[0], "username": row[1], "student": row[2]} for row in rows],
+            "nextAfterId": nextAfterId
+        }), 200
     except Exception as e:
-        logging.error(f"Error fetching add class requests: {e}")
+        logging.error(f"Error fetching free students: {e}")
         return jsonify({"error": serverError}), 500
     finally:
         __closeConnection(conn, cursor)
@@ -691,29 +1368,21 @@ def get_add_class_request():
 
 #TODO: check
 @app.route("/getAllClassesTeacher", methods=["GET"])
-def get_all_classes_teacher():
+@requireRole("teacher")
+@conditionalGet(lambda identity: [("teacher", identity.userId)])
+def get_all_classes_teacher(identity):
     conn, cursor = None, None
     try:
         conn, cursor = __createConnection()
 
-        # Check if they are logged in
-        data = request.args
-        currentUser = data.get("username")
-        if not currentUser:
-            return jsonify({"error": "User is not logged in"}), 400
-
-        # Verify if the user is a teacher
-        if not __checkRole(currentUser, "teacher"):
-            return jsonify({"error": "You are not a teacher"}), 403
-
         # Fetch classes assigned to the teacher
         query = """
         SELECT Classes.className, Classes.period 
         FROM TeacherSchedule
         JOIN Classes ON TeacherSchedule.classId = Classes.id
-        WHERE TeacherSchedule.teacher = ?
+        WHERE TeacherSchedule.teacherId = ?
         """
-        cursor.execute(query, [currentUser])
+        cursor.execute(query, [identity.userId])
         cursorData = cursor.fetchall()
 
         # Format the data
@@ -729,32 +1398,31 @@ def get_all_classes_teacher():
 #must pass in username (has to be stored) and id (get when they click on the title)
 #TODO: check
 @app.route("/getStudentsInClass", methods=["GET"])
-def get_students_in_class():
+@requireRole("teacher")
+@conditionalGet(lambda identity: [("class", __intArg("id")), ("teacher", identity.userId)])
+def get_students_in_class(identity):
     conn, cursor = None, None
     try:
-        currentUser = request.args.get("username")
         classId = request.args.get("id")
         
-        if not all([currentUser, classId]):
+        if not classId:
             return jsonify({"error": "Missing parameters"}), 400
 
-        if not __checkRole(currentUser, "teacher"):
-            return jsonify({"error": "Permission denied"}), 403
-
         conn, cursor = __createConnection()
 
         # Verify teacher assignment
         cursor.execute("""
             SELECT 1 FROM TeacherSchedule 
-            WHERE teacher = ? AND classId = ?
-        """, [currentUser, classId])
+            WHERE teacherId = ? AND classId = ?
+        """, [identity.userId, classId])
         if not cursor.fetchone():
             return jsonify({"error": "Not assigned to class"}), 403
 
         # Get students
         cursor.execute("""
-            SELECT student FROM ClassStudents 
-            WHERE classId = ?
+            SELECT u.full_name FROM ClassStudents cs
+            JOIN Users u ON u.id = cs.studentId
+            WHERE cs.classId = ?
         """, [classId])
         
         return jsonify({
@@ -767,20 +1435,94 @@ def get_students_in_class():
     finally:
         __closeConnection(conn, cursor)
 
+ROSTER_COLUMNS = ("classId", "className", "period", "teacherId", "teacher", "studentId", "username", "student")
+
+# Rosters for every class a teacher has, or (admins) for the whole school or one teacher,
+# streamed straight off the cursor as csv or jsonl, gzipped with ?gzip=1
+@app.route("/exportRosters", methods=["GET"])
+@requireRole("teacher", "admin")
+def exportRosters(identity):
+    conn, cursor = None, None
+    try:
+        format = request.args.get("format", "csv")
+        compress = request.args.get("gzip") in ("1", "true")
+        if format not in export.FORMATS:
+            return jsonify({"error": "format must be csv or jsonl"}), 400
+        teacherId = identity.userId if identity.role == "teacher" else request.args.get("teacherId", type=int)
+        classId = request.args.get("classId", type=int)
+
+        conditions, params = [], []
+        # Class by class, students in id order within each. Both orders come off
+        # indexes, so at most one class is sorted before its rows go out. A
+        # teacher's export is driven from their TeacherSchedule rows; the whole
+        # school's from ClassStudents, so a class with no TeacherSchedule row
+        # still comes out, with the teacher recorded on the class
+        if teacherId is not None:
+            source = """
+            FROM TeacherSchedule ts
+            JOIN Classes c ON c.id = ts.classId
+            JOIN ClassStudents cs ON cs.classId = c.id"""
+            conditions.append("ts.teacherId = ?")
+            params.append(teacherId)
+            classColumn = "ts.classId"
+        else:
+            source = """
+            FROM ClassStudents cs
+            JOIN Classes c ON c.id = cs.classId
+            LEFT JOIN TeacherSchedule ts ON ts.classId = c.id"""
+            classColumn = "cs.classId"
+        if classId is not None:
+            conditions.append(f"{classColumn} = ?")
+            params.append(classId)
+        query = f"""
+            SELECT c.id, c.className, c.period, COALESCE(ts.teacherId, c.teacherId), COALESCE(ts.teacher, c.teacher),
+                   cs.studentId, u.username, COALESCE(u.full_name, cs.student)
+            {source}
+            LEFT JOIN Users u ON u.id = cs.studentId
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            ORDER BY {classColumn}, cs.studentId
+        """
+        conn, cursor = __createConnection()
+        cursor.execute(query, params)
+
+        # The generator owns the connection from here and gives it back when done
+        body = __streamRoster(conn, cursor, format, compress)
+        conn, cursor = None, None
+        filename = f"rosters.{format}" + (".gz" if compress else "")
+        return app.response_class(
+            body,
+            mimetype="application/gzip" if compress else export.MIMETYPES[format],
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+    except Exception as e:
+        logging.error(f"Error exporting rosters: {e}")
+        return jsonify({"error": serverError}), 500
+    finally:
+        __closeConnection(conn, cursor)
+
+def __streamRoster(conn, cursor, format, compress):
+    try:
+        chunks = export.encodeRows(export.fetchChunks(cursor, STREAM_CHUNK), ROSTER_COLUMNS, format)
+        yield from export.gzipChunks(chunks) if compress else chunks
+    except Exception as e:
+        # Too late for an error status, the client sees a truncated file
+        logging.error(f"Error streaming rosters: {e}")
+        raise
+    finally:
+        __closeConnection(conn, cursor)
+
 #todo: Student end points
 
 #can also be used to get all classes to drop
 #TODO: check
 @app.route("/getStudentClassInfo", methods=["GET"])
-def studentClassInfo():
+@requireRole("student")
+@conditionalGet(lambda identity: [("class", __intArg("classId"))])
+def studentClassInfo(identity):
     data = request.args
-    username = data.get("username")
     classId = data.get("classId")
-    if not all([username, classId]):
-        return jsonify({"error", "missing parameter"}), 400
-    # Check if logged in and correct role
-    if not __checkRole(username, "student"):
-        return jsonify({"error": "Permission not granted"}), 403
+    if not classId:
+        return jsonify({"error": "missing parameter"}), 400
     
     conn, cursor = None, None
     try:
@@ -816,155 +1558,171 @@ def studentClassInfo():
 
 #TODO: check
 @app.route("/sendDropRequest", methods=["POST"])
-def sendDropRequest():
-    conn, cursor = None, None
+@requireRole("student")
+def sendDropRequest(identity):
     try:
         data = request.json
-        username = data.get("username")
         classId = data.get("classId")
 
-        if not all([username, classId]):
+        if not classId:
             return jsonify({"error": "Missing required fields"}), 400
 
-        if not __checkRole(username, "student"):
-            return jsonify({"error": "Permission denied"}), 403
-
-        conn, cursor = __createConnection()
-
-        # Get full name
-        cursor.execute("SELECT full_name FROM Users WHERE username = ?", [username])
-        if not (full_name := cursor.fetchone()):
-            return jsonify({"error": "User not found"}), 404
-
-        # Check existing request
-        cursor.execute("""
-            SELECT 1 FROM DropRequests 
-            WHERE classId = ? AND student = ?
-        """, [classId, full_name[0]])
-        if cursor.fetchone():
+        def insertRequest(cursor):
+            # Check existing request
+            cursor.execute("""
+                SELECT 1 FROM DropRequests 
+                WHERE classId = ? AND studentId = ?
+            """, [classId, identity.userId])
+            if cursor.fetchone():
+                return False
+
+            # Create request
+            cursor.execute("""
+                INSERT INTO DropRequests (classId, student, studentId)
+                VALUES (?, ?, ?)
+            """, [classId, identity.fullName, identity.userId])
+            __requestCreated(cursor, "DropRequests", "drop", cursor.lastrowid)
+            dataVersions.touch(("student", identity.userId))
+            return True
+
+        if not __write(insertRequest):
             return jsonify({"error": "Duplicate request"}), 409
-
-        # Create request
-        cursor.execute("""
-            INSERT INTO DropRequests (classId, student)
-            VALUES (?, ?)
-        """, [classId, full_name[0]])
-
-        conn.commit()
         return jsonify({"message": "Drop request submitted"}), 200
 
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Drop request error: {e}")
         return jsonify({"error": serverError}), 500
-    finally:
-        __closeConnection(conn, cursor)
 
 #TODO: check
 @app.route("/sendAddRequest", methods=["POST"])
-def studentAddRequest():
-    conn, cursor = None, None
+@requireRole("student")
+def studentAddRequest(identity):
     try:
         data = request.json
 
         # Validate input
-        username = data.get('username')
         class_id = data.get("classId")
-        if not all([username, class_id]):
-            return jsonify({"error": "Missing username or class ID"}), 400
-
-        if not __checkRole(username, "student"):
-            return jsonify({"error": "Student access required"}), 403  # Proper 403 status
-
-        conn, cursor = __createConnection()
-
-        # Verify class existence and get details
-        cursor.execute("""
-            SELECT period, capacity, teacher 
-            FROM Classes 
-            WHERE id = ?
-        """, [class_id])
-        class_data = cursor.fetchone()
-        if not class_data:
-            return jsonify({"error": "Invalid class ID"}), 404
-
-        class_period, capacity, teacher = class_data
-
-        # Check class capacity
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM ClassStudents 
-            WHERE classId = ?
-        """, [class_id])
-        enrolled = cursor.fetchone()[0]
-        if enrolled >= capacity:
-            return jsonify({"error": "Class is full"}), 409
-
-        # Check student availability
-        missing_periods = __getMissingPeriods(username)
-        if class_period not in missing_periods:
-            return jsonify({"error": f"Period {class_period} conflict"}), 409
-
-        # Check existing requests
-        cursor.execute("""
-            SELECT 1 
-            FROM AddRequests 
-            WHERE classId = ? AND student = ?
-        """, [class_id, username])  # Use username instead of full_name
-        if cursor.fetchone():
-            return jsonify({"error": "Duplicate add request"}), 409
-
-        # Insert request
-        cursor.execute("""
-            INSERT INTO AddRequests (classId, student)
-            VALUES (?, ?)
-        """, [class_id, username])  # Store username instead of full_name
-        
-        conn.commit()
+        if not class_id:
+            return jsonify({"error": "Missing class ID"}), 400
+
+        def insertRequest(cursor):
+            # Verify class existence and get details
+            cursor.execute("""
+                SELECT id, period, capacity, teacher 
+                FROM Classes 
+                WHERE id = ?
+            """, [class_id])
+            class_data = cursor.fetchone()
+            if not class_data:
+                return "Invalid class ID", 404, None
+
+            # the id as stored, the body may have sent it as a string
+            classId, class_period, capacity, teacher = class_data
+
+            # Check student availability
+            periodMask = getPeriodMask(cursor, identity.userId)
+            if periodMask is None or periodMask & periodBit(class_period):
+                return f"Period {class_period} conflict", 409, None
+
+            # A full class (capacity counts the seats still open) puts the
+            # student on its waitlist instead of turning them away
+            if capacity <= 0:
+                position = waitlists.join(cursor, classId, identity.userId, identity.fullName)
+                if position is None:
+                    return "Already on the waitlist", 409, None
+                dataVersions.touch(("student", identity.userId), ("waitlist", classId))
+                return None, 202, position
+
+            # Check existing requests
+            cursor.execute("""
+                SELECT 1 
+                FROM AddRequests 
+                WHERE classId = ? AND studentId = ?
+            """, [class_id, identity.userId])
+            if cursor.fetchone():
+                return "Duplicate add request", 409, None
+
+            # Insert request
+            cursor.execute("""
+                INSERT INTO AddRequests (classId, student, studentId)
+                VALUES (?, ?, ?)
+            """, [class_id, identity.fullName, identity.userId])
+            __requestCreated(cursor, "AddRequests", "add", cursor.lastrowid)
+            dataVersions.touch(("student", identity.userId))
+            return None, 200, None
+
+        error, status, position = __write(insertRequest)
+        if error:
+            return jsonify({"error": error}), status
+        if position is not None:
+            return jsonify({"message": "Class is full, added to the waitlist", "position": position}), 202
         return jsonify({"message": "Add request submitted"}), 200
 
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
     except Exception as e:
         logging.error(f"Add request error: {str(e)}", exc_info=True)
-        if conn:
-            conn.rollback()
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        __closeConnection(conn, cursor)
+
+# Where the student stands on the waitlists they are on, from memory
+@app.route("/waitlistPosition", methods=["GET"])
+@requireRole("student")
+def waitlistPosition(identity):
+    positions = waitlists.positions(identity.userId)
+    classId = request.args.get("classId")
+    if classId is None:
+        return jsonify({"waitlists": positions}), 200
+    classId = __intArg("classId")
+    for entry in positions:
+        if entry["classId"] == classId:
+            return jsonify(entry), 200
+    return jsonify({"error": "Not on the waitlist for that class"}), 404
+
+@app.route("/leaveWaitlist", methods=["DELETE"])
+@requireRole("student")
+def leaveWaitlist(identity):
+    try:
+        data = request.json
+        classId = data.get("classId")
+        if not isinstance(classId, int):
+            return jsonify({"error": "Missing class ID"}), 400
+        def leave(cursor):
+            if not waitlists.leave(cursor, classId, identity.userId):
+                return False
+            dataVersions.touch(("student", identity.userId), ("waitlist", classId))
+            return True
+
+        if not __write(leave):
+            return jsonify({"error": "Not on the waitlist for that class"}), 404
+        return jsonify({"message": "Removed from the waitlist"}), 200
+    except WriteQueueFull:
+        return jsonify({"error": busyError}), 503
+    except Exception as e:
+        logging.error(f"Leave waitlist error: {e}")
+        return jsonify({"error": serverError}), 500
 
 #TODO: check
 @app.route("/studentGetAvailableClasses", methods=["GET"])
-def studentGetAvailableClasses():
+@requireRole("student")
+@conditionalGet(lambda identity: [("student", identity.userId), CATALOG])
+def studentGetAvailableClasses(identity):
     conn, cursor = None, None
     try:
         conn, cursor = __createConnection()
 
-        # Check if the user is logged in
-        data = request.args
-        user = data.get('username')
-        if not user:
-            return jsonify({"error": "Username cannot be blank"}), 400
-        if not __checkRole(user, "student"):
-            return jsonify({"error": logInError}), 400
-
-        # Fetch the periods the student is already enrolled in
-        currentMissingPeriods = __getMissingPeriods(user)
+        # Periods the student has no class in yet
+        currentMissingPeriods = freePeriods(getPeriodMask(cursor, identity.userId) or 0, MAX_PERIODS)
 
         # If no missing periods, return an empty result
         if not currentMissingPeriods:
             return jsonify({"result": []}), 200
 
-        # Query for available classes in the missing periods
-        classQuery = """
-        SELECT className, classDescription, teacher
-        FROM Classes
-        WHERE capacity > 0 AND period IN ({})
-        """.format(",".join("?" for _ in currentMissingPeriods))  # Dynamically build placeholders
-        cursor.execute(classQuery, currentMissingPeriods)
-        classData = cursor.fetchall()
-
-        # Format the result
+        # Open classes in the missing periods, from memory
         finalClassData = [
-            {"Class Name": curr[0], "Class Description": curr[1], "Teacher": curr[2]}
-            for curr in classData
+            {"Class Name": curr.name, "Class Description": curr.description, "Teacher": curr.teacher}
+            for curr in seatIndex.available(currentMissingPeriods)
         ]
 
         # Return the available classes
@@ -976,6 +1734,74 @@ def studentGetAvailableClasses():
     finally:
         __closeConnection(conn, cursor)
 
+# ("seats", id) keys for the open classes in the student's free periods, whose seat
+# counts the dashboard shows. One primary key lookup, no handler run
+def __openSeatKeys(userId):
+    conn, cursor = None, None
+    try:
+        conn, cursor = __createConnection()
+        periodMask = getPeriodMask(cursor, userId) or 0
+    finally:
+        __closeConnection(conn, cursor)
+    return [("seats", curr.id) for curr in seatIndex.available(freePeriods(periodMask, MAX_PERIODS))]
+
+# Everything the student pages show, in one call: schedule by period, open classes in
+# the free periods, pending add/drop requests and waitlist places. Three queries on one
+# connection, the open classes and waitlists come from memory
+@app.route("/studentDashboard", methods=["GET"])
+@requireRole("student")
+@conditionalGet(lambda identity: [("student", identity.userId), CATALOG] + __openSeatKeys(identity.userId) +
+                [("waitlist", entry["classId"]) for entry in waitlists.positions(identity.userId)])
+def studentDashboard(identity):
+    conn, cursor = None, None
+    try:
+        conn, cursor = __createConnection()
+        periodMask = getPeriodMask(cursor, identity.userId) or 0
+
+        cursor.execute("""
+            SELECT c.period, c.id, c.className, c.classDescription, c.teacher
+            FROM ClassStudents cs
+            JOIN Classes c ON c.id = cs.classId
+            WHERE cs.studentId = ?
+            ORDER BY c.period
+        """, [identity.userId])
+        schedule = [
+            {"period": row[0], "classId": row[1], "className": row[2], "classDescription": row[3], "teacher": row[4]}
+            for row in cursor.fetchall()
+        ]
+
+        cursor.execute("""
+            SELECT 'add', r.id, r.classId, c.className, c.period
+            FROM AddRequests r LEFT JOIN Classes c ON c.id = r.classId
+            WHERE r.studentId = ?
+            UNION ALL
+            SELECT 'drop', r.id, r.classId, c.className, c.period
+            FROM DropRequests r LEFT JOIN Classes c ON c.id = r.classId
+            WHERE r.studentId = ?
+        """, [identity.userId, identity.userId])
+        pending = {"add": [], "drop": []}
+        for kind, requestId, classId, className, period in cursor.fetchall():
+            pending[kind].append({"id": requestId, "classId": classId, "className": className, "period": period})
+
+        openClasses = [
+            {"classId": curr.id, "className": curr.name, "classDescription": curr.description,
+             "teacher": curr.teacher, "period": curr.period, "seatsLeft": curr.seats}
+            for curr in seatIndex.available(freePeriods(periodMask, MAX_PERIODS))
+        ]
+        return jsonify({
+            "schedule": schedule,
+            "freePeriods": freePeriods(periodMask, MAX_PERIODS),
+            "openClasses": openClasses,
+            "pendingRequests": pending,
+            "waitlists": waitlists.positions(identity.userId)
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Error building student dashboard: {e}")
+        return jsonify({"error": serverError}), 500
+    finally:
+        __closeConnection(conn, cursor)
+
 #TODO: check
 @app.route("/changePassword", methods=["POST"])
 def changePassword():
@@ -985,8 +1811,9 @@ def changePassword():
     newPassword = data.get("newPassword")
     if not all([username, oldPassword, newPassword]):
         return jsonify({"error": "missing parameter"}), 400
+    conn, cursor = None, None
     try:
-        conn, cursor = __createConnection()
+        conn, cursor = __createConnection(readOnly=True)
         #check if user exists
         userQuery = """
             SELECT 1
@@ -995,7 +1822,7 @@ def changePassword():
         """
         cursor.execute(userQuery, [username])
         if not cursor.fetchone():
-            return jsonify({"error", "user doesn't exist"}), 400
+            return jsonify({"error": "user doesn't exist"}), 400
         #verify that old password is valid
         passwordQuery = """
             SELECT salt, hash
@@ -1004,30 +1831,105 @@ def changePassword():
         """
         cursor.execute(passwordQuery, [username])
         salt, storedHash = cursor.fetchone()
+        # Don't hold a connection while hashing
+        __closeConnection(conn, cursor)
+        conn, cursor = None, None
         tempHash = __hashPassword(oldPassword, salt)
         if not secrets.compare_digest(tempHash, storedHash):
             return jsonify({"error": "invalid old password"}), 400
         newSalt = __generateSalt()
         newHash = __hashPassword(newPassword, newSalt)
+        # Only if the hash we checked is still the stored one
         updatePasswordQuery = """
             UPDATE Users
             SET salt = ?, hash = ?
-            WHERE username = ?
+            WHERE username = ? AND hash = ?
+            RETURNING id
         """
-        cursor.execute(updatePasswordQuery, [newSalt, newHash, username])
-        conn.commit()
+        def updatePassword(cursor):
+            row = cursor.execute(updatePasswordQuery, [newSalt, newHash, username, storedHash]).fetchone()
+            if row:
+                # no data: the hash is nobody else's business
+                journal.record(cursor, "Users", journal.UPDATE, userId=row[0])
+            return row is not None
+
+        updated = __write(updatePassword)
+        if not updated:
+            return jsonify({"error": "password was changed by another request"}), 409
+        identityCache.invalidate(username)
+        # Sessions opened with the old password stop working
+        tokenSigner.revoke(username)
 
         return jsonify({"message": "password changed successfully"}), 200
 
+    except (HashPoolBusy, WriteQueueFull):
+        return jsonify({"error": busyError}), 503
     except Exception as e:
-        if conn:
-            conn.rollback()
         logging.error(f"Error during password change: {e}")
         return jsonify({"error": str(e)}), 500
 
     finally:
-        if conn and cursor:
-            __closeConnection(conn, cursor)
+        __closeConnection(conn, cursor)
+
+# Prometheus scrape target. Unauthenticated like most exporters, keep it off the public listener
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    hashStats = hashExecutor.stats()
+    poolStats = dbPool.stats()
+    readStats = readPool.stats()
+    cacheStats = identityCache.stats()
+    writeStats = writeQueue.stats()
+    responseStats = responseCache.stats()
+    seatStats = seatIndex.stats()
+    waitlistStats = waitlists.stats()
+    eventStats = eventBus.stats()
+    backupStats = backupRunner.stats()
+    extra = [
+        ("password_hash_seconds_total", "counter", "PBKDF2 time from submit to result, queueing included", hashStats["hashTimeTotal"]),
+        ("password_hash_total", "counter", "Password hashes completed", hashStats["completed"]),
+        ("password_hash_rejected_total", "counter", "Hashes refused because the queue was full", hashStats["rejected"]),
+        ("password_hash_queue_depth", "gauge", "Hashes queued or running", hashStats["queueDepth"]),
+        ("db_pool_connections", "gauge", "Open database connections", poolStats["size"]),
+        ("db_pool_idle_connections", "gauge", "Database connections waiting in the pool", poolStats["idle"]),
+        ("db_pool_waits_total", "counter", "Times a request had to wait for a connection", poolStats["waits"]),
+        ("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection", poolStats["waitTimeTotal"]),
+        ("db_read_pool_connections", "gauge", "Open read-only connections", readStats["size"]),
+        ("db_read_pool_idle_connections", "gauge", "Read-only connections waiting in the pool", readStats["idle"]),
+        ("db_read_pool_waits_total", "counter", "Times a GET had to wait for a read-only connection", readStats["waits"]),
+        ("db_read_pool_wait_seconds_total", "counter", "Time spent waiting for a read-only connection", readStats["waitTimeTotal"]),
+        ("identity_cache_hits_total", "counter", "Identity lookups answered from the cache", cacheStats["hits"]),
+        ("identity_cache_misses_total", "counter", "Identity lookups that went to the database", cacheStats["misses"]),
+        ("response_cache_hits_total", "counter", "Conditional GETs answered from the response cache", responseStats["hits"]),
+        ("response_cache_misses_total", "counter", "Conditional GETs that ran their handler", responseStats["misses"]),
+        ("response_not_modified_total", "counter", "Conditional GETs answered with 304", responseStats["notModified"]),
+        ("seat_index_open_classes", "gauge", "Classes with seats left, in the seat index", seatStats["openClasses"]),
+        ("seat_index_open_seats", "gauge", "Seats left across all classes, in the seat index", seatStats["openSeats"]),
+        ("waitlist_students", "gauge", "Waitlist entries across all classes", waitlistStats["waiting"]),
+        ("waitlist_promotions_total", "counter", "Students enrolled from a waitlist", waitlistStats["promoted"]),
+        ("admin_event_subscribers", "gauge", "Open /adminEvents streams", eventStats["subscribers"]),
+        ("admin_events_published_total", "counter", "Request queue events published", eventStats["published"]),
+        ("backup_running", "gauge", "1 while an online backup is copying", int(backupStats["running"])),
+        ("backups_total", "counter", "Online backups completed", backupStats["completed"]),
+        ("backup_failures_total", "counter", "Online backups that failed", backupStats["failed"]),
+        ("backup_last_bytes", "gauge", "Size of the last completed backup", backupStats["lastBytes"]),
+        ("backup_last_seconds", "gauge", "Duration of the last completed backup, pauses included", backupStats["lastSeconds"]),
+        ("backup_last_timestamp_seconds", "gauge", "Snapshot time of the last completed backup", backupStats["lastTakenAt"]),
+        ("db_write_queue_depth", "gauge", "Writes waiting for the writer thread", writeStats["queueDepth"]),
+        ("db_write_total", "counter", "Writes applied by the writer thread", writeStats["writes"]),
+        ("db_write_groups_total", "counter", "Transactions committed by the writer thread", writeStats["groups"]),
+        ("db_write_failed_groups_total", "counter", "Writer transactions that failed as a whole", writeStats["failedGroups"]),
+        ("db_write_group_seconds_total", "counter", "Time the writer spent applying and committing groups", writeStats["groupTimeTotal"]),
+    ]
+    return app.response_class(requestMetrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+# Statements with the most total time since startup, needs SQL_TRACE=1
+@app.route("/sqlStats", methods=["GET"])
+@requireRole("admin")
+def sql_stats(identity):
+    if not sqlTracer.enabled:
+        return jsonify({"error": "sql tracing is off, start the server with SQL_TRACE=1"}), 404
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify({"statements": sqlTracer.stats(limit)}), 200
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
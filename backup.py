@@ -0,0 +1,264 @@
+"""Online backups of the registration database, and restores from them.
+
+    python backup.py create [--db path] [--dir backups] [--pages N] [--sleep-ms N] [--verify]
+    python backup.py list [--dir backups]
+    python backup.py restore DEST [--dir backups] [--at 2026-10-18T09:30:00Z]
+
+A backup copies the database page by page with sqlite's backup API while the
+server keeps running. The copy reads one snapshot: the source connection holds
+a read transaction for the whole run, which in WAL mode never blocks writers,
+so writes that land mid-backup neither stall nor restart it. Between steps it
+sleeps, so a backup never takes a whole core from request threads. Each backup
+is written next to a .json report with its snapshot time, the change journal
+seq it includes, and its throughput.
+
+Restores are point in time at backup granularity: the newest backup taken at
+or before --at is copied into DEST, which must not exist yet. The live
+database is never touched. Consumers of /changes can resume from the report's
+changeSeq after a restore.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import journal
+
+BACKUP_PAGES = 256  # pages copied per step
+BACKUP_SLEEP = 0.01  # seconds between steps
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class BackupError(Exception):
+    pass
+
+
+def _timestamp(moment):
+    return datetime.fromtimestamp(moment, timezone.utc).strftime(TIME_FORMAT)
+
+
+def parseTime(text):
+    """A TIME_FORMAT (UTC) string as unix time, BackupError if it isn't one."""
+    try:
+        return datetime.strptime(text, TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        raise BackupError(f"time must look like {_timestamp(0)}")
+
+
+def _reportPath(backupPath):
+    return os.path.splitext(backupPath)[0] + ".json"
+
+
+def create(sourcePath, backupDir, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP, verify=False, progress=None):
+    """Back up sourcePath into a new file in backupDir, returns its report.
+    progress(pagesDone, pagesTotal) is called after every step."""
+    os.makedirs(backupDir, exist_ok=True)
+    source = sqlite3.connect(sourcePath, isolation_level=None)
+    try:
+        # Pin one snapshot: without it every commit elsewhere restarts the copy
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # the snapshot starts at the first read
+        takenAt = time.time()
+        try:
+            changeSeq = journal.latestSeq(source.cursor())
+        except sqlite3.OperationalError:  # schema from before the change journal
+            changeSeq = None
+        name = "database-" + datetime.fromtimestamp(takenAt, timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        path = os.path.join(backupDir, name + ".db")
+        # Written under a temporary name, so a backup that dies halfway never looks finished
+        partial = path + ".partial"
+        target = sqlite3.connect(partial)
+        steps = [0, 0.0]  # steps, seconds slept
+
+        def step(status, remaining, total):
+            steps[0] += 1
+            if progress:
+                progress(total - remaining, total)
+            if remaining:
+                time.sleep(sleep)
+                steps[1] += sleep
+
+        started = time.perf_counter()
+        try:
+            source.backup(target, pages=pages, progress=step)
+            pageSize = target.execute("PRAGMA page_size").fetchone()[0]
+            pageCount = target.execute("PRAGMA page_count").fetchone()[0]
+            if verify:
+                result = target.execute("PRAGMA quick_check").fetchone()[0]
+                if result != "ok":
+                    raise BackupError(f"backup failed its check: {result}")
+        except BaseException:
+            target.close()
+            os.remove(partial)
+            raise
+        target.close()
+        seconds = time.perf_counter() - started
+    finally:
+        source.close()
+    os.replace(partial, path)
+
+    size = pageSize * pageCount
+    report = {
+        "name": name,
+        "path": path,
+        "takenAt": _timestamp(takenAt),
+        "takenAtUnix": takenAt,
+        "changeSeq": changeSeq,
+        "pages": pageCount,
+        "bytes": size,
+        "steps": steps[0],
+        "seconds": round(seconds, 3),
+        "sleptSeconds": round(steps[1], 3),
+        # throughput over the whole run, and over the time spent copying
+        "mbPerSecond": round(size / 1e6 / seconds, 2) if seconds else None,
+        "copyMbPerSecond": round(size / 1e6 / (seconds - steps[1]), 2) if seconds > steps[1] else None,
+        "verified": verify,
+    }
+    with open(_reportPath(path), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def listBackups(backupDir):
+    """Reports of the finished backups in backupDir, oldest first."""
+    if not os.path.isdir(backupDir):
+        return []
+    reports = []
+    for fileName in os.listdir(backupDir):
+        if fileName.endswith(".json") and os.path.exists(os.path.join(backupDir, fileName[:-5] + ".db")):
+            with open(os.path.join(backupDir, fileName)) as f:
+                reports.append(json.load(f))
+    return sorted(reports, key=lambda report: report["takenAtUnix"])
+
+
+def restore(backupDir, destPath, at=None):
+    """Copy the newest backup taken at or before unix time at (the newest of
+    all if at is None) into destPath, which must not exist. The copy is
+    checked before it is kept. Returns the backup's report."""
+    if os.path.exists(destPath):
+        raise BackupError(f"{destPath} already exists, restore into a fresh file")
+    candidates = [report for report in listBackups(backupDir) if at is None or report["takenAtUnix"] <= at]
+    if not candidates:
+        raise BackupError("no backup was taken before that time" if at is not None else "there are no backups")
+    report = candidates[-1]
+    partial = destPath + ".partial"
+    source = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(report['path']))}?mode=ro", uri=True)
+    target = sqlite3.connect(partial)
+    try:
+        source.backup(target)
+        result = target.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise BackupError(f"backup {report['name']} failed its check: {result}")
+    except BaseException:
+        target.close()
+        os.remove(partial)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(partial, destPath)
+    return report
+
+
+class BackupRunner:
+    """Runs create() on a background thread for the admin endpoint, one at a
+    time, and keeps its progress and the last report for polling and metrics."""
+
+    def __init__(self, sourcePath, backupDir, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP):
+        self.sourcePath = sourcePath
+        self.backupDir = backupDir
+        self.pages = pages
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._running = False
+        self._progress = (0, 0)
+        self._last = None
+        self._error = None
+        self._completed = 0
+        self._failed = 0
+
+    def start(self, verify=False):
+        """Start a backup, False if one is already running."""
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+            self._progress = (0, 0)
+            self._error = None
+        threading.Thread(target=self._run, args=(verify,), name="backup", daemon=True).start()
+        return True
+
+    def _run(self, verify):
+        report, error = None, None
+        try:
+            report = create(self.sourcePath, self.backupDir, self.pages, self.sleep, verify, self._setProgress)
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            self._running = False
+            if error is None:
+                self._last = report
+                self._completed += 1
+            else:
+                self._error = error
+                self._failed += 1
+
+    def _setProgress(self, done, total):
+        with self._lock:
+            self._progress = (done, total)
+
+    def status(self):
+        with self._lock:
+            done, total = self._progress
+            return {
+                "running": self._running,
+                "pagesDone": done,
+                "pagesTotal": total,
+                "lastBackup": self._last,
+                "lastError": self._error,
+            }
+
+    def stats(self):
+        with self._lock:
+            last = self._last or {}
+            return {
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "lastBytes": last.get("bytes", 0),
+                "lastSeconds": last.get("seconds", 0),
+                "lastTakenAt": last.get("takenAtUnix", 0),
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=os.environ.get("BACKUP_DIR", "./database/backups"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    createParser = commands.add_parser("create", help="back up the database")
+    createParser.add_argument("--db", default=os.environ.get("DATABASE_PATH", "./database/database.db"))
+    createParser.add_argument("--pages", type=int, default=BACKUP_PAGES, help="pages copied per step")
+    createParser.add_argument("--sleep-ms", type=float, default=BACKUP_SLEEP * 1000, help="pause between steps")
+    createParser.add_argument("--verify", action="store_true", help="quick_check the copy")
+    commands.add_parser("list", help="list finished backups")
+    restoreParser = commands.add_parser("restore", help="restore a backup into a new file")
+    restoreParser.add_argument("dest")
+    restoreParser.add_argument("--at", help=f"newest backup taken at or before this UTC time, like {_timestamp(0)}")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "create":
+            result = create(args.db, args.dir, args.pages, args.sleep_ms / 1000, args.verify)
+        elif args.command == "list":
+            result = listBackups(args.dir)
+        else:
+            result = restore(args.dir, args.dest, parseTime(args.at) if args.at else None)
+    except BackupError as e:
+        print(e)
+        sys.exit(2)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,405 @@
+"""Benchmark every endpoint against a freshly seeded database, prints JSON.
+
+    python bench.py --students 2000 --teachers 50 --classes 200 --requests 1000 --iterations 50 --mode both > run.json
+
+Each route is driven --iterations times through the Flask test client and/or a
+real threaded HTTP server, and gets status counts, throughput and p50/p95/p99
+latency in milliseconds. Routes that change data each get their own slice of
+the seeded rows, so every run does the same work and runs can be compared.
+
+/backupDatabase runs last. Each call waits for the backup before it to finish,
+so the route's latency is only the start (concurrent http clients can still
+race each other into a 409), and the report's "backup" section has the last
+backup's own throughput.
+
+--sql-trace turns on SQL_TRACE and adds the fewest statements any successful
+call of a route traced (client mode). The run fails if a route that writes
+traced none, since then its statements went uncounted.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import migrations
+from hashing import pbkdf2Hash
+
+PASSWORD = "bench"
+BATCH_ITEMS = 5  # requests per call to the batch approval endpoints
+IMPORT_ROWS = 2  # users per /importUsers call, each one is a PBKDF2 hash
+# Non-GET routes that run no SQL in the request itself (the copy runs on its own thread)
+NO_SQL_ROUTES = {"/backupDatabase"}
+
+
+def seed(path, args, consume):
+    """Build the database and return the ids the scenarios need.
+
+    Regular classes use periods 1..P-1 and every student is enrolled in one of
+    them; period P holds one big class, so any student can still be added to it."""
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    salt = "bench-salt"
+    hashed = pbkdf2Hash(PASSWORD, salt)
+
+    def addUsers(prefix, count, role):
+        conn.executemany(
+            "INSERT INTO Users (username, full_name, salt, hash, role) VALUES (?, ?, ?, ?, ?)",
+            [[f"{prefix}{i}", f"{prefix.title()} {i}", salt, hashed, role] for i in range(count)])
+
+    addUsers("admin", 1, "admin")
+    addUsers("teacher", args.teachers, "teacher")
+    addUsers("student", args.students, "student")
+    addUsers("spareteacher", consume, "teacher")
+    addUsers("spare", 2 * consume, "student")
+    users = {row[0]: (row[1], row[2], row[3]) for row in conn.execute("SELECT username, id, full_name, role FROM Users")}
+
+    def userId(username):
+        return users[username][0]
+
+    regularPeriods = max(args.periods - 1, 1)
+    classes = []
+    for c in range(args.classes):
+        teacher = f"teacher{c % args.teachers}"
+        classes.append([f"Class {c}", "seeded", args.students, users[teacher][1], userId(teacher), c // args.teachers % regularPeriods + 1])
+    classes.append(["Big class", "seeded", args.students, "Teacher 0", userId("teacher0"), args.periods])
+    # empty classes for /deleteClass to remove
+    classes += [[f"Spare class {i}", "seeded", 10, f"Spareteacher {i}", userId(f"spareteacher{i}"), 2] for i in range(consume)]
+    conn.executemany(
+        "INSERT INTO Classes (className, classDescription, capacity, teacher, teacherId, period) VALUES (?, ?, ?, ?, ?, ?)",
+        classes)
+    classRows = conn.execute("SELECT id, teacherId, period FROM Classes ORDER BY id").fetchall()
+    conn.execute("INSERT INTO TeacherSchedule (teacher, teacherId, classId) SELECT teacher, teacherId, id FROM Classes")
+    regular = classRows[:args.classes]
+    bigClass = classRows[args.classes][0]
+    spareClasses = [row[0] for row in classRows[args.classes + 1:]]
+
+    # one enrollment per student
+    enrollments = []
+    for s in range(args.students):
+        classId, teacherId, period = regular[s % len(regular)]
+        enrollments.append((f"student{s}", classId, period))
+    conn.executemany(
+        "INSERT INTO ClassStudents (classId, student, studentId) VALUES (?, ?, ?)",
+        [[classId, users[u][1], userId(u)] for u, classId, period in enrollments])
+    conn.executemany(
+        "INSERT INTO StudentSchedule (student, studentId, classId, period) VALUES (?, ?, ?, ?)",
+        [[users[u][1], userId(u), classId, period] for u, classId, period in enrollments])
+    conn.executemany("UPDATE Users SET periodMask = ? WHERE id = ?",
+                     [[1 << (period - 1), userId(u)] for u, classId, period in enrollments])
+    conn.execute("""
+        UPDATE Classes SET capacity = capacity - (SELECT COUNT(*) FROM ClassStudents WHERE classId = Classes.id)
+    """)
+
+    # pending requests: the first --requests students want to drop their class and join the big one
+    conn.executemany(
+        "INSERT INTO DropRequests (classId, student, studentId) VALUES (?, ?, ?)",
+        [[classId, users[u][1], userId(u)] for u, classId, period in enrollments[:args.requests]])
+    conn.executemany(
+        "INSERT INTO AddRequests (classId, student, studentId) VALUES (?, ?, ?)",
+        [[bigClass, users[u][1], userId(u)] for u, classId, period in enrollments[:args.requests]])
+    conn.commit()
+    drops = conn.execute("SELECT id, classId, studentId FROM DropRequests ORDER BY id").fetchall()
+    adds = conn.execute("SELECT id, classId, studentId FROM AddRequests ORDER BY id").fetchall()
+    conn.close()
+    return {
+        "users": users,
+        "enrollments": enrollments,
+        "regular": regular,
+        "bigClass": bigClass,
+        "spareClasses": spareClasses,
+        "drops": drops,
+        "adds": adds,
+    }
+
+
+def scenarios(data, args, consume, tokenFor, waitForBackup):
+    """(route, request builder) pairs in the order they run. A builder takes
+    the index of the call within the whole run and returns
+    (method, path, json body or raw bytes, content type, token)."""
+    users, enrollments = data["users"], data["enrollments"]
+    drops, adds, bigClass = data["drops"], data["adds"], data["bigClass"]
+    admin = tokenFor("admin0")
+
+    def student(i):
+        return f"student{i % args.students}"
+
+    def teacherOf(classRow):
+        return next(u for u, (uid, name, role) in users.items() if uid == classRow[1])
+
+    def jsonCall(method, path, body, token):
+        return method, path, body, "application/json", token
+
+    def batch(rows, i):
+        chunk = rows[2 * consume + i * BATCH_ITEMS:2 * consume + (i + 1) * BATCH_ITEMS]
+        return {"requests": [{"classId": classId, "studentId": studentId} for requestId, classId, studentId in chunk]}
+
+    def importBody(i):
+        lines = ["username,full_name,password,role"]
+        lines += [f"imported{i}x{r},Imported {i} {r},{PASSWORD},student" for r in range(IMPORT_ROWS)]
+        return "POST", "/importUsers", ("\n".join(lines) + "\n").encode(), "text/csv", admin
+
+    def startBackup(i):
+        waitForBackup()
+        return jsonCall("POST", "/backupDatabase", {}, admin)
+
+    regularTeachers = {row[0]: teacherOf(row) for row in data["regular"][:args.teachers]}
+    regularIds = list(regularTeachers)
+
+    return [
+        # reads
+        ("/getAllClassesTeacher", lambda i: jsonCall("GET", "/getAllClassesTeacher", None, tokenFor(f"teacher{i % args.teachers}"))),
+        ("/getStudentsInClass", lambda i: jsonCall(
+            "GET", f"/getStudentsInClass?id={regularIds[i % len(regularIds)]}", None,
+            tokenFor(regularTeachers[regularIds[i % len(regularIds)]]))),
+        ("/studentGetAvailableClasses", lambda i: jsonCall("GET", "/studentGetAvailableClasses", None, tokenFor(student(i)))),
+        ("/getStudentClassInfo", lambda i: jsonCall(
+            "GET", f"/getStudentClassInfo?classId={enrollments[i % args.students][1]}", None, tokenFor(student(i)))),
+        ("/getAddClassRequest", lambda i: jsonCall("GET", "/getAddClassRequest", None, admin)),
+        ("/getDropClassRequest", lambda i: jsonCall("GET", "/getDropClassRequest", None, admin)),
+        ("/studentsFreeInPeriod", lambda i: jsonCall("GET", f"/studentsFreeInPeriod?period={args.periods}", None, admin)),
+        ("/studentDashboard", lambda i: jsonCall("GET", "/studentDashboard", None, tokenFor(student(i)))),
+        ("/waitlistPosition", lambda i: jsonCall("GET", "/waitlistPosition", None, tokenFor(student(i)))),
+        ("/exportRosters", lambda i: jsonCall(
+            "GET", f"/exportRosters?classId={regularIds[i % len(regularIds)]}", None, admin)),
+        ("/exportRosters (whole school)", lambda i: jsonCall("GET", "/exportRosters", None, admin)),
+        ("/allocateAddRequests (dry run)", lambda i: jsonCall(
+            "POST", "/allocateAddRequests", {"policy": "lottery", "seed": i, "dryRun": True}, admin)),
+        # password hashing
+        ("/login", lambda i: jsonCall("POST", "/login", {"username": student(i), "password": PASSWORD, "role": "student"}, None)),
+        ("/changePassword", lambda i: jsonCall(
+            "POST", "/changePassword", {"username": f"spare{consume + i}", "oldPassword": PASSWORD, "newPassword": PASSWORD + "2"}, None)),
+        ("/createUser", lambda i: jsonCall(
+            "POST", "/createUser", {"newUsername": f"created{i}", "full_name": f"Created {i}", "newPassword": PASSWORD, "role": "student"}, admin)),
+        ("/importUsers", importBody),
+        # writes, each call on its own seeded rows
+        ("/sendAddRequest", lambda i: jsonCall("POST", "/sendAddRequest", {"classId": bigClass}, tokenFor(f"student{args.requests + i}"))),
+        ("/sendDropRequest", lambda i: jsonCall(
+            "POST", "/sendDropRequest", {"classId": enrollments[args.requests + i][1]}, tokenFor(f"student{args.requests + i}"))),
+        ("/acceptAddClass", lambda i: jsonCall("POST", "/acceptAddClass", {"class_id": adds[i][1], "student_id": adds[i][2]}, admin)),
+        ("/declineAdd", lambda i: jsonCall(
+            "DELETE", "/declineAdd", {"addId": adds[consume + i][0], "classId": adds[consume + i][1], "studentId": adds[consume + i][2]}, admin)),
+        ("/acceptAddClassBatch", lambda i: jsonCall("POST", "/acceptAddClassBatch", batch(adds, i), admin)),
+        ("/acceptClassDrop", lambda i: jsonCall("POST", "/acceptClassDrop", {"classId": drops[i][1], "studentId": drops[i][2]}, admin)),
+        ("/declineDrop", lambda i: jsonCall(
+            "POST", "/declineDrop", {"dropId": drops[consume + i][0], "classId": drops[consume + i][1], "studentId": drops[consume + i][2]}, admin)),
+        ("/acceptClassDropBatch", lambda i: jsonCall("POST", "/acceptClassDropBatch", batch(drops, i), admin)),
+        ("/addStudentToClass", lambda i: jsonCall(
+            "POST", "/addStudentToClass", {"classId": bigClass, "studentId": users[f"student{args.requests + consume + i}"][0]}, admin)),
+        ("/addNewClass", lambda i: jsonCall(
+            "POST", "/addNewClass",
+            {"classname": f"New class {i}", "description": "bench", "teacherId": users[f"spareteacher{i}"][0], "capacity": 30, "period": 1},
+            admin)),
+        ("/deleteClass", lambda i: jsonCall("DELETE", "/deleteClass", {"classId": data["spareClasses"][i]}, admin)),
+        ("/deleteuser", lambda i: jsonCall("DELETE", "/deleteuser", {"username": f"spare{i}"}, admin)),
+        # the journal the writes above filled
+        ("/changes", lambda i: jsonCall("GET", f"/changes?since={i * 10}&limit=100", None, admin)),
+        ("/backupDatabase", startBackup),
+    ]
+
+
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return None
+    rank = max(int(round(p / 100 * len(sortedValues))) - 1, 0)
+    return sortedValues[min(rank, len(sortedValues) - 1)]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    counts = {}
+    for status in statuses:
+        counts[str(status)] = counts.get(str(status), 0) + 1
+    return {
+        "requests": len(latencies),
+        "statusCounts": counts,
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50": round(percentile(latencies, 50) * 1000, 3),
+        "p95": round(percentile(latencies, 95) * 1000, 3),
+        "p99": round(percentile(latencies, 99) * 1000, 3),
+        "max": round(latencies[-1] * 1000, 3),
+    }
+
+
+# statements=N from an X-SQL-Trace header, None without one
+def _tracedStatements(response):
+    header = response.headers.get("X-SQL-Trace", "")
+    for part in header.split("; "):
+        if part.startswith("statements="):
+            return int(part[len("statements="):])
+    return None
+
+
+def runClient(app, build, indexes):
+    """Sequential calls through the Flask test client, no sockets involved."""
+    client = app.test_client()
+    latencies, statuses, traced = [], [], []
+    start = time.perf_counter()
+    for i in indexes:
+        method, path, body, contentType, token = build(i)
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        kwargs = {"json": body} if contentType == "application/json" and body is not None else {"data": body, "content_type": contentType}
+        began = time.perf_counter()
+        response = client.open(path, method=method, headers=headers, **kwargs)
+        latencies.append(time.perf_counter() - began)
+        statuses.append(response.status_code)
+        statements = _tracedStatements(response)
+        if statements is not None and response.status_code < 300:
+            traced.append(statements)
+    summary = summarize(latencies, statuses, time.perf_counter() - start)
+    if traced:
+        summary["minSqlStatements"] = min(traced)
+    return summary
+
+
+def _httpCall(baseUrl, method, path, body, contentType, token):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    if body is not None:
+        headers["Content-Type"] = contentType
+        if contentType == "application/json":
+            body = json.dumps(body).encode()
+    req = urllib.request.Request(baseUrl + path, data=body, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def runHttp(baseUrl, build, indexes, threads):
+    """The same calls over real sockets from --threads concurrent clients."""
+    def timed(i):
+        call = build(i)
+        began = time.perf_counter()
+        try:
+            status = _httpCall(baseUrl, *call)
+        except OSError as e:
+            status = f"error ({e.__class__.__name__})"
+        return time.perf_counter() - began, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(timed, indexes))
+    return summarize([r[0] for r in results], [r[1] for r in results], time.perf_counter() - start)
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    modes = ["client", "http"] if args.mode == "both" else [args.mode]
+    consume = args.iterations * len(modes)
+    needRequests = (2 + BATCH_ITEMS) * consume
+    if args.requests < needRequests:
+        sys.exit(f"--requests must be at least {needRequests} for {args.iterations} iterations in {len(modes)} mode(s)")
+    if args.students < args.requests + 2 * consume:
+        sys.exit(f"--students must be at least --requests + {2 * consume}")
+    if args.classes < args.teachers or args.periods < 2:
+        sys.exit("need at least one class per teacher and two periods")
+
+    workDir = tempfile.mkdtemp()
+    path = os.path.join(workDir, "bench.db")
+    seedStart = time.perf_counter()
+    data = seed(path, args, consume)
+    seedTime = time.perf_counter() - seedStart
+
+    # app reads its configuration at import time
+    os.environ["DATABASE_PATH"] = path
+    os.environ.setdefault("SESSION_SECRET", "bench")
+    if args.sql_trace:
+        os.environ["SQL_TRACE"] = "1"
+    import app as server
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    tokens = {}
+
+    def tokenFor(username):
+        # minted directly so only /login itself pays for PBKDF2
+        if username not in tokens:
+            userId, fullName, role = data["users"][username]
+            tokens[username] = server.tokenSigner.issue(username, userId, fullName, role)[0]
+        return tokens[username]
+
+    def waitForBackup():
+        while server.backupRunner.status()["running"]:
+            time.sleep(0.01)
+
+    routes = scenarios(data, args, consume, tokenFor, waitForBackup)
+    results = {}
+    httpServer = None
+    try:
+        for m, mode in enumerate(modes):
+            indexes = range(m * args.iterations, (m + 1) * args.iterations)
+            if mode == "http":
+                from werkzeug.serving import make_server
+                httpServer = make_server("127.0.0.1", 0, server.app, threaded=True)
+                threading.Thread(target=httpServer.serve_forever, daemon=True).start()
+                baseUrl = f"http://127.0.0.1:{httpServer.server_port}"
+            results[mode] = {}
+            for route, build in routes:
+                if mode == "client":
+                    results[mode][route] = runClient(server.app, build, indexes)
+                else:
+                    results[mode][route] = runHttp(baseUrl, build, indexes, args.threads)
+                print(f"{mode} {route}: p50 {results[mode][route]['p50']}ms", file=sys.stderr)
+        waitForBackup()
+        backupStatus = server.backupRunner.status()
+    finally:
+        if httpServer:
+            httpServer.shutdown()
+        server.hashExecutor.shutdown()
+        server.dbPool.closeAll()
+
+    if args.sql_trace and "client" in results:
+        untraced = [route for route, build in routes
+                    if build(0)[0] != "GET" and route not in NO_SQL_ROUTES
+                    and results["client"][route].get("minSqlStatements") == 0]
+        if untraced:
+            sys.exit(f"writes traced no statements: {', '.join(untraced)}")
+
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "seedSeconds": round(seedTime, 3),
+        "results": results,
+        "backup": backupStatus["lastBackup"] or {"error": backupStatus["lastError"]},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--teachers", type=int, default=50)
+    parser.add_argument("--classes", type=int, default=200)
+    parser.add_argument("--periods", type=int, default=7)
+    parser.add_argument("--requests", type=int, default=1000, help="pending add and drop requests each")
+    parser.add_argument("--iterations", type=int, default=50, help="calls per route per mode")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent clients in http mode")
+    parser.add_argument("--mode", choices=["client", "http", "both"], default="both")
+    parser.add_argument("--sql-trace", action="store_true", help="trace statements, fail if a write traces none")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
@@ -1,3 +1,6 @@
+-- Base schema (version 0). Changes on top of it are numbered migrations in
+-- migrations.py, applied at startup and recorded in schema_version
+
 -- User Table: Tracks all users (admin, students, and teachers)
 CREATE TABLE Users (
     username VARCHAR(50) PRIMARY KEY,
@@ -0,0 +1,86 @@
+import itertools
+import json
+import os
+import threading
+from collections import deque
+
+from writer import afterCommit
+
+# Tells a subscriber it missed events (or the server restarted) and must reload
+RESYNC = "resync"
+
+
+class EventBus:
+    """In-process pub/sub with a bounded replay buffer.
+
+    Events get increasing ids within a process. A cursor is "epoch-id", so a
+    cursor from before a restart, or one older than the buffer, is answered
+    with a RESYNC instead of a silent gap."""
+
+    def __init__(self, maxBacklog=10000, maxSubscribers=32):
+        self.epoch = os.urandom(4).hex()
+        self.maxSubscribers = maxSubscribers
+        self._events = deque(maxlen=maxBacklog)  # (id, type, json data)
+        self._lastId = 0
+        self._subscribers = 0
+        self._published = 0
+        self._changed = threading.Condition()
+
+    def publish(self, type, data):
+        with self._changed:
+            self._lastId += 1
+            self._events.append((self._lastId, type, json.dumps(data)))
+            self._published += 1
+            self._changed.notify_all()
+
+    # From inside a queued write: published once the write commits, so
+    # subscribers never hear about a change that was rolled back
+    def publishOnCommit(self, type, data):
+        afterCommit(lambda: self.publish(type, data))
+
+    def cursor(self, eventId=None):
+        return f"{self.epoch}-{self._lastId if eventId is None else eventId}"
+
+    # The event id a cursor points at, or None if it isn't one of ours
+    def _parse(self, cursor):
+        epoch, _, eventId = (cursor or "").rpartition("-")
+        if epoch != self.epoch or not eventId.isdigit():
+            return None
+        return int(eventId)
+
+    def since(self, cursor, timeout=None):
+        """Events after cursor as (cursor, type, json data), waiting up to
+        timeout for the first one. Returns None when the cursor can't be
+        replayed: the subscriber should reload and carry on from cursor()."""
+        lastId = self._parse(cursor)
+        with self._changed:
+            if lastId is None or lastId > self._lastId:
+                return None
+            if lastId == self._lastId and timeout:
+                self._changed.wait(timeout)
+            oldest = self._events[0][0] if self._events else self._lastId + 1
+            if lastId < oldest - 1:
+                return None
+            # Ids are consecutive, so the first event we want sits at a known offset
+            return [(self.cursor(eventId), type, data)
+                    for eventId, type, data in itertools.islice(self._events, lastId - oldest + 1, None)]
+
+    def subscribe(self):
+        """Take a subscriber slot, False when all maxSubscribers are in use."""
+        with self._changed:
+            if self._subscribers >= self.maxSubscribers:
+                return False
+            self._subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._changed:
+            self._subscribers -= 1
+
+    def stats(self):
+        with self._changed:
+            return {
+                "subscribers": self._subscribers,
+                "published": self._published,
+                "backlog": len(self._events),
+            }
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+import zlib
+
+FORMATS = ("csv", "jsonl")
+MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+# Yields lists of rows from a cursor that has executed its query, chunkSize at a time
+def fetchChunks(cursor, chunkSize):
+    while True:
+        rows = cursor.fetchmany(chunkSize)
+        if not rows:
+            return
+        yield rows
+
+
+def encodeRows(chunks, columns, format="csv"):
+    """Yields one encoded str per chunk of row tuples: a header line and then
+    csv records, or one json object per line keyed by columns."""
+    if format not in FORMATS:
+        raise ExportFormatError(f"unknown format {format!r}, expected csv or jsonl")
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # An empty export still gets its header
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for rows in chunks:
+            yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+# gzip a stream of str chunks as it goes. Each chunk is flushed, so the client
+# gets bytes as soon as there are rows instead of when zlib's buffer fills
+def gzipChunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
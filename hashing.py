@@ -0,0 +1,103 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PBKDF2_ITERATIONS = 100000
+# Default queue bound: at least this many, so a burst of logins on a small host
+# waits its turn instead of getting 503s
+MIN_PENDING = 32
+PENDING_PER_WORKER = 8
+
+
+# Runs in the worker processes, so it has to stay a plain module level function
+def pbkdf2Hash(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), PBKDF2_ITERATIONS).hex()
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+class HashExecutor:
+    """Process pool for PBKDF2 so password hashing doesn't hold up request threads."""
+
+    def __init__(self, workers=None, maxPending=None):
+        self.workers = workers or os.cpu_count() or 1
+        # Anything past this many queued hashes is rejected instead of piling up
+        self.maxPending = maxPending or max(MIN_PENDING, self.workers * PENDING_PER_WORKER)
+        self._slots = threading.BoundedSemaphore(self.maxPending)
+        # Bulk callers (imports) may hold at most half the slots between them,
+        # so logins and password changes always find one free (unless
+        # maxPending is 1, and then there is nothing to share)
+        self.maxBulk = max(1, self.maxPending // 2)
+        self._bulkSlots = threading.BoundedSemaphore(self.maxBulk)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._totalTime = 0.0
+        self._maxTime = 0.0
+
+    def _getExecutor(self):
+        # Created on first use so importing the app doesn't fork workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    # bulk=True waits for a slot from the bulk share instead of raising, for
+    # callers that want backpressure rather than rejection
+    def submit(self, password, salt, bulk=False):
+        bulkSlots = self._bulkSlots if bulk else None
+        if bulkSlots is not None:
+            bulkSlots.acquire()
+        if not self._slots.acquire(blocking=bulk):
+            with self._lock:
+                self._rejected += 1
+            raise HashPoolBusy("password hashing queue is full")
+        start = time.perf_counter()
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._getExecutor().submit(pbkdf2Hash, password, salt)
+        except Exception:
+            self._finish(start, bulkSlots)
+            raise
+        future.add_done_callback(lambda f: self._finish(start, bulkSlots))
+        return future
+
+    def hash(self, password, salt):
+        return self.submit(password, salt).result()
+
+    def _finish(self, start, bulkSlots=None):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            self._totalTime += elapsed
+            self._maxTime = max(self._maxTime, elapsed)
+        self._slots.release()
+        if bulkSlots is not None:
+            bulkSlots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "maxPending": self.maxPending,
+                "maxBulk": self.maxBulk,
+                "queueDepth": self._pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "hashTimeTotal": self._totalTime,
+                "hashTimeMax": self._maxTime,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdentityCache:
+    """Bounded LRU cache of username -> (role, full_name, user id) with a TTL."""
+
+    def __init__(self, maxSize=10000, ttl=60.0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> (role, fullName, userId, expires)
+        self._byId = {}  # userId -> username
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, username):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[3] < now:
+                if entry is not None:
+                    self._remove(username)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self._hits += 1
+            return entry[0], entry[1], entry[2]
+
+    # Same as get but keyed by the integer user id, returns (username, role, fullName)
+    def getById(self, userId):
+        with self._lock:
+            username = self._byId.get(userId)
+        if username is None:
+            with self._lock:
+                self._misses += 1
+            return None
+        identity = self.get(username)
+        if identity is None:
+            return None
+        return username, identity[0], identity[1]
+
+    def put(self, username, role, fullName, userId):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if username in self._entries:
+                self._remove(username)
+            self._entries[username] = (role, fullName, userId, expires)
+            self._byId[userId] = username
+            while len(self._entries) > self.maxSize:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def invalidate(self, username):
+        with self._lock:
+            if username in self._entries:
+                self._remove(username)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._byId.clear()
+
+    def _remove(self, username):
+        role, fullName, userId, expires = self._entries.pop(username)
+        if self._byId.get(userId) == username:
+            del self._byId[userId]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxSize": self.maxSize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,146 @@
+import json
+import time
+
+# Every write that changes ClassStudents, a class's seats, AddRequests,
+# DropRequests or Users appends one row to ChangeJournal from inside its own
+# transaction, so the journal holds exactly the changes that committed.
+# Downstream systems page through it with /changes and ack what they have
+# applied; rows every registered consumer has acked are compacted away.
+
+INSERT = "insert"
+DELETE = "delete"
+UPDATE = "update"
+COMPACT_BATCH = 5000  # most rows one compaction deletes, so it never holds the writer for long
+
+_recordQuery = """
+    INSERT INTO ChangeJournal (at, tableName, op, classId, userId, data)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# The seats left travel with each enrollment change, read in the same write
+_enrollmentQuery = """
+    INSERT INTO ChangeJournal (at, tableName, op, classId, userId, data)
+    VALUES (?, 'ClassStudents', ?, ?, ?, json_object('seatsLeft', (SELECT capacity FROM Classes WHERE id = ?)))
+"""
+
+
+class ChangesCompacted(Exception):
+    """The changes after the requested seq have been compacted away; the
+    consumer has to reload from the tables and carry on from latestSeq."""
+
+    def __init__(self, latestSeq):
+        super().__init__(f"changes were compacted, reload and continue from {latestSeq}")
+        self.latestSeq = latestSeq
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def _encode(data):
+    return None if data is None else json.dumps(data, separators=(",", ":"))
+
+
+def record(cursor, tableName, op, classId=None, userId=None, data=None):
+    cursor.execute(_recordQuery, [_now(), tableName, op, classId, userId, _encode(data)])
+
+
+# rows are (classId, userId, data)
+def recordMany(cursor, tableName, op, rows):
+    at = _now()
+    cursor.executemany(_recordQuery, [(at, tableName, op, classId, userId, _encode(data))
+                                      for classId, userId, data in rows])
+
+
+# After the student's ClassStudents row was inserted or deleted and the seat taken or given back
+def recordEnrollment(cursor, op, classId, studentId):
+    cursor.execute(_enrollmentQuery, [_now(), op, classId, studentId, classId])
+
+
+# pairs are (classId, studentId)
+def recordEnrollments(cursor, op, pairs):
+    at = _now()
+    cursor.executemany(_enrollmentQuery, [(at, op, classId, studentId, classId) for classId, studentId in pairs])
+
+
+# The AddRequests or DropRequests row just inserted, read back by id
+def recordRequest(cursor, table, requestId):
+    cursor.execute(f"""
+        INSERT INTO ChangeJournal (at, tableName, op, classId, userId, data)
+        SELECT ?, ?, ?, classId, studentId, json_object('requestId', id)
+        FROM {table}
+        WHERE id = ?
+    """, [_now(), table, INSERT, requestId])
+
+
+def latestSeq(cursor):
+    # AUTOINCREMENT keeps the highest seq ever handed out, even once it is compacted
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ChangeJournal'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def page(cursor, since, limit):
+    """Up to limit changes after seq since, oldest first, and the latest seq.
+    Raises ChangesCompacted if some of the changes after since are gone."""
+    # Read before the page, so a change committed in between can't look like a gap
+    latest = latestSeq(cursor)
+    cursor.execute("""
+        SELECT seq, at, tableName, op, classId, userId, data
+        FROM ChangeJournal
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    """, [since, limit])
+    rows = cursor.fetchall()
+    # seqs have no gaps, so the first row is since + 1 unless rows were compacted
+    first = rows[0][0] if rows else latest + 1
+    if since < first - 1:
+        raise ChangesCompacted(latest)
+    changes = [{
+        "seq": seq,
+        "at": at,
+        "table": tableName,
+        "op": op,
+        "classId": classId,
+        "userId": userId,
+        "data": json.loads(data) if data else None,
+    } for seq, at, tableName, op, classId, userId, data in rows]
+    return changes, max(latest, rows[-1][0]) if rows else latest
+
+
+def compact(cursor, batch=COMPACT_BATCH):
+    """Delete up to batch of the oldest changes every consumer has acked,
+    returns how many went. Nothing is compacted while there are no consumers."""
+    cursor.execute("SELECT MIN(ackedSeq) FROM ChangeConsumers")
+    acked = cursor.fetchone()[0]
+    if acked is None:
+        return 0
+    cursor.execute("""
+        DELETE FROM ChangeJournal
+        WHERE seq <= MIN(?, (SELECT MIN(seq) FROM ChangeJournal) + ? - 1)
+    """, [acked, batch])
+    return cursor.rowcount
+
+
+# Record that consumer has applied every change up to seq (registering it on
+# its first ack), then compact. Acks never move a consumer backwards.
+# Returns (ackedSeq, compacted)
+def ack(cursor, consumer, seq):
+    cursor.execute("""
+        INSERT INTO ChangeConsumers (name, ackedSeq, updated) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET ackedSeq = MAX(ackedSeq, excluded.ackedSeq), updated = excluded.updated
+        RETURNING ackedSeq
+    """, [consumer, seq, _now()])
+    ackedSeq = cursor.fetchone()[0]
+    return ackedSeq, compact(cursor)
+
+
+# A consumer that is gone for good would otherwise hold back compaction forever.
+# Returns (removed, compacted)
+def removeConsumer(cursor, consumer):
+    cursor.execute("DELETE FROM ChangeConsumers WHERE name = ?", [consumer])
+    if not cursor.rowcount:
+        return False, 0
+    return True, compact(cursor)
+
@@ -0,0 +1,217 @@
+import bisect
+import sqlite3
+import threading
+import time
+
+# Upper bounds in seconds; anything slower lands in +Inf
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Timers for the request the current thread is serving
+_current = threading.local()
+
+
+def addDbTime(seconds):
+    _current.db = getattr(_current, "db", 0.0) + seconds
+
+
+def addHashTime(seconds):
+    _current.hash = getattr(_current, "hash", 0.0) + seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that charges the time spent inside sqlite to the current request."""
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+    # Rows after the first are stepped out of sqlite by the fetch calls
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection factory for the pool: every cursor it hands out is a TimedCursor."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            addDbTime(time.perf_counter() - start)
+
+
+class _Shard:
+    # Counters owned by a single thread. Only that thread writes them, so
+    # recording needs no lock; readers copy the dicts and sum the shards
+    def __init__(self, thread):
+        self.thread = thread
+        self.inFlight = 0
+        self.requests = {}  # (route, method, status) -> count
+        self.latency = {}  # (route, method) -> [count per bucket..., +Inf count, sum]
+        self.dbTime = {}  # route -> seconds
+        self.hashTime = {}  # route -> seconds
+        self.pythonTime = {}  # route -> seconds
+
+    def merge(self, other):
+        self.inFlight += other.inFlight
+        for key, count in list(other.requests.items()):
+            self.requests[key] = self.requests.get(key, 0) + count
+        for key, values in list(other.latency.items()):
+            mine = self.latency.setdefault(key, [0] * len(values))
+            for i, value in enumerate(list(values)):
+                mine[i] += value
+        for name in ("dbTime", "hashTime", "pythonTime"):
+            mine = getattr(self, name)
+            for key, seconds in list(getattr(other, name).items()):
+                mine[key] = mine.get(key, 0.0) + seconds
+
+
+class RequestMetrics:
+    """Per-route latency histograms, status counts and time breakdown, rendered
+    in the Prometheus text format. Call start() when a request begins and
+    finish() once with its route and status."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        # Totals folded in from threads that have exited
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard(threading.current_thread())
+            self._local.shard = shard
+            with self._lock:
+                # A threaded server starts a thread per connection, so fold the
+                # dead ones away instead of letting the list grow
+                live = []
+                for other in self._shards:
+                    if other.thread.is_alive():
+                        live.append(other)
+                    else:
+                        self._retired.merge(other)
+                live.append(shard)
+                self._shards = live
+        return shard
+
+    def start(self):
+        _current.start = time.perf_counter()
+        _current.db = 0.0
+        _current.hash = 0.0
+        _current.recorded = False
+        self._shard().inFlight += 1
+
+    def finish(self, route, method, status):
+        if getattr(_current, "recorded", True):
+            return
+        _current.recorded = True
+        elapsed = time.perf_counter() - _current.start
+        shard = self._shard()
+        shard.inFlight -= 1
+        key = (route, method, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        histogram = shard.latency.get((route, method))
+        if histogram is None:
+            histogram = shard.latency[(route, method)] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, elapsed)] += 1
+        histogram[-1] += elapsed
+        db, hashing = _current.db, _current.hash
+        shard.dbTime[route] = shard.dbTime.get(route, 0.0) + db
+        shard.hashTime[route] = shard.hashTime.get(route, 0.0) + hashing
+        shard.pythonTime[route] = shard.pythonTime.get(route, 0.0) + max(elapsed - db - hashing, 0.0)
+
+    def snapshot(self):
+        total = _Shard(None)
+        with self._lock:
+            total.merge(self._retired)
+            shards = list(self._shards)
+        for shard in shards:
+            total.merge(shard)
+        return total
+
+    def render(self, extra=()):
+        """Prometheus text exposition. extra is (name, type, help, value) for
+        process-wide values the app wants to publish alongside."""
+        total = self.snapshot()
+        lines = []
+
+        def family(name, kind, text):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("http_request_duration_seconds", "histogram", "Request latency by route")
+        for (route, method), values in sorted(total.latency.items()):
+            labels = f'route="{_escape(route)}",method="{method}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += values[len(self.buckets)]
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {values[-1]}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {cumulative}")
+
+        family("http_requests_total", "counter", "Finished requests by route and status")
+        for (route, method, status), count in sorted(total.requests.items()):
+            lines.append(f'http_requests_total{{route="{_escape(route)}",method="{method}",status="{status}"}} {count}')
+
+        family("http_requests_in_flight", "gauge", "Requests currently being served")
+        lines.append(f"http_requests_in_flight {total.inFlight}")
+
+        for name, attr, text in (
+                ("http_request_db_seconds_total", "dbTime", "Time spent inside sqlite"),
+                ("http_request_hash_seconds_total", "hashTime", "Time spent waiting on PBKDF2"),
+                ("http_request_python_seconds_total", "pythonTime", "Time spent outside sqlite and PBKDF2")):
+            family(name, "counter", f"{text}, by route")
+            for route, seconds in sorted(getattr(total, attr).items()):
+                lines.append(f'{name}{{route="{_escape(route)}"}} {seconds}')
+
+        for name, kind, text, value in extra:
+            family(name, kind, text)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
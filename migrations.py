@@ -0,0 +1,360 @@
+import logging
+import os
+import sqlite3
+import sys
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "schema.sql")
+BACKFILL_BATCH = 1000
+
+# Numbered migrations applied on top of database/schema.sql, in order, each in its
+# own transaction. Never edit one that has shipped, add a new number instead.
+
+
+# executescript() would commit the open migration transaction, so run statements one by one
+def _executeAll(conn, script):
+    for statement in script.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+
+
+def _addIndexes(conn):
+    _executeAll(conn, """
+        CREATE INDEX IF NOT EXISTS idx_users_full_name ON Users(full_name);
+        CREATE INDEX IF NOT EXISTS idx_users_username_role ON Users(username, role);
+        CREATE INDEX IF NOT EXISTS idx_classes_teacher_period ON Classes(teacher, period);
+        CREATE INDEX IF NOT EXISTS idx_classes_period_capacity ON Classes(period, capacity);
+        CREATE INDEX IF NOT EXISTS idx_class_students_student ON ClassStudents(student);
+        CREATE INDEX IF NOT EXISTS idx_teacher_schedule_teacher_class ON TeacherSchedule(teacher, classId);
+    """)
+
+
+def _addUniqueRequests(conn):
+    # The duplicate-request checks in app.py assume one row per (class, student);
+    # drop any duplicates that slipped in before making the database enforce it
+    for table in ("ClassStudents", "AddRequests", "DropRequests"):
+        conn.execute(f"""
+            DELETE FROM {table}
+            WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY classId, student)
+        """)
+    _executeAll(conn, """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_class_students ON ClassStudents(classId, student);
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_add_requests ON AddRequests(classId, student);
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_drop_requests ON DropRequests(classId, student);
+    """)
+
+
+# Marks a migration that commits in small batches itself, so other connections
+# get the write lock in between. It has to be safe to re-run after a crash.
+def batched(apply):
+    apply.batched = True
+    return apply
+
+
+# (table, text column holding the name, new integer column)
+USER_REFERENCES = [
+    ("Classes", "teacher", "teacherId"),
+    ("ClassStudents", "student", "studentId"),
+    ("AddRequests", "student", "studentId"),
+    ("DropRequests", "student", "studentId"),
+    ("StudentSchedule", "student", "studentId"),
+    ("TeacherSchedule", "teacher", "teacherId"),
+]
+
+
+def _addUserIds(conn):
+    # Users keeps username as its primary key, id is a unique integer alongside it.
+    # Ids come from a counter instead of rowid so a deleted user's id is never reused
+    _executeAll(conn, """
+        ALTER TABLE Users ADD COLUMN id INTEGER;
+        CREATE UNIQUE INDEX uq_users_id ON Users(id);
+        CREATE TABLE UserIdSequence (next INTEGER NOT NULL);
+        INSERT INTO UserIdSequence (next) SELECT IFNULL(MAX(rowid), 0) FROM Users
+    """)
+    conn.execute("""
+        CREATE TRIGGER trg_users_assign_id AFTER INSERT ON Users WHEN NEW.id IS NULL
+        BEGIN
+            UPDATE UserIdSequence SET next = next + 1;
+            UPDATE Users SET id = (SELECT next FROM UserIdSequence) WHERE rowid = NEW.rowid;
+        END
+    """)
+    for table, textColumn, idColumn in USER_REFERENCES:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {idColumn} INTEGER REFERENCES Users(id)")
+    # The (classId, student) uniques would stop two students with the same name
+    # from requesting the same class, key them on the id instead
+    _executeAll(conn, """
+        DROP INDEX IF EXISTS uq_class_students;
+        DROP INDEX IF EXISTS uq_add_requests;
+        DROP INDEX IF EXISTS uq_drop_requests;
+        CREATE UNIQUE INDEX uq_class_students_id ON ClassStudents(classId, studentId);
+        CREATE UNIQUE INDEX uq_add_requests_id ON AddRequests(classId, studentId);
+        CREATE UNIQUE INDEX uq_drop_requests_id ON DropRequests(classId, studentId);
+        CREATE INDEX idx_class_students_student_id ON ClassStudents(studentId);
+        CREATE INDEX idx_add_requests_student_id ON AddRequests(studentId);
+        CREATE INDEX idx_drop_requests_student_id ON DropRequests(studentId);
+        CREATE INDEX idx_student_schedule_student_id ON StudentSchedule(studentId);
+        CREATE INDEX idx_classes_teacher_id_period ON Classes(teacherId, period);
+        CREATE INDEX idx_teacher_schedule_teacher_id_class ON TeacherSchedule(teacherId, classId)
+    """)
+
+
+# Runs one UPDATE per rowid window of BACKFILL_BATCH rows, committing each window
+def _backfillInBatches(conn, table, update):
+    last = 0
+    while True:
+        upTo = conn.execute(f"""
+            SELECT MAX(rowid) FROM (
+                SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?
+            )
+        """, [last, BACKFILL_BATCH]).fetchone()[0]
+        if upTo is None:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(update, [last, upTo])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        last = upTo
+
+
+@batched
+def _backfillUserIds(conn):
+    _backfillInBatches(conn, "Users", """
+        UPDATE Users SET id = rowid
+        WHERE rowid > ? AND rowid <= ? AND id IS NULL
+    """)
+    # Older rows name the user by full_name, AddRequests by username; prefer the
+    # unique username match and fall back to the first user with that name
+    for table, textColumn, idColumn in USER_REFERENCES:
+        _backfillInBatches(conn, table, f"""
+            UPDATE {table} SET {idColumn} = COALESCE(
+                (SELECT id FROM Users WHERE username = {table}.{textColumn}),
+                (SELECT MIN(id) FROM Users WHERE full_name = {table}.{textColumn})
+            )
+            WHERE rowid > ? AND rowid <= ? AND {idColumn} IS NULL
+        """)
+
+
+def _addPeriodMask(conn):
+    # Bit p-1 is set when the user has a class in period p
+    conn.execute("ALTER TABLE Users ADD COLUMN periodMask INTEGER NOT NULL DEFAULT 0")
+
+
+@batched
+def _backfillPeriodMask(conn):
+    _backfillInBatches(conn, "Users", """
+        UPDATE Users SET periodMask = (
+            SELECT IFNULL(SUM(DISTINCT 1 << (c.period - 1)), 0)
+            FROM ClassStudents cs
+            JOIN Classes c ON c.id = cs.classId
+            WHERE cs.studentId = Users.id
+        )
+        WHERE rowid > ? AND rowid <= ?
+    """)
+
+
+def _addRequestListingIndexes(conn):
+    # The admin listings page by id within a class; an index on classId alone
+    # keeps rowid order inside each class, so no sort is needed
+    _executeAll(conn, """
+        CREATE INDEX IF NOT EXISTS idx_add_requests_class ON AddRequests(classId);
+        CREATE INDEX IF NOT EXISTS idx_drop_requests_class ON DropRequests(classId)
+    """)
+
+
+def _addWaitlist(conn):
+    # A new row's id is above every id still in the table, so id order is
+    # join order; (classId, id) finds a class's head without a sort
+    _executeAll(conn, """
+        CREATE TABLE Waitlist (
+            id INTEGER PRIMARY KEY,
+            classId INTEGER NOT NULL,
+            studentId INTEGER NOT NULL,
+            student VARCHAR(50) NOT NULL,
+            FOREIGN KEY (classId) REFERENCES Classes(id)
+        );
+        CREATE UNIQUE INDEX uq_waitlist ON Waitlist(classId, studentId);
+        CREATE INDEX idx_waitlist_class ON Waitlist(classId, id);
+        CREATE INDEX idx_waitlist_student ON Waitlist(studentId)
+    """)
+
+
+def _addTeacherScheduleClassIndex(conn):
+    # Roster exports join TeacherSchedule by class
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_teacher_schedule_class ON TeacherSchedule(classId, teacherId)")
+
+
+def _addChangeJournal(conn):
+    # AUTOINCREMENT so a seq is never handed out twice, even after compaction
+    # has emptied the table. at is unix time in milliseconds
+    _executeAll(conn, """
+        CREATE TABLE ChangeJournal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            at INTEGER NOT NULL,
+            tableName TEXT NOT NULL,
+            op TEXT NOT NULL,
+            classId INTEGER,
+            userId INTEGER,
+            data TEXT
+        );
+        CREATE TABLE ChangeConsumers (
+            name TEXT PRIMARY KEY,
+            ackedSeq INTEGER NOT NULL,
+            updated INTEGER NOT NULL
+        )
+    """)
+
+
+def _addStudentScheduleClassIndex(conn):
+    # Deleting a class clears its StudentSchedule rows
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_student_schedule_class ON StudentSchedule(classId)")
+
+
+@batched
+def _backfillTeacherSchedule(conn):
+    # Classes created before TeacherSchedule was kept up to date have no row
+    # there, so their teacher couldn't see them. Resolve the teacher the same
+    # way _backfillUserIds did; classes whose teacher is gone stay unassigned
+    _backfillInBatches(conn, "Classes", """
+        INSERT INTO TeacherSchedule (teacher, teacherId, classId)
+        SELECT teacher, teacherId, id FROM (
+            SELECT c.id, c.teacher, COALESCE(
+                c.teacherId,
+                (SELECT id FROM Users WHERE username = c.teacher),
+                (SELECT MIN(id) FROM Users WHERE full_name = c.teacher)
+            ) AS teacherId
+            FROM Classes c
+            WHERE c.rowid > ? AND c.rowid <= ?
+                AND NOT EXISTS (SELECT 1 FROM TeacherSchedule ts WHERE ts.classId = c.id)
+        )
+        WHERE teacherId IS NOT NULL
+    """)
+
+
+MIGRATIONS = [
+    (1, "secondary indexes for the hot lookups", _addIndexes),
+    (2, "unique (classId, student) on enrollment and request tables", _addUniqueRequests),
+    (3, "integer user id columns and indexes", _addUserIds),
+    (4, "backfill integer user ids", _backfillUserIds),
+    (5, "per-user period occupancy bitmask", _addPeriodMask),
+    (6, "backfill period occupancy bitmask", _backfillPeriodMask),
+    (7, "indexes for paging request listings by class", _addRequestListingIndexes),
+    (8, "per-class waitlist", _addWaitlist),
+    (9, "TeacherSchedule by class for roster exports", _addTeacherScheduleClassIndex),
+    (10, "change journal for incremental sync", _addChangeJournal),
+    (11, "StudentSchedule by class for class deletion", _addStudentScheduleClassIndex),
+    (12, "backfill TeacherSchedule from Classes", _backfillTeacherSchedule),
+]
+
+# Queries on the request path that must be answered with an index.
+# checkQueryPlans fails if any of them plans a full table scan.
+HOT_QUERIES = [
+    ("role check", "SELECT role, full_name, id FROM Users WHERE username = ?", ["u"]),
+    ("user by id", "SELECT role, full_name FROM Users WHERE id = ?", [1]),
+    ("user by full name", "SELECT id, role FROM Users WHERE full_name = ?", ["n"]),
+    ("teacher period clash", "SELECT 1 FROM Classes WHERE teacherId = ? AND period = ?", [1, 1]),
+    ("seat index refresh", "SELECT id, className, classDescription, teacher, period, capacity FROM Classes WHERE id IN (SELECT value FROM json_each(?))", ["[1, 2]"]),
+    ("student period mask", "SELECT periodMask FROM Users WHERE id = ?", [1]),
+    ("class roster", "SELECT u.full_name FROM ClassStudents cs JOIN Users u ON u.id = cs.studentId WHERE cs.classId = ?", [1]),
+    ("duplicate add request", "SELECT 1 FROM AddRequests WHERE classId = ? AND studentId = ?", [1, 1]),
+    ("duplicate drop request", "SELECT 1 FROM DropRequests WHERE classId = ? AND studentId = ?", [1, 1]),
+    ("teacher assignment", "SELECT 1 FROM TeacherSchedule WHERE teacherId = ? AND classId = ?", [1, 1]),
+    ("add requests page", "SELECT r.id FROM AddRequests r WHERE r.id > ? ORDER BY r.id LIMIT ?", [0, 100]),
+    ("add requests page by class", "SELECT r.id FROM AddRequests r WHERE r.classId = ? AND r.id > ? ORDER BY r.id LIMIT ?", [1, 0, 100]),
+    ("drop requests page by class", "SELECT r.id FROM DropRequests r WHERE r.classId = ? AND r.id > ? ORDER BY r.id LIMIT ?", [1, 0, 100]),
+    ("waitlist head", "SELECT id, studentId, student FROM Waitlist WHERE classId = ? ORDER BY id LIMIT 1", [1]),
+    ("student schedule", "SELECT c.period, c.id FROM ClassStudents cs JOIN Classes c ON c.id = cs.classId WHERE cs.studentId = ?", [1]),
+    ("student pending requests", "SELECT r.id FROM AddRequests r LEFT JOIN Classes c ON c.id = r.classId WHERE r.studentId = ? UNION ALL SELECT r.id FROM DropRequests r LEFT JOIN Classes c ON c.id = r.classId WHERE r.studentId = ?", [1, 1]),
+    ("teacher roster export", "SELECT c.id, cs.studentId FROM TeacherSchedule ts JOIN Classes c ON c.id = ts.classId JOIN ClassStudents cs ON cs.classId = c.id LEFT JOIN Users u ON u.id = cs.studentId WHERE ts.teacherId = ? ORDER BY ts.classId, cs.studentId", [1]),
+    ("class deletion cleanup", "DELETE FROM StudentSchedule WHERE classId = ?", [1]),
+    ("changes page", "SELECT seq, at, tableName, op, classId, userId, data FROM ChangeJournal WHERE seq > ? ORDER BY seq LIMIT ?", [0, 100]),
+    ("journal compaction", "DELETE FROM ChangeJournal WHERE seq <= MIN(?, (SELECT MIN(seq) FROM ChangeJournal) + ? - 1)", [0, 5000]),
+    ("teacher classes", "SELECT Classes.className, Classes.period FROM TeacherSchedule JOIN Classes ON TeacherSchedule.classId = Classes.id WHERE TeacherSchedule.teacherId = ?", [1]),
+]
+
+
+def _ensureBaseSchema(conn, schemaPath):
+    hasUsers = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Users'").fetchone()
+    if not hasUsers:
+        with open(schemaPath) as f:
+            conn.executescript(f.read())
+        conn.executemany("INSERT OR IGNORE INTO Roles (role) VALUES (?)",
+                         [["admin"], ["teacher"], ["student"]])
+        conn.commit()
+
+
+def currentVersion(conn):
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn, schemaPath=SCHEMA_PATH, migrations=MIGRATIONS):
+    """Apply every pending migration, returns the list of versions applied."""
+    _ensureBaseSchema(conn, schemaPath)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    applied = []
+    for version, description, apply in migrations:
+        if version <= currentVersion(conn):
+            continue
+        if getattr(apply, "batched", False):
+            apply(conn)
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)",
+                         [version, description])
+            conn.commit()
+            logging.info(f"Applied migration {version}: {description}")
+            applied.append(version)
+            continue
+        # IMMEDIATE takes the write lock up front, so two servers starting at
+        # once can't both run the same migration
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= currentVersion(conn):
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                         [version, description])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def checkQueryPlans(conn, queries=HOT_QUERIES):
+    """Return (name, plan detail) for every hot query that scans a whole table."""
+    problems = []
+    for name, query, params in queries:
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query, params):
+            detail = row[-1]
+            # "SCAN t" is a full table walk, "SEARCH t USING INDEX" is what we want.
+            # Walking a json_each() parameter list is fine, it's the caller's ids
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail:
+                problems.append((name, detail))
+    return problems
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("DATABASE_PATH", "./database/database.db")
+    conn = sqlite3.connect(path)
+    try:
+        applied = migrate(conn)
+        print(f"schema version {currentVersion(conn)} (applied: {applied or 'none'})")
+        problems = checkQueryPlans(conn)
+        for name, detail in problems:
+            print(f"full scan in hot query '{name}': {detail}")
+        sys.exit(1 if problems else 0)
+    finally:
+        conn.close()
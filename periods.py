@@ -0,0 +1,56 @@
+# Period occupancy is kept as a bitmask per user (Users.periodMask):
+# bit p-1 is set when the user already has a class in period p, so a
+# schedule conflict check is a single AND.
+
+
+def periodBit(period):
+    return 1 << (period - 1)
+
+
+def freePeriods(mask, maxPeriods):
+    return [p for p in range(1, maxPeriods + 1) if not mask & periodBit(p)]
+
+
+def getPeriodMask(cursor, userId):
+    cursor.execute("SELECT periodMask FROM Users WHERE id = ?", [userId])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Set the period's bit unless it is already taken. Run it inside the enrollment
+# transaction; False means the student already has a class in that period.
+def claimPeriod(cursor, userId, period):
+    bit = periodBit(period)
+    cursor.execute("""
+        UPDATE Users SET periodMask = periodMask | ?
+        WHERE id = ? AND periodMask & ? = 0
+    """, [bit, userId, bit])
+    return cursor.rowcount == 1
+
+
+def releasePeriod(cursor, userId, period):
+    cursor.execute("UPDATE Users SET periodMask = periodMask & ~? WHERE id = ?",
+                   [periodBit(period), userId])
+
+
+# Clear the period for everyone enrolled in a class, e.g. when it is deleted
+def releaseClassPeriod(cursor, classId, period):
+    cursor.execute("""
+        UPDATE Users SET periodMask = periodMask & ~?
+        WHERE id IN (SELECT studentId FROM ClassStudents WHERE classId = ?)
+    """, [periodBit(period), classId])
+
+
+# Students with no class in any of the given periods, by id, up to limit of
+# them after afterId
+def studentsFreeIn(cursor, periods, afterId, limit):
+    mask = 0
+    for period in periods:
+        mask |= periodBit(period)
+    cursor.execute("""
+        SELECT id, username, full_name FROM Users
+        WHERE role = 'student' AND periodMask & ? = 0 AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, [mask, afterId, limit])
+    return cursor.fetchall()
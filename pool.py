@@ -0,0 +1,195 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# Pragmas applied once when a connection is created, so a borrowed
+# connection is ready to use with no per-request setup
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,  # negative means KiB, so ~16MB of page cache
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+
+# For readOnly pools: journal_mode and synchronous can't be set without write
+# access, and readers get a bigger page cache and map since they do all the scanning
+READ_PRAGMAS = {
+    "busy_timeout": 5000,
+    "cache_size": -64000,  # ~64MB
+    "mmap_size": 536870912,
+    "temp_store": "MEMORY",
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of pre-configured sqlite3 connections.
+
+    readOnly=True opens them with a mode=ro URI and query_only set, so nothing
+    borrowed from the pool can take the write lock. The database must exist."""
+
+    def __init__(self, path, maxSize=8, timeout=5.0, foreignKeys=True,
+                 statementCache=256, pragmas=None, factory=sqlite3.Connection, onConnect=None,
+                 readOnly=False):
+        self.path = path
+        self.readOnly = readOnly
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.foreignKeys = foreignKeys
+        self.statementCache = statementCache
+        if pragmas is None:
+            pragmas = READ_PRAGMAS if readOnly else DEFAULT_PRAGMAS
+        self.pragmas = dict(pragmas)
+        self.factory = factory
+        self.onConnect = onConnect  # called with each new connection, after the pragmas
+        # LIFO so the most recently used (warmest) connection is handed out first
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self._hits = 0
+        self._misses = 0
+        self._waits = 0
+        self._waitTime = 0.0
+        self._maxWait = 0.0
+
+    def _connect(self):
+        target = self.path
+        if self.readOnly:
+            target = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+        conn = sqlite3.connect(
+            target,
+            timeout=self.timeout,
+            check_same_thread=False,  # connections move between request threads
+            cached_statements=self.statementCache,
+            factory=self.factory,
+            uri=self.readOnly,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.execute(f"PRAGMA foreign_keys = {'ON' if self.foreignKeys else 'OFF'}")
+        if self.readOnly:
+            conn.execute("PRAGMA query_only = ON")
+        if self.onConnect:
+            self.onConnect(conn)
+        return conn
+
+    # A connection configured like the pooled ones but not counted against
+    # maxSize, for a long-lived owner such as the writer thread. Caller closes it
+    def dedicated(self):
+        return self._connect()
+
+    def acquire(self):
+        if self._closed:
+            raise PoolTimeout("connection pool is closed")
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        # Nothing idle, open a new connection if we are still under the limit
+        with self._lock:
+            canCreate = self._created < self.maxSize
+            if canCreate:
+                self._created += 1
+                self._misses += 1
+        if canCreate:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool is exhausted, wait for someone to give a connection back
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"no database connection free after {self.timeout}s")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._hits += 1
+            self._waits += 1
+            self._waitTime += waited
+            self._maxWait = max(self._maxWait, waited)
+        return conn
+
+    def release(self, conn):
+        if conn is None:
+            return
+        try:
+            # Never hand out a connection with a half finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def connection(self):
+        return _PooledConnection(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._created,
+                "idle": self._idle.qsize(),
+                "maxSize": self.maxSize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "waits": self._waits,
+                "waitTimeTotal": self._waitTime,
+                "waitTimeMax": self._maxWait,
+            }
+
+    def closeAll(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class _PooledConnection:
+    # with pool.connection() as conn: ... gives the connection back on exit
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire()
+        return self.conn
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None and self.conn.in_transaction:
+            self.conn.commit()
+        self.pool.release(self.conn)
+        self.conn = None
+        return False
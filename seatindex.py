@@ -0,0 +1,97 @@
+import json
+import threading
+from collections import namedtuple
+
+from writer import afterCommit
+
+OpenClass = namedtuple("OpenClass", ["id", "name", "description", "teacher", "period", "seats"])
+
+
+class SeatIndex:
+    """Classes with seats left, by period, kept in memory so "what can I still
+    take" doesn't scan Classes.
+
+    load() fills it at startup. After that every write that changes a class's
+    capacity (or creates or deletes one) calls refresh() with its ids; the
+    rows are read inside the write and applied once it commits, so the index
+    never shows seats the database doesn't have. Writes made by another
+    process aren't seen until the next load()."""
+
+    def __init__(self):
+        self._byPeriod = {}  # period -> {classId: OpenClass}, open classes only
+        self._periodOf = {}  # classId -> period, for every indexed class
+        self._sorted = {}  # period -> tuple of its open classes in id order, built on demand
+        self._lock = threading.Lock()
+
+    def load(self, cursor):
+        cursor.execute("SELECT id, className, classDescription, teacher, period, capacity FROM Classes")
+        rows = cursor.fetchall()
+        with self._lock:
+            self._byPeriod.clear()
+            self._periodOf.clear()
+            self._sorted.clear()
+            for row in rows:
+                self._set(row[0], OpenClass(*row))
+
+    # From inside a queued write, after the classes' rows have changed.
+    # onListingChanged() runs after the commit if that changed the list of open
+    # classes (one opened, filled up, appeared or went), not just seat counts
+    def refresh(self, cursor, classIds, onListingChanged=None):
+        classIds = list(set(classIds))
+        cursor.execute("""
+            SELECT id, className, classDescription, teacher, period, capacity
+            FROM Classes
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, [json.dumps(classIds)])
+        found = {row[0]: OpenClass(*row) for row in cursor.fetchall()}
+        updates = [(classId, found.get(classId)) for classId in classIds]
+        afterCommit(lambda: self._apply(updates, onListingChanged))
+
+    def _apply(self, updates, onListingChanged=None):
+        listingChanged = False
+        with self._lock:
+            for classId, entry in updates:
+                before = self._listed(classId)
+                self._set(classId, entry)
+                listingChanged = listingChanged or before != self._listed(classId)
+        if listingChanged and onListingChanged:
+            onListingChanged()
+
+    # The open class as listed, seat count aside; None if it isn't open. Caller holds the lock
+    def _listed(self, classId):
+        period = self._periodOf.get(classId)
+        entry = self._byPeriod.get(period, {}).get(classId)
+        return entry._replace(seats=None) if entry else None
+
+    # entry None means the class is gone. Caller holds the lock
+    def _set(self, classId, entry):
+        oldPeriod = self._periodOf.pop(classId, None)
+        if oldPeriod is not None:
+            if self._byPeriod.get(oldPeriod, {}).pop(classId, None) is not None:
+                self._sorted.pop(oldPeriod, None)
+        if entry is None:
+            return
+        self._periodOf[classId] = entry.period
+        if entry.seats > 0:
+            self._byPeriod.setdefault(entry.period, {})[classId] = entry
+            self._sorted.pop(entry.period, None)
+
+    def available(self, periods):
+        """Open classes in the given periods, by period then id."""
+        result = []
+        with self._lock:
+            for period in sorted(set(periods)):
+                classes = self._sorted.get(period)
+                if classes is None:
+                    openClasses = self._byPeriod.get(period, {})
+                    classes = self._sorted[period] = tuple(openClasses[classId] for classId in sorted(openClasses))
+                result.extend(classes)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "classes": len(self._periodOf),
+                "openClasses": sum(len(classes) for classes in self._byPeriod.values()),
+                "openSeats": sum(entry.seats for classes in self._byPeriod.values() for entry in classes.values()),
+            }
@@ -0,0 +1,204 @@
+import json
+import sqlite3
+
+import journal
+from periods import claimPeriod, periodBit, releasePeriod
+
+# Classes.capacity is the number of seats still open. Every change to it goes
+# through here, so a seat is only ever taken by a conditional UPDATE whose
+# outcome we check, and can't be oversubscribed by concurrent writers.
+# Both directions also write their ChangeJournal row.
+
+ENROLLED = "enrolled"
+CLASS_FULL = "full"
+NO_SUCH_CLASS = "missing"
+PERIOD_CONFLICT = "conflict"
+ALREADY_ENROLLED = "duplicate"
+
+
+# Take one seat if there is one left, returns the class period or None
+def reserveSeat(cursor, classId):
+    cursor.execute("""
+        UPDATE Classes SET capacity = capacity - 1
+        WHERE id = ? AND capacity > 0
+        RETURNING period
+    """, [classId])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Give one seat back, returns the class period or None if the class is gone
+def releaseSeat(cursor, classId):
+    cursor.execute("""
+        UPDATE Classes SET capacity = capacity + 1
+        WHERE id = ?
+        RETURNING period
+    """, [classId])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Seat + period + roster row for one student, all or nothing. Call it inside
+# an open transaction: it runs under a savepoint so a failure only undoes this
+# enrollment, not the rest of the caller's work. Returns (status, period).
+def enroll(cursor, classId, studentId, studentName):
+    cursor.execute("SAVEPOINT enroll")
+    try:
+        period = reserveSeat(cursor, classId)
+        if period is None:
+            cursor.execute("SELECT 1 FROM Classes WHERE id = ?", [classId])
+            status = CLASS_FULL if cursor.fetchone() else NO_SUCH_CLASS
+        elif not claimPeriod(cursor, studentId, period):
+            status = PERIOD_CONFLICT
+        else:
+            try:
+                cursor.execute("""
+                    INSERT INTO ClassStudents (classId, student, studentId)
+                    VALUES (?, ?, ?)
+                """, [classId, studentName, studentId])
+                journal.recordEnrollment(cursor, journal.INSERT, classId, studentId)
+                status = ENROLLED
+            except sqlite3.IntegrityError:
+                status = ALREADY_ENROLLED
+        if status != ENROLLED:
+            cursor.execute("ROLLBACK TO enroll")
+        cursor.execute("RELEASE enroll")
+        return status, period
+    except Exception:
+        cursor.execute("ROLLBACK TO enroll")
+        cursor.execute("RELEASE enroll")
+        raise
+
+
+# Undo an enrollment, returns False if the student wasn't in the class
+def unenroll(cursor, classId, studentId):
+    cursor.execute("DELETE FROM ClassStudents WHERE classId = ? AND studentId = ?",
+                   [classId, studentId])
+    if not cursor.rowcount:
+        return False
+    period = releaseSeat(cursor, classId)
+    if period is not None:
+        releasePeriod(cursor, studentId, period)
+    journal.recordEnrollment(cursor, journal.DELETE, classId, studentId)
+    return True
+
+
+# enroll() for many (classId, studentId, studentName) rows at once, in order,
+# with the same statuses: three reads up front, then one executemany per table
+# instead of a savepoint and five statements per row. Call it inside an open
+# transaction. The seat and period UPDATEs stay conditional; if another writer
+# got in between, the whole call raises. Returns [(status, period)] in row order.
+def enrollMany(cursor, rows):
+    if not rows:
+        return []
+    classIds = json.dumps(list({classId for classId, studentId, studentName in rows}))
+    studentIds = json.dumps(list({studentId for classId, studentId, studentName in rows}))
+    cursor.execute("SELECT id, period, capacity FROM Classes WHERE id IN (SELECT value FROM json_each(?))",
+                   [classIds])
+    classes = {classId: [period, capacity] for classId, period, capacity in cursor.fetchall()}
+    cursor.execute("SELECT id, periodMask FROM Users WHERE id IN (SELECT value FROM json_each(?))", [studentIds])
+    masks = dict(cursor.fetchall())
+    cursor.execute("""
+        SELECT classId, studentId FROM ClassStudents
+        WHERE classId IN (SELECT value FROM json_each(?))
+            AND studentId IN (SELECT value FROM json_each(?))
+    """, [classIds, studentIds])
+    enrolled = set(cursor.fetchall())
+
+    results = []
+    seatsTaken = {}  # classId -> seats
+    claimed = {}  # studentId -> period bits
+    inserts = []
+    for classId, studentId, studentName in rows:
+        found = classes.get(classId)
+        if found is None:
+            results.append((NO_SUCH_CLASS, None))
+            continue
+        period, capacity = found
+        if capacity <= 0:
+            results.append((CLASS_FULL, None))
+            continue
+        bit = periodBit(period)
+        mask = masks.get(studentId)
+        if mask is None or mask & bit:
+            results.append((PERIOD_CONFLICT, period))
+        elif (classId, studentId) in enrolled:
+            results.append((ALREADY_ENROLLED, period))
+        else:
+            found[1] -= 1
+            masks[studentId] = mask | bit
+            enrolled.add((classId, studentId))
+            seatsTaken[classId] = seatsTaken.get(classId, 0) + 1
+            claimed[studentId] = claimed.get(studentId, 0) | bit
+            inserts.append((classId, studentId, studentName, found[1]))
+            results.append((ENROLLED, period))
+    if not inserts:
+        return results
+
+    cursor.executemany("""
+        UPDATE Classes SET capacity = capacity - ?
+        WHERE id = ? AND capacity >= ?
+    """, [(seats, classId, seats) for classId, seats in seatsTaken.items()])
+    if cursor.rowcount != len(seatsTaken):
+        raise sqlite3.OperationalError("class seats changed during a batch enrollment")
+    cursor.executemany("""
+        UPDATE Users SET periodMask = periodMask | ?
+        WHERE id = ? AND periodMask & ? = 0
+    """, [(bits, studentId, bits) for studentId, bits in claimed.items()])
+    if cursor.rowcount != len(claimed):
+        raise sqlite3.OperationalError("student periods changed during a batch enrollment")
+    cursor.executemany("INSERT INTO ClassStudents (classId, student, studentId) VALUES (?, ?, ?)",
+                       [(classId, studentName, studentId) for classId, studentId, studentName, seatsLeft in inserts])
+    # Each row's seatsLeft is what it was right after that enrollment, as with enroll()
+    journal.recordMany(cursor, "ClassStudents", journal.INSERT,
+                       [(classId, studentId, {"seatsLeft": seatsLeft})
+                        for classId, studentId, studentName, seatsLeft in inserts])
+    return results
+
+
+# unenroll() for many (classId, studentId) pairs at once, returns the set of
+# pairs that were enrolled and are now dropped
+def unenrollMany(cursor, pairs):
+    if not pairs:
+        return set()
+    cursor.execute("""
+        DELETE FROM ClassStudents
+        WHERE id IN (
+            SELECT cs.id
+            FROM json_each(?) j
+            JOIN ClassStudents cs
+                ON cs.classId = json_extract(j.value, '$[0]')
+                AND cs.studentId = json_extract(j.value, '$[1]')
+        )
+        RETURNING classId, studentId
+    """, [json.dumps(pairs)])
+    dropped = set(cursor.fetchall())
+    if not dropped:
+        return dropped
+    ordered = [pair for pair in dict.fromkeys(pairs) if pair in dropped]
+
+    seatsFreed = {}
+    for classId, studentId in ordered:
+        seatsFreed[classId] = seatsFreed.get(classId, 0) + 1
+    cursor.executemany("UPDATE Classes SET capacity = capacity + ? WHERE id = ?",
+                       [(seats, classId) for classId, seats in seatsFreed.items()])
+    cursor.execute("SELECT id, period, capacity FROM Classes WHERE id IN (SELECT value FROM json_each(?))",
+                   [json.dumps(list(seatsFreed))])
+    classes = {classId: (period, capacity) for classId, period, capacity in cursor.fetchall()}
+
+    released = {}  # studentId -> period bits
+    journalRows = []
+    for classId, studentId in ordered:
+        found = classes.get(classId)
+        if found is None:  # class is gone, as releaseSeat() finding nothing
+            journalRows.append((classId, studentId, {"seatsLeft": None}))
+            continue
+        period, capacity = found
+        released[studentId] = released.get(studentId, 0) | periodBit(period)
+        # Seats left right after this drop, counting up to the final capacity
+        seatsFreed[classId] -= 1
+        journalRows.append((classId, studentId, {"seatsLeft": capacity - seatsFreed[classId]}))
+    cursor.executemany("UPDATE Users SET periodMask = periodMask & ~? WHERE id = ?",
+                       [(bits, studentId) for studentId, bits in released.items()])
+    journal.recordMany(cursor, "ClassStudents", journal.DELETE, journalRows)
+    return dropped
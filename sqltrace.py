@@ -0,0 +1,241 @@
+import contextlib
+import functools
+import logging
+import re
+import threading
+import time
+
+from metrics import TimedConnection, TimedCursor
+
+# Statements slower than this go to the slow query log
+DEFAULT_SLOW_SECONDS = 0.1
+# Same statement this many times in one request looks like a query per row
+DEFAULT_REPEAT_THRESHOLD = 5
+
+slowLog = logging.getLogger("slowquery")
+
+# Trace of the request the current thread is serving, None outside requests
+_current = threading.local()
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_inLists = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_spaces = re.compile(r"\s+")
+
+
+# One line, literals replaced by ?, so the same query with different values
+# (or a different number of IN items) counts as one statement
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    sql = _spaces.sub(" ", sql).strip()
+    sql = _literals.sub("?", sql)
+    return _inLists.sub("IN (?, ...)", sql)
+
+
+class _RequestTrace:
+    def __init__(self):
+        self.statements = 0  # everything sqlite ran, trigger bodies and implicit BEGINs included
+        self.executed = {}  # sql -> [executions, total seconds, slowest execution]
+
+
+class TracedCursor(TimedCursor):
+    """Times each statement from execute() to its last fetch and reports it to the tracer."""
+
+    _stats = None
+    _running = 0.0
+
+    def _record(self, sql, seconds):
+        tracer = self.connection.tracer
+        self._stats = tracer.executed(sql, seconds) if tracer else None
+        self._running = seconds
+
+    def _fetched(self, seconds):
+        if self._stats is not None:
+            self._running += seconds
+            self._stats[1] += seconds
+            self._stats[2] = max(self._stats[2], self._running)
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._fetched(time.perf_counter() - start)
+
+
+class TracedConnection(TimedConnection):
+    """Connection factory for the pool; SqlTracer.attach must run on each new connection."""
+
+    tracer = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+
+class SqlTracer:
+    """Per-request statement counts and timings, a slow query log and a warning
+    when one statement repeats enough to look like N+1.
+
+    The slow query log is always on. With enabled=True it also hooks
+    set_trace_callback on each connection to count every statement sqlite
+    runs, and keeps totals per normalized statement for /sqlStats."""
+
+    def __init__(self, enabled=False, slowSeconds=DEFAULT_SLOW_SECONDS,
+                 repeatThreshold=DEFAULT_REPEAT_THRESHOLD, maxStatements=1000):
+        self.enabled = enabled
+        self.slowSeconds = slowSeconds
+        self.repeatThreshold = repeatThreshold
+        self.maxStatements = maxStatements
+        self._totals = {}  # normalized sql -> [executions, total seconds, slowest]
+        self._lock = threading.Lock()
+
+    # Pool onConnect hook
+    def attach(self, conn):
+        conn.tracer = self
+        if self.enabled:
+            conn.set_trace_callback(self._onStatement)
+
+    def _onStatement(self, sql):
+        trace = getattr(_current, "trace", None)
+        if trace is not None:
+            trace.statements += 1
+
+    def executed(self, sql, seconds):
+        trace = getattr(_current, "trace", None)
+        if trace is None:
+            # Outside a request (startup, streamed responses) there's nothing to
+            # aggregate into, so only the slow check applies
+            if seconds >= self.slowSeconds:
+                slowLog.warning(f"{seconds * 1000:.1f}ms outside a request: {normalize(sql)}")
+            return None
+        stats = trace.executed.get(sql)
+        if stats is None:
+            stats = trace.executed[sql] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        return stats
+
+    def start(self):
+        _current.trace = _RequestTrace()
+
+    # The trace of the request this thread is serving, to hand to another thread
+    def current(self):
+        return getattr(_current, "trace", None)
+
+    # Count this thread's statements into trace (from current() on the request
+    # thread) for the duration. The request thread must be waiting meanwhile:
+    # traces aren't locked
+    @contextlib.contextmanager
+    def using(self, trace):
+        previous = getattr(_current, "trace", None)
+        _current.trace = trace
+        try:
+            yield
+        finally:
+            _current.trace = previous
+
+    def finish(self, route):
+        """End the current request's trace, returns its summary or None if there wasn't one."""
+        trace = getattr(_current, "trace", None)
+        if trace is None:
+            return None
+        _current.trace = None
+
+        # Merge the raw statements by their normalized form
+        merged = {}
+        for sql, (count, total, slowest) in trace.executed.items():
+            stats = merged.setdefault(normalize(sql), [0, 0.0, 0.0])
+            stats[0] += count
+            stats[1] += total
+            stats[2] = max(stats[2], slowest)
+
+        repeated = []
+        slowest = (None, 0.0)
+        for sql, (count, total, maxSeconds) in merged.items():
+            if maxSeconds >= self.slowSeconds:
+                slowLog.warning(f"{maxSeconds * 1000:.1f}ms in {route}: {sql}")
+            if count >= self.repeatThreshold:
+                repeated.append((sql, count))
+            if maxSeconds > slowest[1]:
+                slowest = (sql, maxSeconds)
+
+        if repeated:
+            details = "; ".join(f"{count}x {sql}" for sql, count in repeated)
+            slowLog.warning(f"{route} repeated {len(repeated)} statement(s) (N+1?): {details}")
+
+        if self.enabled:
+            with self._lock:
+                for sql, (count, total, maxSeconds) in merged.items():
+                    stats = self._totals.get(sql)
+                    if stats is None:
+                        if len(self._totals) >= self.maxStatements:
+                            continue
+                        stats = self._totals[sql] = [0, 0.0, 0.0]
+                    stats[0] += count
+                    stats[1] += total
+                    stats[2] = max(stats[2], maxSeconds)
+
+        return {
+            "statements": trace.statements,
+            "executed": sum(stats[0] for stats in merged.values()),
+            "distinct": len(merged),
+            "dbSeconds": sum(stats[1] for stats in merged.values()),
+            "slowest": slowest,
+            "repeated": repeated,
+        }
+
+    # Value for the X-SQL-Trace debug header
+    @staticmethod
+    def header(summary):
+        parts = [
+            f"statements={summary['statements']}",
+            f"executed={summary['executed']}",
+            f"distinct={summary['distinct']}",
+            f"db_ms={summary['dbSeconds'] * 1000:.2f}",
+        ]
+        if summary["repeated"]:
+            parts.append(f"repeated={len(summary['repeated'])}")
+        sql, seconds = summary["slowest"]
+        if sql:
+            parts.append(f"slowest_ms={seconds * 1000:.2f}")
+            parts.append(f"slowest={sql[:200]}")
+        return "; ".join(parts)
+
+    def stats(self, limit=50):
+        """Statements with the most total time since startup."""
+        with self._lock:
+            items = [(sql, list(values)) for sql, values in self._totals.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [
+            {"sql": sql, "executions": count, "totalMs": round(total * 1000, 3),
+             "avgMs": round(total * 1000 / count, 3), "maxMs": round(maxSeconds * 1000, 3)}
+            for sql, (count, total, maxSeconds) in items[:limit]
+        ]
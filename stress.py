@@ -0,0 +1,121 @@
+"""Hammer seats.enroll from many threads and check no class is overbooked.
+
+    python stress.py --students 2000 --classes 4 --capacity 100 --threads 16 [--writer]
+
+--writer sends the enrollments through a WriteQueue, the way the server does,
+instead of each thread taking the write lock itself.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import migrations
+import seats
+from pool import ConnectionPool
+from writer import WriteQueue
+
+
+def seed(path, students, classes, capacity):
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    conn.execute("INSERT INTO Users (username, full_name, salt, hash, role) VALUES ('t', 'Teacher', '', '', 'teacher')")
+    teacherId = conn.execute("SELECT id FROM Users WHERE username = 't'").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO Users (username, full_name, salt, hash, role) VALUES (?, ?, '', '', 'student')",
+        [[f"s{i}", f"Student {i}"] for i in range(students)])
+    # every class in its own period so a student can end up in all of them
+    conn.executemany(
+        "INSERT INTO Classes (className, classDescription, capacity, teacher, teacherId, period) VALUES (?, '', ?, 'Teacher', ?, ?)",
+        [[f"Class {c}", capacity, teacherId, c + 1] for c in range(classes)])
+    conn.commit()
+    classIds = [row[0] for row in conn.execute("SELECT id FROM Classes")]
+    studentRows = conn.execute("SELECT id, full_name FROM Users WHERE role = 'student'").fetchall()
+    conn.close()
+    return classIds, studentRows
+
+
+def run(args):
+    workDir = tempfile.mkdtemp()
+    path = os.path.join(workDir, "stress.db")
+    classIds, studentRows = seed(path, args.students, args.classes, args.capacity)
+    pool = ConnectionPool(path, maxSize=args.threads, foreignKeys=False)
+    writeQueue = WriteQueue(pool.dedicated) if args.writer else None
+
+    # every student tries every class, in a random order, so the threads collide
+    attempts = [(classId, studentId, name) for classId in classIds for studentId, name in studentRows]
+    random.shuffle(attempts)
+    counts = {}
+    countsLock = threading.Lock()
+    nextAttempt = iter(attempts)
+    iterLock = threading.Lock()
+
+    def worker():
+        local = {}
+        while True:
+            with iterLock:
+                attempt = next(nextAttempt, None)
+            if attempt is None:
+                break
+            classId, studentId, name = attempt
+            try:
+                if writeQueue:
+                    status, period = writeQueue.run(lambda cursor: seats.enroll(cursor, classId, studentId, name))
+                else:
+                    with pool.connection() as conn:
+                        conn.execute("BEGIN")
+                        status, period = seats.enroll(conn.cursor(), classId, studentId, name)
+                        conn.commit()
+            except sqlite3.Error as e:
+                status = f"error ({e})"
+            local[status] = local.get(status, 0) + 1
+        with countsLock:
+            for status, n in local.items():
+                counts[status] = counts.get(status, 0) + n
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if writeQueue:
+        writeQueue.close()
+        groups = writeQueue.stats()
+
+    conn = sqlite3.connect(path)
+    failures = []
+    for classId in classIds:
+        left = conn.execute("SELECT capacity FROM Classes WHERE id = ?", [classId]).fetchone()[0]
+        enrolled = conn.execute("SELECT COUNT(*) FROM ClassStudents WHERE classId = ?", [classId]).fetchone()[0]
+        if left < 0 or enrolled > args.capacity or enrolled + left != args.capacity:
+            failures.append(f"class {classId}: {enrolled} enrolled, {left} seats left, capacity {args.capacity}")
+    conn.close()
+    pool.closeAll()
+
+    print(f"{len(attempts)} attempts on {args.threads} threads in {elapsed:.2f}s "
+          f"({len(attempts) / elapsed:.0f} enrollments/s)")
+    for status, n in sorted(counts.items()):
+        print(f"  {status}: {n}")
+    if writeQueue:
+        print(f"  {groups['groups']} write transactions, largest group {groups['largestGroup']}")
+    if counts.get(seats.ENROLLED, 0) != min(args.capacity, args.students) * args.classes:
+        failures.append(f"expected every seat taken, got {counts.get(seats.ENROLLED, 0)} enrollments")
+    for failure in failures:
+        print(f"OVERBOOKED {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--classes", type=int, default=4)
+    parser.add_argument("--capacity", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writer", action="store_true")
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,97 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import namedtuple
+
+Identity = namedtuple("Identity", ["username", "userId", "fullName", "role", "issued", "expires"])
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _nowMs():
+    return int(time.time() * 1000)
+
+
+class RevocationSet:
+    """Per-user 'tokens issued before this moment are dead' markers."""
+
+    def __init__(self, ttl):
+        # A marker only has to outlive the tokens it kills
+        self.ttl = ttl
+        self._revokedAt = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, username):
+        now = _nowMs()
+        with self._lock:
+            self._revokedAt[username] = now
+            self._prune(now)
+
+    def isRevoked(self, username, issued):
+        with self._lock:
+            revokedAt = self._revokedAt.get(username)
+        return revokedAt is not None and issued <= revokedAt
+
+    def _prune(self, now):
+        cutoff = now - int(self.ttl * 1000)
+        for username in [u for u, at in self._revokedAt.items() if at < cutoff]:
+            del self._revokedAt[username]
+
+
+class TokenSigner:
+    """Stateless HMAC-SHA256 session tokens: <payload>.<signature>, both base64url."""
+
+    def __init__(self, secret, ttl=3600, revocations=None):
+        self.secret = secret if isinstance(secret, bytes) else secret.encode()
+        self.ttl = ttl
+        self.revocations = revocations or RevocationSet(ttl)
+
+    def _sign(self, payload):
+        return _encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, username, userId, fullName, role):
+        issued = _nowMs()
+        expires = issued + int(self.ttl * 1000)
+        body = json.dumps({"u": username, "d": userId, "n": fullName, "r": role, "i": issued, "e": expires},
+                          separators=(",", ":"))
+        payload = _encode(body.encode())
+        return f"{payload}.{self._sign(payload)}", expires
+
+    def verify(self, token):
+        try:
+            payload, signature = token.split(".")
+        except (AttributeError, ValueError):
+            raise InvalidToken("malformed token")
+        # compare_digest only takes ASCII str, and a bearer header can carry anything
+        try:
+            signature, expected = signature.encode(), self._sign(payload).encode()
+        except UnicodeError:
+            raise InvalidToken("malformed token")
+        if not hmac.compare_digest(signature, expected):
+            raise InvalidToken("bad signature")
+        try:
+            data = json.loads(_decode(payload))
+            identity = Identity(data["u"], data["d"], data["n"], data["r"], data["i"], data["e"])
+        except (ValueError, KeyError, TypeError):
+            raise InvalidToken("malformed token")
+        if identity.expires < _nowMs():
+            raise InvalidToken("token expired")
+        if self.revocations.isRevoked(identity.username, identity.issued):
+            raise InvalidToken("token revoked")
+        return identity
+
+    def revoke(self, username):
+        self.revocations.revoke(username)
@@ -0,0 +1,190 @@
+"""Bulk user import from a CSV or JSONL file.
+
+    python userimport.py users.csv [--db path] [--format csv|jsonl] [--batch 500] [--workers N]
+
+Rows need username, full_name, password and role. The file is read as a stream
+and handled one batch at a time, so memory stays flat whatever its size.
+"""
+import argparse
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import journal
+import migrations
+from hashing import HashExecutor
+from writer import transaction
+
+IMPORT_BATCH = 500
+MAX_REPORTED_ERRORS = 1000  # past this only the count goes up
+ROLES = ("admin", "student", "teacher")
+FIELDS = ("username", "full_name", "password", "role")
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+# Yields (line number, row dict) from an iterable of text lines. A line that
+# can't be parsed comes out as (line number, error string) instead
+def parseRows(lines, format="csv"):
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        missing = [field for field in FIELDS if field not in (reader.fieldnames or [])]
+        if missing:
+            raise ImportFormatError(f"csv header is missing {', '.join(missing)}")
+        for row in reader:
+            yield reader.line_num, row
+    elif format == "jsonl":
+        for lineNumber, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield lineNumber, "not valid json"
+                continue
+            yield lineNumber, row if isinstance(row, dict) else "not a json object"
+    else:
+        raise ImportFormatError(f"unknown format {format!r}, expected csv or jsonl")
+
+
+# Returns an error string, or None if the row can be inserted
+def _validate(row):
+    if isinstance(row, str):
+        return row
+    values = [row.get(field) for field in FIELDS]
+    if not all(isinstance(value, str) and value for value in values):
+        return "username, full_name, password and role are all required"
+    if row["role"] not in ROLES:
+        return "Invalid role"
+    return None
+
+
+class ImportReport:
+    """Running totals for one import, with the first MAX_REPORTED_ERRORS row errors."""
+
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def fail(self, lineNumber, username, error):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": lineNumber, "username": username, "error": error})
+
+    def asDict(self):
+        return {
+            "created": self.created,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errorsTruncated": self.failed > len(self.errors),
+            "seconds": round(time.perf_counter() - self.started, 3),
+        }
+
+
+# One write per batch; a rejected row fails only its own statement.
+# Returns whether each row was inserted
+def _insertBatch(batch, cursor):
+    inserted = []
+    for lineNumber, row, salt, hashedPassword in batch:
+        cursor.execute("""
+            INSERT INTO Users (username, full_name, salt, hash, role)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (username) DO NOTHING
+        """, [row["username"], row["full_name"], salt, hashedPassword, row["role"]])
+        inserted.append(cursor.rowcount == 1)
+        if inserted[-1]:
+            # id is assigned by the trg_users_assign_id trigger
+            cursor.execute("SELECT id FROM Users WHERE username = ?", [row["username"]])
+            journal.record(cursor, "Users", journal.INSERT, userId=cursor.fetchone()[0], data={"role": row["role"]})
+    return inserted
+
+
+def importUsers(write, rows, hasher, batchSize=IMPORT_BATCH, onCreated=None):
+    """Insert users from parseRows() output, returns an ImportReport.
+
+    write(fn) runs fn(cursor) in a transaction and returns its result:
+    WriteQueue.run in the server, writer.transaction on a plain connection
+    otherwise. Passwords for a batch are hashed in parallel on the hasher's
+    process pool while the batch is collected. Imports get at most half of the
+    hasher's queue and block when that share is full, so a big file slows
+    down instead of being rejected and logins still find room."""
+    report = ImportReport()
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, batchSize))
+        if not chunk:
+            return report
+        pending = []
+        for lineNumber, row in chunk:
+            error = _validate(row)
+            if error:
+                report.fail(lineNumber, row.get("username") if isinstance(row, dict) else None, error)
+                continue
+            salt = os.urandom(16).hex()
+            pending.append((lineNumber, row, salt, hasher.submit(row["password"], salt, bulk=True)))
+        batch = [(lineNumber, row, salt, future.result()) for lineNumber, row, salt, future in pending]
+        if not batch:
+            continue
+        inserted = write(functools.partial(_insertBatch, batch))
+        for (lineNumber, row, salt, hashedPassword), created in zip(batch, inserted):
+            if created:
+                report.created += 1
+                if onCreated:
+                    onCreated(row["username"])
+            else:
+                report.fail(lineNumber, row["username"], "username already exists")
+
+
+# Text lines from a binary stream, without reading it all in
+def textLines(binaryStream):
+    return io.TextIOWrapper(binaryStream, encoding="utf-8", newline="")
+
+
+def formatFor(filename, contentType=None):
+    if contentType:
+        if "csv" in contentType:
+            return "csv"
+        if "json" in contentType:
+            return "jsonl"
+    return "jsonl" if filename and filename.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file")
+    parser.add_argument("--db", default=os.environ.get("DATABASE_PATH", "./database/database.db"))
+    parser.add_argument("--format", choices=["csv", "jsonl"])
+    parser.add_argument("--batch", type=int, default=IMPORT_BATCH)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    hasher = HashExecutor(workers=args.workers)
+    try:
+        migrations.migrate(conn)
+        with open(args.file, newline="", encoding="utf-8") as f:
+            rows = parseRows(f, args.format or formatFor(args.file))
+            report = importUsers(functools.partial(transaction, conn), rows, hasher, args.batch)
+    except ImportFormatError as e:
+        print(e)
+        sys.exit(2)
+    finally:
+        hasher.shutdown()
+        conn.close()
+    result = report.asDict()
+    for error in result["errors"]:
+        print(f"line {error['line']}: {error['username'] or '-'}: {error['error']}")
+    print(f"created {result['created']}, failed {result['failed']} in {result['seconds']}s")
+    sys.exit(1 if report.failed else 0)
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from writer import afterCommit
+
+# Key bumped by changes that can't say what they touched, every ETag depends on it
+EVERYTHING = ("all",)
+# Key for anything that changes which classes have seats: a class opening,
+# filling up, being created or deleted. Seat counts alone move ("seats", id)
+CATALOG = ("catalog",)
+
+
+class DataVersions:
+    """In-memory change counters per key: ("class", id), ("seats", id),
+    ("student", id), ("teacher", id), ("waitlist", id), CATALOG and EVERYTHING.
+
+    Writes call touch() with what they changed; the counters move only once
+    that write commits. A GET derives its ETag from the counters of what it
+    read, so an unchanged ETag means an unchanged response. Counters start
+    over on restart, which is why each ETag also carries a random epoch."""
+
+    def __init__(self):
+        self.epoch = os.urandom(6).hex()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    # From inside a queued write
+    def touch(self, *keys):
+        afterCommit(lambda: self.bump(*keys))
+
+    def touchAll(self):
+        self.touch(EVERYTHING)
+
+    def bump(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def etag(self, resource, keys):
+        """ETag for resource (anything identifying the response, such as path
+        and user) while the given keys stay where they are now."""
+        with self._lock:
+            versions = [self._versions.get(key, 0) for key in (EVERYTHING, *keys)]
+        digest = hashlib.blake2b(repr((resource, versions)).encode(), digest_size=12)
+        return f"{self.epoch}-{digest.hexdigest()}"
+
+
+class ResponseCache:
+    """Bounded LRU cache of resource -> (etag, response body). An entry is only
+    good for the ETag it was stored with, so stale entries are never served,
+    just replaced or evicted."""
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._notModified = 0
+        self._evictions = 0
+
+    def get(self, resource, etag):
+        with self._lock:
+            entry = self._entries.get(resource)
+            if entry is None or entry[0] != etag:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(resource)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, resource, etag, body):
+        with self._lock:
+            self._entries[resource] = (etag, body)
+            self._entries.move_to_end(resource)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    # A 304 never touches the cache but is counted with it
+    def notModified(self):
+        with self._lock:
+            self._notModified += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxSize": self.maxSize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "notModified": self._notModified,
+                "evictions": self._evictions,
+            }
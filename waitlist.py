@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+
+import seats
+from writer import afterCommit
+
+
+class Waitlists:
+    """Per-class FIFO of students waiting for a seat.
+
+    The Waitlist table is the record, and it is what writes read and change:
+    inside a group commit the in-memory copy is behind until the group
+    commits. That copy, a deque of student ids per class updated through
+    afterCommit, answers position queries without touching the database."""
+
+    def __init__(self):
+        self._queues = {}  # classId -> deque of studentIds, head first
+        self._byStudent = {}  # studentId -> set of classIds they wait for
+        self._lock = threading.Lock()
+        self._promoted = 0
+
+    def load(self, cursor):
+        cursor.execute("SELECT classId, studentId FROM Waitlist ORDER BY classId, id")
+        rows = cursor.fetchall()
+        with self._lock:
+            self._queues.clear()
+            self._byStudent.clear()
+            for classId, studentId in rows:
+                self._append(classId, studentId)
+
+    # Puts the student at the end of the class's list, from inside a queued write.
+    # Returns their position, or None if they were already on it
+    def join(self, cursor, classId, studentId, student):
+        cursor.execute("""
+            INSERT INTO Waitlist (classId, studentId, student) VALUES (?, ?, ?)
+            ON CONFLICT (classId, studentId) DO NOTHING
+        """, [classId, studentId, student])
+        if cursor.rowcount != 1:
+            return None
+        cursor.execute("SELECT COUNT(*) FROM Waitlist WHERE classId = ? AND id <= ?",
+                       [classId, cursor.lastrowid])
+        position = cursor.fetchone()[0]
+        afterCommit(lambda: self._locked(self._append, classId, studentId))
+        return position
+
+    # Returns False if the student wasn't on the class's list
+    def leave(self, cursor, classId, studentId):
+        cursor.execute("DELETE FROM Waitlist WHERE classId = ? AND studentId = ?", [classId, studentId])
+        if not cursor.rowcount:
+            return False
+        afterCommit(lambda: self._locked(self._remove, classId, [studentId]))
+        return True
+
+    # Gives a seat that just opened to the head of the list, from inside the
+    # write that opened it. Students who can't take the class any more (their
+    # period got taken, their account is gone) are dropped on the way.
+    # Returns the promoted student's id, or None
+    def promote(self, cursor, classId):
+        removed = []
+        promoted = None
+        while promoted is None:
+            cursor.execute("SELECT id, studentId, student FROM Waitlist WHERE classId = ? ORDER BY id LIMIT 1",
+                           [classId])
+            head = cursor.fetchone()
+            if head is None:
+                break
+            entryId, studentId, student = head
+            status, period = seats.enroll(cursor, classId, studentId, student)
+            if status == seats.CLASS_FULL:
+                break
+            if status == seats.NO_SUCH_CLASS:
+                self.dropClass(cursor, classId)
+                break
+            cursor.execute("DELETE FROM Waitlist WHERE id = ?", [entryId])
+            removed.append(studentId)
+            if status == seats.ENROLLED:
+                promoted = studentId
+        if removed:
+            afterCommit(lambda: self._locked(self._remove, classId, removed, promoted is not None))
+        return promoted
+
+    # When the class is deleted
+    def dropClass(self, cursor, classId):
+        cursor.execute("DELETE FROM Waitlist WHERE classId = ?", [classId])
+        if cursor.rowcount:
+            afterCommit(lambda: self._locked(self._dropClass, classId))
+
+    # When the student is deleted
+    def removeStudent(self, cursor, studentId):
+        cursor.execute("DELETE FROM Waitlist WHERE studentId = ? RETURNING classId", [studentId])
+        classIds = [row[0] for row in cursor.fetchall()]
+        if classIds:
+            afterCommit(lambda: self._locked(self._removeStudent, studentId, classIds))
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            fn(*args)
+
+    # The methods below change the in-memory copy; the caller holds the lock
+    def _append(self, classId, studentId):
+        self._queues.setdefault(classId, deque()).append(studentId)
+        self._byStudent.setdefault(studentId, set()).add(classId)
+
+    def _remove(self, classId, studentIds, promoted=False):
+        queue = self._queues.get(classId)
+        for studentId in studentIds:
+            # Promotion removes from the head, so this is O(1) there
+            if queue and queue[0] == studentId:
+                queue.popleft()
+            elif queue and studentId in queue:
+                queue.remove(studentId)
+            self._forget(studentId, classId)
+        if queue is not None and not queue:
+            del self._queues[classId]
+        if promoted:
+            self._promoted += 1
+
+    def _dropClass(self, classId):
+        for studentId in self._queues.pop(classId, ()):
+            self._forget(studentId, classId)
+
+    def _removeStudent(self, studentId, classIds):
+        for classId in classIds:
+            self._remove(classId, [studentId])
+
+    def _forget(self, studentId, classId):
+        classIds = self._byStudent.get(studentId)
+        if classIds is not None:
+            classIds.discard(classId)
+            if not classIds:
+                del self._byStudent[studentId]
+
+    def positions(self, studentId):
+        """[{"classId", "position", "length"}] for every list the student is on, 1 is next."""
+        with self._lock:
+            result = []
+            for classId in sorted(self._byStudent.get(studentId, ())):
+                queue = self._queues[classId]
+                result.append({"classId": classId, "position": queue.index(studentId) + 1, "length": len(queue)})
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "classes": len(self._queues),
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "promoted": self._promoted,
+            }
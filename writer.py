@@ -0,0 +1,194 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+# Stops the writer thread once everything queued ahead of it is applied
+_STOP = object()
+
+# afterCommit callbacks registered by the write running on this thread
+_local = threading.local()
+
+
+class WriteQueueFull(Exception):
+    pass
+
+
+class Rollback(Exception):
+    """Raise from a queued write to undo its own changes and still hand value back."""
+
+    def __init__(self, value=None):
+        super().__init__(value)
+        self.value = value
+
+
+# Call callback() once the write that is running commits, or never if it is
+# rolled back. For in-memory state that must not run ahead of the database
+def afterCommit(callback):
+    callbacks = getattr(_local, "callbacks", None)
+    if callbacks is None:
+        raise RuntimeError("afterCommit called outside a write")
+    callbacks.append(callback)
+
+
+# Runs fn(cursor), returns (result, error, callbacks it registered)
+def _runWrite(fn, cursor):
+    _local.callbacks = callbacks = []
+    try:
+        return fn(cursor), None, callbacks
+    except Rollback as e:
+        return e.value, e, []
+    except Exception as e:
+        return None, e, []
+    finally:
+        _local.callbacks = None
+
+
+def _runCallbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"afterCommit callback failed: {e}")
+
+
+# BEGIN IMMEDIATE ... COMMIT around fn(cursor) on a connection the caller owns.
+# The same contract as WriteQueue.run for code that can also run without the server
+def transaction(conn, fn):
+    conn.execute("BEGIN IMMEDIATE")
+    result, error, callbacks = _runWrite(fn, conn.cursor())
+    if error is not None:
+        conn.rollback()
+        if isinstance(error, Rollback):
+            return result
+        raise error
+    conn.commit()
+    _runCallbacks(callbacks)
+    return result
+
+
+class WriteQueue:
+    """One thread owns the only writing connection and applies queued writes,
+    as many as are waiting (up to maxBatch) per transaction.
+
+    A write is a function taking a cursor. It runs under its own savepoint, so
+    if it raises only its changes are undone, and its caller gets the return
+    value (or the exception) once the transaction holding it has committed
+    and its afterCommit callbacks have run. It must not commit, roll back or
+    BEGIN, and shouldn't do slow work like password hashing: everyone queued
+    behind it waits."""
+
+    def __init__(self, connect, maxBatch=64, maxPending=1024, submitTimeout=5.0):
+        self.maxBatch = maxBatch
+        self.submitTimeout = submitTimeout
+        # Opened here so a bad path fails at startup, not on the first write
+        self._conn = connect()
+        self._queue = queue.Queue(maxsize=maxPending)
+        self._lock = threading.Lock()
+        self._groups = 0
+        self._writes = 0
+        self._failedGroups = 0
+        self._largestGroup = 0
+        self._commitTime = 0.0
+        self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        future = Future()
+        try:
+            self._queue.put((fn, future), timeout=self.submitTimeout)
+        except queue.Full:
+            raise WriteQueueFull(f"write queue still full after {self.submitTimeout}s")
+        return future
+
+    def run(self, fn):
+        return self.submit(fn).result()
+
+    def _loop(self):
+        conn = self._conn
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                group = [item]
+                stopping = False
+                # Everything that queued up during the last commit goes in this one
+                while len(group) < self.maxBatch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    group.append(item)
+                self._apply(conn, group)
+                if stopping:
+                    return
+        finally:
+            conn.close()
+
+    def _apply(self, conn, group):
+        start = time.perf_counter()
+        outcomes = []
+        committed = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            for fn, future in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT queued_write")
+                result, error, callbacks = _runWrite(fn, cursor)
+                if error is not None:
+                    cursor.execute("ROLLBACK TO queued_write")
+                    if isinstance(error, Rollback):
+                        error = None
+                committed.extend(callbacks)
+                outcomes.append((future, result, error))
+                cursor.execute("RELEASE queued_write")
+            conn.commit()
+        except Exception as e:
+            # The transaction itself failed, so nothing in the group was written
+            logging.error(f"Write group of {len(group)} failed: {e}")
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            for fn, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            with self._lock:
+                self._failedGroups += 1
+            return
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._groups += 1
+            self._writes += len(group)
+            self._largestGroup = max(self._largestGroup, len(group))
+            self._commitTime += elapsed
+        # Before any caller hears back, so it never sees in-memory state older than its write
+        _runCallbacks(committed)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queueDepth": self._queue.qsize(),
+                "groups": self._groups,
+                "writes": self._writes,
+                "failedGroups": self._failedGroups,
+                "largestGroup": self._largestGroup,
+                "groupTimeTotal": self._commitTime,
+            }
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()